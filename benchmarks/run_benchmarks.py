@@ -0,0 +1,161 @@
+"""
+    Benchmarks for the build and query paths on synthetic collections in a temporary local chroma db.
+
+    python -m benchmarks.run_benchmarks --hps 18000 --diseases 12000 --dim 256 --output results.json
+    python -m benchmarks.run_benchmarks --compare baseline.json results.json --threshold 0.15
+"""
+import argparse
+import json
+import logging
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+import chromadb
+import numpy as np
+
+from benchmarks.synthetic import populate_source_collections
+from core.chromadb_manager import ChromaDBManager
+from core.data_processor import DataProcessor
+from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
+from core.hp_embedding_service import HPEmbeddingService
+from core.query_service import QueryService
+
+logger = logging.getLogger(__name__)
+
+# metrics where a larger value is better, everything else (seconds, latencies, memory) is better when smaller
+HIGHER_IS_BETTER = ("qps", "rows_per_second")
+
+
+def peak_rss_mb() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 / 1024 if sys.platform == "darwin" else usage / 1024  # bytes on macOS, KiB on linux
+
+
+@contextmanager
+def timed(results: Dict, name: str):
+    start = time.perf_counter()
+    yield
+    results[f"{name}.seconds"] = time.perf_counter() - start
+
+
+def latency_stats(latencies: List[float], prefix: str) -> Dict[str, float]:
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        f"{prefix}.p50_ms": float(np.percentile(latencies_ms, 50)),
+        f"{prefix}.p99_ms": float(np.percentile(latencies_ms, 99)),
+        f"{prefix}.qps": len(latencies) / (latencies_ms.sum() / 1000) if latencies_ms.sum() else 0.0,
+    }
+
+
+def run(args) -> Dict:
+    path = tempfile.mkdtemp(prefix="hpdisease-bench-")
+    metrics = {}
+    try:
+        populate_source_collections(chromadb.PersistentClient(path=path), n_hps=args.hps, n_diseases=args.diseases,
+                                    dim=args.dim, min_hps=args.min_hps, max_hps=args.max_hps, seed=args.seed)
+        db_manager = ChromaDBManager(path=path)
+
+        with timed(metrics, "data_processor_init"):
+            data_processor = DataProcessor(db_manager)
+        with timed(metrics, "hp_embedding_service"):
+            HPEmbeddingService(data_processor, batch_size=args.batch_size).process_data()
+        disease_service = DiseaseAvgEmbeddingService(data_processor, batch_size=args.batch_size)
+        with timed(metrics, "disease_avg_embedding_service"):
+            disease_service.process_data()
+        metrics["hp_embedding_service.rows_per_second"] = len(data_processor.hp_embeddings) / \
+            metrics["hp_embedding_service.seconds"]
+        metrics["disease_avg_embedding_service.rows_per_second"] = len(data_processor.disease_incidence) / \
+            metrics["disease_avg_embedding_service.seconds"]
+
+        rng = np.random.default_rng(args.seed + 1)
+        hp_ids = data_processor.hp_embeddings.ids
+        queries = [list(rng.choice(hp_ids, size=rng.integers(3, 15), replace=False)) for _ in range(args.queries)]
+        for backend in args.backends:
+            query_service = QueryService(data_processor, db_manager, disease_service, search_backend=backend)
+            query_service.get_search_backend()  # build outside the timed loop
+            latencies = []
+            for hpo_ids in queries:
+                start = time.perf_counter()
+                query_service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hpo_ids, args.n_results)
+                latencies.append(time.perf_counter() - start)
+            metrics.update(latency_stats(latencies, f"query.{backend}"))
+            if backend != "chroma":
+                start = time.perf_counter()
+                query_service.query_many(queries, args.n_results)
+                metrics[f"query_many.{backend}.qps"] = len(queries) / (time.perf_counter() - start)
+        metrics["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return {
+        "params": {key: value for key, value in vars(args).items() if key not in ("compare", "output", "threshold")},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "chromadb": chromadb.__version__, "machine": platform.machine()},
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "metrics": metrics,
+    }
+
+
+def compare(baseline: Dict, current: Dict, threshold: float) -> List[str]:
+    """
+    :return: One message per metric that got worse than baseline by more than threshold (relative).
+    """
+    regressions = []
+    for name, old in sorted(baseline["metrics"].items()):
+        new = current["metrics"].get(name)
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+        status = "REGRESSION" if worse > threshold else "ok"
+        print(f"{status:<10} {name:<50} {old:>12.4f} -> {new:>12.4f} ({change:+.1%})")
+        if worse > threshold:
+            regressions.append(f"{name}: {old:.4f} -> {new:.4f} ({change:+.1%})")
+    if baseline.get("params") != current.get("params"):
+        print("warning: runs used different parameters, comparison may be meaningless")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hps", type=int, default=2000, help="number of HP terms in ont_hp")
+    parser.add_argument("--diseases", type=int, default=1000, help="number of diseases in hpoa")
+    parser.add_argument("--dim", type=int, default=128, help="embedding dimension")
+    parser.add_argument("--min-hps", type=int, default=3, help="minimum annotations per disease")
+    parser.add_argument("--max-hps", type=int, default=40, help="maximum annotations per disease")
+    parser.add_argument("--queries", type=int, default=200, help="number of timed queries per backend")
+    parser.add_argument("--n-results", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=None, help="upsert batch size")
+    parser.add_argument("--backends", nargs="+", default=["numpy", "chroma"], help="search backends to time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as json to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two result files instead of running, exit code 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change that counts as regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], "r") as file:
+            baseline = json.load(file)
+        with open(args.compare[1], "r") as file:
+            current = json.load(file)
+        regressions = compare(baseline, current, args.threshold)
+        print(f"{len(regressions)} regression(s)")
+        return 1 if regressions else 0
+
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+import json
+
+import numpy as np
+
+"""
+    Synthetic ont_hp and hpoa collections shaped like the curate-gpt ones (all fields inside a '_json' metadata blob),
+    at any scale. Used by the benchmarks and the tests.
+"""
+
+FREQUENCIES = ("", "1/2", "2/8", "HP:0040281", "HP:0040283", "40%")
+
+
+def populate_source_collections(client, n_hps=60, n_diseases=25, dim=8, min_hps=2, max_hps=10,
+                                negated_ratio=0.0, seed=0, batch_size=None):
+    """
+    Creates ont_hp and hpoa in the given chroma client.
+
+    :param n_hps: Number of HP terms in ont_hp.
+    :param n_diseases: Number of diseases in hpoa.
+    :param dim: Embedding dimension.
+    :param min_hps: Minimum annotations per disease.
+    :param max_hps: Maximum (exclusive) annotations per disease.
+    :param negated_ratio: Share of annotations with a NOT qualifier.
+    :param seed: Random seed, the same arguments always give the same collections.
+    :param batch_size: Rows per add call, defaults to the client's max batch size.
+    """
+    rng = np.random.default_rng(seed)
+    batch_size = batch_size or client.get_max_batch_size()
+    hp_ids = [f"HP:{i:07d}" for i in range(n_hps)]
+    ont_hp = client.create_collection("ont_hp")
+    embeddings = rng.normal(size=(n_hps, dim)).astype(np.float32)
+    for start in range(0, n_hps, batch_size):
+        end = start + batch_size
+        ont_hp.add(ids=hp_ids[start:end], embeddings=embeddings[start:end],
+                   metadatas=[{"_json": json.dumps({"original_id": hp_id})} for hp_id in hp_ids[start:end]])
+
+    ids, metadatas = [], []
+    for d in range(n_diseases):
+        disease = f"OMIM:{600000 + d}"
+        for hp_id in rng.choice(hp_ids, size=min(rng.integers(min_hps, max_hps), n_hps), replace=False):
+            ids.append(f"{d}-{hp_id}")
+            metadatas.append({"_json": json.dumps({
+                "disease": disease, "disease_label": f"Synthetic disease {d}", "phenotype": str(hp_id),
+                "qualifier": "NOT" if rng.random() < negated_ratio else "",
+                "frequency": FREQUENCIES[rng.integers(len(FREQUENCIES))], "onset": "", "aspect": "P"})})
+    hpoa = client.create_collection("hpoa")
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        hpoa.add(ids=ids[start:end], embeddings=np.zeros((len(ids[start:end]), dim), dtype=np.float32),
+                 metadatas=metadatas[start:end])
+    return hp_ids
@@ -0,0 +1,17 @@
+import chromadb
+import pytest
+
+from benchmarks.synthetic import populate_source_collections
+from core.chromadb_manager import ChromaDBManager
+from core.data_processor import DataProcessor
+
+
+@pytest.fixture
+def synthetic_db_manager(tmp_path) -> ChromaDBManager:
+    populate_source_collections(chromadb.PersistentClient(path=str(tmp_path)))
+    return ChromaDBManager(path=str(tmp_path))
+
+
+@pytest.fixture
+def synthetic_data_processor(synthetic_db_manager) -> DataProcessor:
+    return DataProcessor(synthetic_db_manager)
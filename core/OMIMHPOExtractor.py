@@ -1,3 +1,8 @@
+import io
+
+from core.hpoa_reader import HPOAReader
+
+
 class OMIMHPOExtractor:
     @staticmethod
     def extract_omim_hpo_mappings(data):
@@ -7,31 +12,15 @@ class OMIMHPOExtractor:
         :param data: String containing the data with OMIM and HPO information.
         :return: Dictionary with OMIM IDs as keys and lists of HPO IDs as values.
         """
-        omim_hpo_dict = {}
-        lines = data.split('\n')
-        header_skipped = False
-
-        for line in lines:
-            if not line or line.startswith('#'):
-                continue
-
-            if not header_skipped:
-                header_skipped = True
-                continue
-
-            parts = line.split('\t')
-            if len(parts) < 4:
-                continue
+        return OMIMHPOExtractor.extract_omim_hpo_mappings_from_stream(io.StringIO(data))
 
-            omim_id, disease_name, hpo_id = parts[0], parts[1], parts[3]
-
-            if omim_id in omim_hpo_dict:
-                omim_hpo_dict[omim_id].add(hpo_id)
-            else:
-                omim_hpo_dict[omim_id] = {hpo_id}
-
-        for omim in omim_hpo_dict:
-            omim_hpo_dict[omim] = list(omim_hpo_dict[omim])
-
-        return omim_hpo_dict
+    @staticmethod
+    def extract_omim_hpo_mappings_from_stream(source, databases=None):
+        """
+        Same as extract_omim_hpo_mappings but streams the hpoa line by line instead of needing it as one string.
 
+        :param source: Path to a (optionally gzipped) .hpoa file or an open text stream.
+        :param databases: Optional database prefixes to keep, e.g. ('OMIM',).
+        :return: Dictionary with disease IDs as keys and lists of unique HPO IDs as values.
+        """
+        return HPOAReader(source, databases=databases).read().disease_to_hps(unique=True)
@@ -0,0 +1,122 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from core.hpoa_reader import HPOAAnnotations
+
+"""
+    Aggregation strategies turning a set of HP embeddings into one vector. A strategy assigns a weight to every
+    hpoa annotation (0 drops it) and to every query term; the weighted averages of all diseases are then one weighted
+    sparse-dense product over the incidence matrix, see DiseaseIncidence.
+"""
+
+# default of every strategy, the same as config.yaml's aggregation section
+DEFAULT_EXCLUDE_NEGATED = False
+
+
+class AggregationStrategy(ABC):
+    name = None
+
+    def __init__(self, exclude_negated: bool = DEFAULT_EXCLUDE_NEGATED):
+        """
+        :param exclude_negated: Drop NOT qualified annotations (the disease explicitly lacks the phenotype).
+        """
+        self.exclude_negated = exclude_negated
+
+    def prepare(self, annotations: HPOAAnnotations):
+        """
+        Called once per (re)load with the whole corpus, before any weights are requested.
+        """
+        pass
+
+    def annotation_weights(self, annotations: HPOAAnnotations) -> np.ndarray:
+        """
+        :return: float32 weight per annotation, aligned with the annotation columns.
+        """
+        weights = self._annotation_weights(annotations).astype(np.float32, copy=False)
+        if self.exclude_negated:
+            weights = np.where(annotations.negated, np.float32(0), weights)
+        return weights
+
+    @abstractmethod
+    def _annotation_weights(self, annotations: HPOAAnnotations) -> np.ndarray:
+        pass
+
+    def query_weights(self, hp_ids: List[str]) -> Optional[np.ndarray]:
+        """
+        :return: Weight per query term or None for a plain mean.
+        """
+        return None
+
+    def __repr__(self):
+        return f"{type(self).__name__}(exclude_negated={self.exclude_negated})"
+
+
+class MeanAggregation(AggregationStrategy):
+    """ Unweighted mean, every annotation counts once. """
+    name = "mean"
+
+    def _annotation_weights(self, annotations: HPOAAnnotations) -> np.ndarray:
+        return np.ones(len(annotations), dtype=np.float32)
+
+
+class FrequencyWeightedAggregation(AggregationStrategy):
+    """ Weights a disease's terms by their hpoa frequency, query terms are present so they weigh 1. """
+    name = "frequency"
+
+    def __init__(self, exclude_negated: bool = DEFAULT_EXCLUDE_NEGATED, missing_frequency: float = 1.0):
+        """
+        :param missing_frequency: Weight for annotations without a frequency.
+        """
+        super().__init__(exclude_negated)
+        self.missing_frequency = missing_frequency
+
+    def _annotation_weights(self, annotations: HPOAAnnotations) -> np.ndarray:
+        frequency = annotations.frequency
+        return np.where(np.isnan(frequency), np.float32(self.missing_frequency), frequency)
+
+
+class InformationContentAggregation(AggregationStrategy):
+    """
+        Weights terms by their information content -log((n_diseases(term) + 1) / (n_diseases + 1)), computed once from
+        the annotation counts, so specific terms outweigh ones shared by many diseases. Counts are taken from the
+        direct annotations only, the ontology isn't available here to propagate them to ancestors.
+    """
+    name = "ic"
+
+    def __init__(self, exclude_negated: bool = DEFAULT_EXCLUDE_NEGATED):
+        super().__init__(exclude_negated)
+        self.ic = np.empty(0, dtype=np.float32)  # per hpoa term code
+        self.term_ic: Dict[str, float] = {}
+        self.max_ic = 0.0
+
+    def prepare(self, annotations: HPOAAnnotations):
+        present = ~annotations.negated
+        pairs = np.unique(annotations.disease[present].astype(np.int64) << 32 | annotations.hpo[present])
+        diseases_per_term = np.bincount((pairs & 0xFFFFFFFF).astype(np.int64), minlength=len(annotations.hpo_values))
+        n_diseases = len(annotations.disease_values)
+        self.ic = -np.log((diseases_per_term + 1) / (n_diseases + 1)).astype(np.float32)
+        self.term_ic = dict(zip(annotations.hpo_values, self.ic.tolist()))
+        self.max_ic = float(np.log(n_diseases + 1))  # ic of a term no disease is annotated with
+
+    def _annotation_weights(self, annotations: HPOAAnnotations) -> np.ndarray:
+        return self.ic[annotations.hpo]
+
+    def query_weights(self, hp_ids: List[str]) -> Optional[np.ndarray]:
+        return np.fromiter((self.term_ic.get(hp_id, self.max_ic) for hp_id in hp_ids), dtype=np.float32)
+
+
+AGGREGATION_STRATEGIES = {strategy.name: strategy for strategy in
+                          (MeanAggregation, FrequencyWeightedAggregation, InformationContentAggregation)}
+
+
+def create_aggregation_strategy(config: Optional[Dict] = None) -> AggregationStrategy:
+    """
+    :param config: The 'aggregation' section of config.yaml, e.g. {'strategy': 'ic', 'exclude_negated': True}.
+    """
+    config = dict(config or {})
+    name = config.pop("strategy", MeanAggregation.name)
+    if name not in AGGREGATION_STRATEGIES:
+        raise ValueError(f"Unknown aggregation strategy {name}, expected one of {list(AGGREGATION_STRATEGIES)}")
+    return AGGREGATION_STRATEGIES[name](**config)
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from core.query_service import QueryService, _init_query_worker, _query_chunk_in_worker
+from utils.instrumentation import metrics
+from utils.similarity_measures import SimilarityMeasures
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """ Raised when the request queue is full and the service was told not to wait. """
+
+
+class _Request:
+    __slots__ = ("hpo_ids", "n_results", "similarity", "future")
+
+    def __init__(self, hpo_ids: List[str], n_results: int, similarity: Optional[SimilarityMeasures],
+                 future: asyncio.Future):
+        self.hpo_ids = hpo_ids
+        self.n_results = n_results
+        self.similarity = similarity
+        self.future = future
+
+
+class AsyncQueryService:
+    """
+        asyncio front end for a shared QueryService (one ChromaDBManager client, one in memory DataProcessor).
+        Requests arriving within batch_window_ms of each other are micro batched and scored together with
+        QueryService.query_many in a bounded thread (or process) pool, so the event loop never runs the numpy work.
+    """
+
+    def __init__(self, query_service: QueryService, max_workers: int = 4, use_processes: bool = False,
+                 batch_window_ms: float = 2.0, max_batch_size: int = 256, max_pending: int = 1024,
+                 wait_when_full: bool = True, timeout: Optional[float] = None):
+        """
+        :param query_service: The shared, synchronous query service.
+        :param max_workers: Pool size, also the max number of batches scored at the same time.
+        :param use_processes: Score in a process pool (in memory backends and the default similarity only).
+        :param batch_window_ms: How long the first request of a batch waits for others to join.
+        :param max_batch_size: Max requests per batch.
+        :param max_pending: Max queued requests, beyond that callers wait (or get Overloaded).
+        :param wait_when_full: Wait for queue space instead of raising Overloaded right away.
+        :param timeout: Default per request timeout in seconds, None waits forever.
+        """
+        self.query_service = query_service
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.wait_when_full = wait_when_full
+        self.timeout = timeout
+        self.executor: Optional[Executor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._scoring = set()
+        # requests the batcher took off the queue but hasn't handed to a scoring task yet
+        self._batch: List[_Request] = []
+
+    async def __aenter__(self) -> "AsyncQueryService":
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def start(self):
+        if self._batcher is not None:
+            return
+        if self.use_processes:
+            backend = self.query_service.get_search_backend()
+            self.executor = ProcessPoolExecutor(
+                self.max_workers, initializer=_init_query_worker,
+                initargs=(self.query_service.hp_embeddings, backend, self.query_service.data_processor.aggregation))
+        else:
+            self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="query")
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._batcher = asyncio.create_task(self._batch_loop())
+
+    async def close(self):
+        if self._batcher is None:
+            return
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        if self._scoring:
+            await asyncio.gather(*self._scoring, return_exceptions=True)
+        unscored, self._batch = self._batch, []
+        while not self._queue.empty():
+            unscored.append(self._queue.get_nowait())
+        for request in unscored:
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("AsyncQueryService closed"))
+        self.executor.shutdown(wait=True)
+        self._batcher = None
+
+    async def query(self, hpo_ids: List[str], n_results: int = 10, similarity: Optional[SimilarityMeasures] = None,
+                    timeout: Optional[float] = None) -> List[Tuple[str, float]]:
+        """
+        :param hpo_ids: List of HPO term IDs.
+        :param n_results: number of results
+        :param similarity: Similarity measure, defaults to the query service's measure.
+        :param timeout: Seconds before asyncio.TimeoutError, defaults to the service timeout.
+        :return: List of (disease, distance), empty if none of the HPO terms has an embedding.
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        timeout = timeout if timeout is not None else self.timeout
+        deadline = loop.time() + timeout if timeout is not None else None
+        request = _Request(hpo_ids, n_results, similarity, loop.create_future())
+        if self.wait_when_full:
+            await asyncio.wait_for(self._queue.put(request), timeout)
+        else:
+            try:
+                self._queue.put_nowait(request)
+            except asyncio.QueueFull:
+                metrics.count("async_rejected")
+                raise Overloaded(f"{self.max_pending} requests pending")
+        remaining = deadline - loop.time() if deadline is not None else None
+        return await asyncio.wait_for(request.future, remaining)
+
+    async def _batch_loop(self):
+        while True:
+            self._batch = batch = [await self._queue.get()]
+            if self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            batch[:] = [request for request in batch if not request.future.done()]  # timed out while queued
+            if not batch:
+                continue
+            await self._slots.acquire()
+            task = asyncio.create_task(self._score(batch))
+            self._scoring.add(task)
+            task.add_done_callback(self._scoring.discard)
+            self._batch = []
+
+    async def _score(self, batch: List[_Request]):
+        loop = asyncio.get_running_loop()
+        try:
+            groups: Dict[Optional[SimilarityMeasures], List[_Request]] = {}
+            for request in batch:
+                groups.setdefault(request.similarity, []).append(request)
+            for similarity, requests in groups.items():
+                n_results = max(request.n_results for request in requests)
+                hpo_id_lists = [request.hpo_ids for request in requests]
+                metrics.observe("async_batch_size", len(requests))
+                try:
+                    if self.use_processes:
+                        if similarity not in (None, self.query_service.similarity):
+                            raise ValueError("process pool mode only scores the default similarity measure")
+                        results = await loop.run_in_executor(self.executor, _query_chunk_in_worker, hpo_id_lists,
+                                                             n_results)
+                    else:
+                        results = await loop.run_in_executor(self.executor, self.query_service.query_many,
+                                                             hpo_id_lists, n_results, similarity)
+                except Exception as e:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+                for request, ranked in zip(requests, results):
+                    if not request.future.done():
+                        request.future.set_result(ranked[:request.n_results])
+        finally:
+            self._slots.release()
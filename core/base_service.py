@@ -1,8 +1,15 @@
+import logging
 from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-from chromadb.types import Collection
-
+from core.batch_upserter import BatchUpserter
 from core.data_processor import DataProcessor
+from core.fingerprint_store import FingerprintStore
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+logger = logging.getLogger(__name__)
 
 """
     Interface for HPEmbeddingsService & DiseaseAvgEmbeddingsService
@@ -11,16 +18,76 @@ from core.data_processor import DataProcessor
 
 
 class BaseService(ABC):
-    def __init__(self, data_processor: DataProcessor):
+    def __init__(self, data_processor: DataProcessor, batch_size: Optional[int] = None,
+                 use_writer_thread: bool = False):
         # just that
         self.data_processor = data_processor
-        # put into __init__ hpService
-        self.hp_embeddings = data_processor.hp_embeddings
-        self.hp_embeddings_collection = data_processor.db_manager.hp_embeddings_collection
-        # put into init diseaseAvgService
-        self.disease_to_hps = data_processor.disease_to_hps
-        self.disease_avg_embeddings_collection = data_processor.db_manager.disease_avg_embeddings_collection
+        # upsert pipeline settings, batch_size None means the client's max batch size
+        self.batch_size = batch_size
+        self.use_writer_thread = use_writer_thread
+
+    # opened through the db manager on first use, a query only ever touches the disease collection
+    @property
+    def hp_embeddings_collection(self):
+        return self.data_processor.db_manager.hp_embeddings_collection
+
+    @property
+    def disease_avg_embeddings_collection(self):
+        return self.data_processor.db_manager.disease_avg_embeddings_collection
+
+    # read through the data processor so a reload is picked up
+    @property
+    def hp_embeddings(self):
+        return self.data_processor.hp_embeddings
+
+    @property
+    def disease_to_hps(self):
+        return self.data_processor.disease_to_hps
+
+    def create_upserter(self, collection: "Collection") -> BatchUpserter:
+        return BatchUpserter(collection, batch_size=self.batch_size,
+                             max_batch_size=self.data_processor.db_manager.get_max_batch_size(),
+                             use_writer_thread=self.use_writer_thread)
+
+    def fingerprint_store(self, collection: "Collection") -> FingerprintStore:
+        store = FingerprintStore.for_collection(getattr(self.data_processor.db_manager, "path", None),
+                                                collection.name)
+        if collection.count() == 0:
+            store.clear()  # collection was dropped or never built, stored fingerprints are meaningless
+        return store
+
+    def upsert_changed(self, collection: "Collection", ids: List[str], embeddings, metadata: Dict,
+                       fingerprints: Dict[str, str], incremental: bool = True):
+        """
+        Compares fingerprints with the ones stored next to the db, upserts only new or changed ids and deletes ids
+        that disappeared. Fingerprints are only saved once the collection is updated.
+
+        :param ids: All current ids, aligned with embeddings.
+        :param fingerprints: {id: fingerprint} for all current ids.
+        :param incremental: False upserts every id, the fingerprints are still saved so the next incremental build
+            compares against what this one wrote.
+        """
+        store = self.fingerprint_store(collection)
+        changed, removed = store.diff(fingerprints)
+        upserter = self.create_upserter(collection)
+        self.delete_removed(collection, removed, upserter.batch_size)
+        if not incremental:
+            changed = ids
+            upserter.upsert_arrays(ids, embeddings, [metadata] * len(ids))
+        elif changed:
+            changed = set(changed)
+            positions = [position for position, key in enumerate(ids) if key in changed]
+            upserter.upsert_arrays([ids[position] for position in positions], embeddings[positions],
+                                   [metadata] * len(positions))
+        logger.info(f"{collection.name}: {len(changed)} upserted, {len(removed)} deleted, "
+                    f"{len(ids) - len(changed)} unchanged")
+        store.save(fingerprints)
+
+    @staticmethod
+    def delete_removed(collection: "Collection", removed: List[str], batch_size: int):
+        for start in range(0, len(removed), batch_size):
+            collection.delete(ids=removed[start:start + batch_size])
 
     @abstractmethod
-    def process_data(self) -> Collection:
+    def process_data(self, incremental: bool = False) -> "Collection":
         pass
@@ -0,0 +1,150 @@
+import logging
+import queue
+import threading
+import time
+from itertools import islice
+from typing import TYPE_CHECKING, Callable, Iterable, List, Optional, Sequence, Tuple
+
+from utils.instrumentation import metrics
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+logger = logging.getLogger(__name__)
+
+# chroma's limit for sqlite backed clients, used when the client can't tell us
+DEFAULT_MAX_BATCH_SIZE = 5461
+
+Record = Tuple[str, Sequence[float], dict]
+
+"""
+    Streams records into a collection in chunks instead of one upsert per id. Chunks are capped by the client's
+    max batch size and can optionally be handed to a background writer thread, so computing the next chunk overlaps
+    with chroma writing the previous one.
+"""
+
+
+class UpsertStats:
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return (f"UpsertStats(rows={self.rows}, batches={self.batches}, seconds={self.seconds:.2f}, "
+                f"rows_per_second={self.rows_per_second:.0f})")
+
+
+class BatchUpserter:
+    def __init__(self, collection: "Collection", batch_size: Optional[int] = None,
+                 max_batch_size: Optional[int] = None, use_writer_thread: bool = False, queue_size: int = 2,
+                 progress_callback: Optional[Callable[[int, Optional[int]], None]] = None):
+        """
+        :param collection: The collection to upsert into.
+        :param batch_size: Rows per upsert call, defaults to (and is capped by) max_batch_size.
+        :param max_batch_size: Max rows the chroma client accepts per call.
+        :param use_writer_thread: Hand batches to a background thread that does the actual upserts.
+        :param queue_size: Number of pending batches the writer thread may lag behind.
+        :param progress_callback: Called with (rows written, total rows or None) after every batch.
+        """
+        max_batch_size = max_batch_size or DEFAULT_MAX_BATCH_SIZE
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+        self.collection = collection
+        self.batch_size = min(batch_size or max_batch_size, max_batch_size)
+        self.use_writer_thread = use_writer_thread
+        self.queue_size = queue_size
+        self.progress_callback = progress_callback
+
+    def upsert(self, records: Iterable[Record], total: Optional[int] = None) -> UpsertStats:
+        """
+        Upserts (id, embedding, metadata) records in chunks of batch_size.
+
+        :param records: Any iterable of records, consumed lazily.
+        :param total: Number of records if known, only used for progress reporting.
+        :return: UpsertStats for this run.
+        """
+        records = iter(records)
+        batches = iter(lambda: list(islice(records, self.batch_size)), [])
+        return self._run((self._split(batch) for batch in batches), total)
+
+    def upsert_arrays(self, ids: List[str], embeddings, metadatas: Optional[List[dict]] = None) -> UpsertStats:
+        """
+        Upserts already materialized columns by slicing them, no per-row tuples are built.
+
+        :param ids: List of ids.
+        :param embeddings: 2d numpy array (or list of lists) aligned with ids.
+        :param metadatas: Optional list of metadata dicts aligned with ids.
+        :return: UpsertStats for this run.
+        """
+        def batches():
+            for start in range(0, len(ids), self.batch_size):
+                end = start + self.batch_size
+                yield ids[start:end], embeddings[start:end], metadatas[start:end] if metadatas else None
+        return self._run(batches(), len(ids))
+
+    @staticmethod
+    def _split(batch: List[Record]):
+        ids, embeddings, metadatas = zip(*batch)
+        return list(ids), list(embeddings), list(metadatas)
+
+    def _run(self, batches, total: Optional[int]) -> UpsertStats:
+        stats = UpsertStats()
+        start = time.perf_counter()
+        if self.use_writer_thread:
+            self._write_in_background(batches, stats, start, total)
+        else:
+            for batch in batches:
+                self._write(batch, stats, start, total)
+        stats.seconds = time.perf_counter() - start
+        logger.info(f"Upserted {stats.rows} rows into {self.collection.name} in {stats.batches} batches "
+                    f"({stats.seconds:.2f}s, {stats.rows_per_second:.0f} rows/s)")
+        return stats
+
+    def _write(self, batch, stats: UpsertStats, start: float, total: Optional[int]):
+        ids, embeddings, metadatas = batch
+        with metrics.timer("upsert_seconds", collection=self.collection.name):
+            self.collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas)
+        metrics.count("upsert_calls", collection=self.collection.name)
+        metrics.count("upserted_rows", len(ids), collection=self.collection.name)
+        stats.rows += len(ids)
+        stats.batches += 1
+        elapsed = time.perf_counter() - start
+        logger.debug(f"{self.collection.name}: {stats.rows}/{total if total is not None else '?'} rows "
+                     f"({stats.rows / elapsed if elapsed else 0.0:.0f} rows/s)")
+        if self.progress_callback:
+            self.progress_callback(stats.rows, total)
+
+    def _write_in_background(self, batches, stats: UpsertStats, start: float, total: Optional[int]):
+        pending = queue.Queue(maxsize=self.queue_size)
+        errors = []
+        done = object()
+
+        def writer():
+            while True:
+                batch = pending.get()
+                if batch is done:
+                    return
+                if errors:
+                    continue  # drain so the producer never blocks on a dead writer
+                try:
+                    self._write(batch, stats, start, total)
+                except Exception as e:
+                    errors.append(e)
+
+        thread = threading.Thread(target=writer, name=f"upsert-{self.collection.name}", daemon=True)
+        thread.start()
+        try:
+            for batch in batches:
+                if errors:
+                    break
+                pending.put(batch)
+        finally:
+            pending.put(done)
+            thread.join()
+        if errors:
+            raise errors[0]
@@ -1,36 +1,218 @@
-
 import logging
-from typing import Optional
-import chromadb
+import os
+from typing import Dict, List, Optional, Tuple, Union
 from utils.similarity_measures import SimilarityMeasures
 from config.config_loader import load_config
 
 logger = logging.getLogger(__name__)
 
+# resolved relative to this module, not the working directory
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "config.yaml")
+
+DEFAULT_VARIANT = "default"
+
+"""
+    ChromaDBManager owns the one chroma client and a registry of variants. A variant is an (embedding model,
+    similarity measure, aggregation strategy) combination with its own named collection set: the ont_hp and hpoa
+    source collections it reads and the HPtoEmbeddings / DiseaseAvgEmbeddings collections it writes. Collections are
+    opened on first access, so variants that are never used cost nothing.
+"""
+
+
+class CollectionSet:
+    # collection role -> default name, the output collections of a non default variant get the variant as suffix
+    SOURCE_ROLES = {"ont_hp": "ont_hp", "hpoa": "hpoa"}
+    OUTPUT_ROLES = {"hp_embeddings": "HPtoEmbeddings", "disease_avg_embeddings": "DiseaseAvgEmbeddings"}
+
+    def __init__(self, manager: "ChromaDBManager", name: str, model: Optional[str] = None,
+                 similarity: SimilarityMeasures = SimilarityMeasures.COSINE,
+                 aggregation: Optional[Union[str, Dict]] = None, hpoa_path: Optional[str] = None,
+                 hpoa_databases: Optional[List[str]] = None, **collection_names: str):
+        """
+        :param manager: The manager whose client is shared.
+        :param name: Variant name.
+        :param model: Embedding model, informational and part of the variant key.
+        :param similarity: Space of the output collections and default query measure.
+        :param aggregation: Aggregation strategy name or config section, see create_aggregation_strategy.
+        :param hpoa_path: phenotype.hpoa file read instead of the hpoa collection, see DataProcessor.
+        :param hpoa_databases: Database prefixes kept from hpoa_path, e.g. ['OMIM', 'ORPHA'], None keeps all.
+        :param collection_names: Overrides for ont_hp, hpoa, hp_embeddings and disease_avg_embeddings.
+        """
+        unknown = set(collection_names) - set(self.SOURCE_ROLES) - set(self.OUTPUT_ROLES)
+        if unknown:
+            raise ValueError(f"Unknown collection roles {sorted(unknown)} for variant {name}")
+        self.manager = manager
+        self.name = name
+        self.model = model
+        self.similarity = similarity
+        self.aggregation = {"strategy": aggregation} if isinstance(aggregation, str) else aggregation
+        self.hpoa_path = hpoa_path
+        self.hpoa_databases = hpoa_databases
+        suffix = "" if name == DEFAULT_VARIANT else f"_{name}"
+        self.collection_names = {**self.SOURCE_ROLES, **{role: f"{default}{suffix}" for role, default in
+                                                          self.OUTPUT_ROLES.items()}, **collection_names}
+        self.collections = {}
+
+    @property
+    def key(self) -> Tuple[Optional[str], SimilarityMeasures, str]:
+        return self.model, self.similarity, (self.aggregation or {}).get("strategy", "mean")
+
+    # the attributes DataProcessor and the services read from a db manager
+    @property
+    def ont_hp(self):
+        return self.collection("ont_hp")
+
+    @property
+    def hpoa(self):
+        return self.collection("hpoa")
+
+    @property
+    def hp_embeddings_collection(self):
+        return self.collection("hp_embeddings")
+
+    @property
+    def disease_avg_embeddings_collection(self):
+        return self.collection("disease_avg_embeddings")
+
+    @property
+    def path(self) -> str:
+        return self.manager.path
+
+    @property
+    def config(self) -> Dict:
+        return self.manager.config
+
+    @property
+    def index_dir(self) -> str:
+        """ Where search backends persist indexes, separate per variant since they share a similarity space. """
+        return self.path if self.name == DEFAULT_VARIANT else os.path.join(self.path, "variants", self.name)
+
+    def get_max_batch_size(self) -> Optional[int]:
+        return self.manager.get_max_batch_size()
+
+    def collection(self, role: str):
+        """
+        Opens the collection of a role on first use, output collections are created if they don't exist.
+        """
+        if role not in self.collections:
+            name = self.collection_names[role]
+            collection = self.manager.get_collection(name)
+            if collection is None and role in self.OUTPUT_ROLES:
+                collection = self.manager.create_collection(name, self.similarity)
+            if collection is None:
+                return None  # not cached, the source collection may still be created
+            self.collections[role] = collection
+        return self.collections[role]
+
 
 class ChromaDBManager:
-    def __init__(self, similarity: Optional[SimilarityMeasures] = SimilarityMeasures.COSINE):
-        config = self.load_config()
-        path = config['chroma_db_path']
-        # if path is None:
-        #     config = self.load_config()
-        #     path = config['chroma_db_path']
+    def __init__(self, similarity: Optional[SimilarityMeasures] = SimilarityMeasures.COSINE,
+                 path: Optional[str] = None, config_path: Optional[str] = None):
+        """
+        :param similarity: Similarity measure of the default variant.
+        :param path: Chroma db path, read from config.yaml when None.
+        :param config_path: config.yaml to read, the one at the repository root by default. Its optional 'variants'
+            section registers variants by name, see register_variant for their settings.
+        """
+        self.config = {}
+        if path is None:
+            self.config = self.load_config(config_path)
+            path = self.config['chroma_db_path']
+        self.path = path
+        import chromadb  # deferred so importing the package (e.g. for cli --help) does not pay for chromadb
         self.client = chromadb.PersistentClient(path=path)
-        self.ont_hp = self.get_collection("ont_hp")
-        self.hpoa = self.get_collection("hpoa")
-        self.hp_embeddings_collection = self.get_collection("HPtoEmbeddings") or self.create_collection("HPtoEmbeddings", similarity)
-        self.disease_avg_embeddings_collection = self.get_collection("DiseaseAvgEmbeddings") or self.create_collection("DiseaseAvgEmbeddings", similarity)
+        self.variants: Dict[str, CollectionSet] = {}
+        self.register_variant(DEFAULT_VARIANT, similarity=similarity or SimilarityMeasures.COSINE,
+                              aggregation=self.config.get("aggregation"), hpoa_path=self.config.get("hpoa_path"),
+                              hpoa_databases=self.config.get("hpoa_databases"))
+        for name, settings in (self.config.get("variants") or {}).items():
+            self.register_variant(name, **settings)
 
     @staticmethod
-    def load_config():
-        return load_config("../config.yaml")
+    def load_config(config_path: Optional[str] = None):
+        return load_config(config_path or CONFIG_PATH)
+
+    def register_variant(self, name: str, model: Optional[str] = None,
+                         similarity: Union[SimilarityMeasures, str, None] = None,
+                         aggregation: Optional[Union[str, Dict]] = None, hpoa_path: Optional[str] = None,
+                         hpoa_databases: Optional[List[str]] = None, **collection_names: str) -> CollectionSet:
+        """
+        :param name: Variant name, used in Main.run_analysis(variant=...).
+        :param model: Embedding model the ont_hp collection of this variant was embedded with.
+        :param similarity: SimilarityMeasures or its value, cosine by default.
+        :param aggregation: Aggregation strategy name or config section, the default variant's when None. Its
+            exclude_negated defaults to the default variant's.
+        :param hpoa_path: phenotype.hpoa file read instead of the hpoa collection, the default variant's when None.
+        :param hpoa_databases: Database prefixes kept from hpoa_path, None keeps all.
+        :param collection_names: ont_hp, hpoa, hp_embeddings and disease_avg_embeddings collection names.
+        """
+        if isinstance(similarity, str):
+            similarity = SimilarityMeasures(similarity)
+        if name != DEFAULT_VARIANT:
+            default_aggregation = self.variant().aggregation or {}
+            if aggregation is None:
+                aggregation = default_aggregation
+            elif "exclude_negated" in default_aggregation:
+                # a variant that only picks a strategy keeps the configured treatment of NOT annotations
+                aggregation = {"exclude_negated": default_aggregation["exclude_negated"],
+                               **({"strategy": aggregation} if isinstance(aggregation, str) else aggregation)}
+        if hpoa_path is None and name != DEFAULT_VARIANT and "hpoa" not in collection_names:
+            hpoa_path, hpoa_databases = self.variant().hpoa_path, self.variant().hpoa_databases
+        variant = CollectionSet(self, name, model=model, similarity=similarity or SimilarityMeasures.COSINE,
+                                aggregation=aggregation, hpoa_path=hpoa_path, hpoa_databases=hpoa_databases,
+                                **collection_names)
+        self.variants[name] = variant
+        return variant
+
+    def variant(self, name: Optional[str] = None) -> CollectionSet:
+        name = name or DEFAULT_VARIANT
+        if name not in self.variants:
+            raise ValueError(f"Unknown variant {name}, expected one of {list(self.variants)}")
+        return self.variants[name]
+
+    def find_variant(self, model: Optional[str] = None, similarity: Optional[SimilarityMeasures] = None,
+                     aggregation: Optional[str] = None) -> CollectionSet:
+        """
+        :return: The first registered variant matching all given parts of the (model, similarity, aggregation) key.
+        """
+        for variant in self.variants.values():
+            variant_model, variant_similarity, variant_aggregation = variant.key
+            if (model is None or model == variant_model) and (similarity is None or similarity == variant_similarity) \
+                    and (aggregation is None or aggregation == variant_aggregation):
+                return variant
+        raise ValueError(f"No variant for model={model}, similarity={similarity}, aggregation={aggregation}")
+
+    # the default variant's collections, opened on first access
+    @property
+    def ont_hp(self):
+        return self.variant().ont_hp
+
+    @property
+    def hpoa(self):
+        return self.variant().hpoa
+
+    @property
+    def hp_embeddings_collection(self):
+        return self.variant().hp_embeddings_collection
+
+    @property
+    def disease_avg_embeddings_collection(self):
+        return self.variant().disease_avg_embeddings_collection
+
+    @property
+    def index_dir(self) -> str:
+        return self.path
 
     def create_collection(self, name: str, similarity: Optional[SimilarityMeasures] = SimilarityMeasures.COSINE):
         try:
             similarity_str_value = similarity.value if similarity else SimilarityMeasures.COSINE.value
             collection = self.client.create_collection(name=name, metadata={"hnsw:space": similarity_str_value})
             return collection
-        except chromadb.db.base.UniqueConstraintError:
+        except Exception:
+            # the duplicate name error moved between chroma versions (UniqueConstraintError, InternalError), so check
+            # for the collection instead of importing a version specific exception
+            if self.get_collection(name) is None:
+                raise
             logger.info(f"Collection {name} already exists")
             return None
 
@@ -41,5 +223,12 @@ class ChromaDBManager:
             logger.info(f"Error getting collection {name}: {str(e)}")
             return None
 
+    def get_max_batch_size(self) -> Optional[int]:
+        try:
+            return self.client.get_max_batch_size()
+        except Exception as e:
+            logger.info(f"Error getting max batch size: {str(e)}")
+            return None
+
     def list_collections(self):
-        return self.client.list_collections()
\ No newline at end of file
+        return self.client.list_collections()
@@ -0,0 +1,152 @@
+"""
+Command line entry point for one-shot queries and builds:
+
+    python -m core.cli query HP:0001250 HP:0004322 --top 10
+    python -m core.cli build --incremental
+    python -m core.cli export disease_averages/
+    python -m core.cli import disease_averages/ --replace
+
+Only argparse is imported up front, numpy, chromadb and the services are imported when a command runs. A query
+never creates the upsert services and only opens DiseaseAvgEmbeddings with the chroma backend. Queries load the hp
+matrix and annotations from the snapshot next to the db when one is current (and write it otherwise), so repeated
+invocations skip the collection scan. The cold start (imports, load, query) is reported on stderr.
+"""
+import argparse
+import json
+import sys
+import time
+
+
+def create_main(args, use_snapshot: bool):
+    from core.main import Main
+    from utils.similarity_measures import SimilarityMeasures
+    return Main(similarity_measure=SimilarityMeasures(args.similarity), search_backend=args.backend,
+                use_snapshot=use_snapshot, storage=args.storage, query_cache_size=0, config_path=args.config,
+                hpoa_path=args.hpoa_path,
+                hpoa_databases=args.hpoa_databases.split(",") if args.hpoa_databases else None)
+
+
+def run_query(args) -> int:
+    started = time.perf_counter()
+    main = create_main(args, use_snapshot=not args.no_snapshot)
+    imported = time.perf_counter()
+    query_service = main.get_query_service(args.variant)
+    if args.strategy:
+        query_service.data_processor.disease_average_embeddings()
+    else:
+        backend = query_service.get_search_backend()
+        if backend.name == "chroma" and backend.collection.count() == 0:
+            print(f"{backend.collection.name} is empty, run 'hpdisease build' first.", file=sys.stderr)
+            return 1
+    loaded = time.perf_counter()
+    if args.strategy:
+        results = query_service.query_with_similarity_strategy(args.hpo_ids, args.top, args.strategy)
+    else:
+        results = query_service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(args.hpo_ids, args.top)
+    queried = time.perf_counter()
+    if isinstance(results, str) or not results:
+        print("No valid embeddings found for provided HPO terms.", file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps([{"disease": disease, "distance": distance} for disease, distance in results]))
+    else:
+        for disease, distance in results:
+            print(f"{disease}\t{distance:.6f}")
+    report_timings(args, [("imports and db", imported - started), ("load", loaded - imported),
+                          ("query", queried - loaded)])
+    return 0
+
+
+def run_build(args) -> int:
+    started = time.perf_counter()
+    main = create_main(args, use_snapshot=args.snapshot)
+    main.setup_collections(incremental=args.incremental, n_shards=args.shards, n_processes=args.processes,
+                           variant=args.variant)
+    report_timings(args, [("build", time.perf_counter() - started)])
+    return 0
+
+
+def run_export(args) -> int:
+    started = time.perf_counter()
+    main = create_main(args, use_snapshot=args.snapshot)
+    main.export_disease_averages(args.path, from_collection=args.from_collection, storage=args.storage,
+                                 variant=args.variant)
+    report_timings(args, [("export", time.perf_counter() - started)])
+    return 0
+
+
+def run_import(args) -> int:
+    started = time.perf_counter()
+    main = create_main(args, use_snapshot=args.snapshot)
+    main.import_disease_averages(args.path, replace=args.replace, variant=args.variant)
+    report_timings(args, [("import", time.perf_counter() - started)])
+    return 0
+
+
+def report_timings(args, timings):
+    if args.quiet:
+        return
+    total = time.perf_counter() - args.started
+    print("cold start: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings) + f", total {total:.3f}s",
+          file=sys.stderr)
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="hpdisease", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", help="config.yaml to read, the one at the repository root by default")
+    parser.add_argument("--variant", help="registry variant from config.yaml, the default variant if omitted")
+    parser.add_argument("--similarity", default="cosine", choices=("cosine", "l2", "ip"),
+                        help="similarity measure of the default variant")
+    parser.add_argument("--storage", default="float32", choices=("float32", "float16", "int8"),
+                        help="in memory storage of the hp and disease matrices")
+    parser.add_argument("--backend", default="numpy", choices=("numpy", "hnsw", "chroma"), help="search backend")
+    parser.add_argument("--hpoa-path", help="read disease annotations from this (optionally gzipped) phenotype.hpoa "
+                                            "instead of the hpoa collection")
+    parser.add_argument("--hpoa-databases", metavar="DB[,DB...]",
+                        help="database prefixes to keep from --hpoa-path, e.g. OMIM,ORPHA, all by default")
+    parser.add_argument("--quiet", action="store_true", help="don't report timings on stderr")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    query = commands.add_parser("query", help="rank diseases for one set of HPO terms")
+    query.add_argument("hpo_ids", nargs="+", metavar="HPO_ID")
+    query.add_argument("--top", type=int, default=10, help="number of diseases to return")
+    query.add_argument("--strategy", choices=("cosine", "l2", "ip", "bma"),
+                       help="rank in process with this similarity strategy instead of the search backend")
+    query.add_argument("--no-snapshot", action="store_true", help="read the collections even if a snapshot exists")
+    query.add_argument("--json", action="store_true", help="print the results as json")
+    query.set_defaults(run=run_query)
+
+    build = commands.add_parser("build", help="(re)build the HPtoEmbeddings and DiseaseAvgEmbeddings collections")
+    build_mode = build.add_mutually_exclusive_group()
+    build_mode.add_argument("--incremental", action="store_true",
+                            help="only write what changed since the last build")
+    build_mode.add_argument("--shards", type=int, help="resumable, sharded build of all disease averages")
+    build.add_argument("--processes", type=int, help="processes for the sharded build")
+    build.add_argument("--snapshot", action="store_true", help="refresh the startup snapshot while building")
+    build.set_defaults(run=run_build)
+
+    export = commands.add_parser("export", help="write the disease averages to an archive directory")
+    export.add_argument("path")
+    export.add_argument("--from-collection", action="store_true",
+                        help="page the averages out of DiseaseAvgEmbeddings instead of computing them")
+    export.add_argument("--snapshot", action="store_true", help="load the hp embeddings from the snapshot")
+    export.set_defaults(run=run_export)
+
+    import_ = commands.add_parser("import", help="bulk load an archive into a fresh DiseaseAvgEmbeddings collection")
+    import_.add_argument("path")
+    import_.add_argument("--replace", action="store_true", help="drop a non empty collection first")
+    import_.add_argument("--snapshot", action="store_true", help="load the hp embeddings from the snapshot")
+    import_.set_defaults(run=run_import)
+    return parser
+
+
+def main(argv=None) -> int:
+    started = time.perf_counter()
+    args = create_parser().parse_args(argv)
+    args.started = started
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
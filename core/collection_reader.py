@@ -0,0 +1,143 @@
+import json
+import re
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from core.embedding_matrix import HPEmbeddings
+from utils.instrumentation import metrics
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+try:
+    import orjson
+except ImportError:  # optional, a faster decoder for the '_json' blobs that do need a full parse
+    orjson = None
+
+"""
+    Paginated reads of the curate-gpt source collections. Records are fetched page by page with limit/offset and only
+    the requested include fields, the few '_json' metadata fields we need are pulled out with a regex instead of
+    decoding every blob, and embeddings are copied straight into a preallocated float32 matrix. Peak memory is the
+    final matrix plus one page, not the whole collection payload.
+"""
+
+# records per collection.get call, small enough that one page of metadata and embeddings stays a few MB
+DEFAULT_PAGE_SIZE = 5000
+
+loads = orjson.loads if orjson is not None else json.loads
+
+# field -> pattern for its plain string value, escaped characters are left to the json fallback
+_patterns: Dict[str, "re.Pattern"] = {}
+
+
+class CollectionReader:
+    def __init__(self, collection: "Collection", page_size: int = DEFAULT_PAGE_SIZE):
+        """
+        :param collection: The chroma collection to read.
+        :param page_size: Records per collection.get call.
+        """
+        if page_size < 1:
+            raise ValueError("page_size must be a positive integer")
+        self.collection = collection
+        self.page_size = page_size
+
+    @property
+    def name(self) -> str:
+        return self.collection.name
+
+    def pages(self, include: Sequence[str]) -> Iterator[Dict]:
+        """
+        :param include: Fields to fetch, e.g. ['metadatas'] or ['metadatas', 'embeddings'].
+        :return: collection.get results, one page at a time in storage order.
+        """
+        offset = 0
+        while True:
+            with metrics.timer("fetch_seconds", collection=self.name):
+                page = self.collection.get(limit=self.page_size, offset=offset, include=list(include))
+            ids = page.get("ids") or []
+            if not ids:
+                return
+            count_fetched(page, self.name)
+            yield page
+            if len(ids) < self.page_size:
+                return
+            offset += len(ids)
+
+    def metadata_fields(self, fields: Sequence[str]) -> Iterator[Tuple[Optional[str], ...]]:
+        """
+        Streams the given fields of every record's '_json' metadata. Plain string values are cut out of the blob,
+        only records where a field is missing, not a string or escaped get a full json decode.
+
+        :return: One tuple of values (None when absent) per record.
+        """
+        for page in self.pages(["metadatas"]):
+            with metrics.timer("parse_seconds", collection=self.name):
+                values = [extract_fields(metadata.get("_json", ""), fields) for metadata in page["metadatas"]]
+            yield from values
+
+    def read_hp_embeddings(self, id_field: str = "original_id") -> HPEmbeddings:
+        """
+        Streams ids and embeddings into one preallocated matrix, same semantics as HPEmbeddings.from_records: records
+        without an id are dropped and for duplicate ids the last embedding wins.
+
+        :param id_field: '_json' field holding the HPO id.
+        :return: HPEmbeddings over a C contiguous float32 matrix.
+        """
+        index: Dict[str, int] = {}
+        matrix = None
+        capacity = self.collection.count()
+        for page in self.pages(["metadatas", "embeddings"]):
+            with metrics.timer("parse_seconds", collection=self.name):
+                embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+                if matrix is None:
+                    matrix = np.empty((max(capacity, len(embeddings)), embeddings.shape[1]), dtype=np.float32)
+                rows, positions = [], []
+                for position, metadata in enumerate(page["metadatas"]):
+                    hp_id = extract_fields(metadata.get("_json", ""), (id_field,))[0]
+                    if not hp_id:
+                        continue
+                    row = index.get(hp_id)
+                    if row is None:
+                        row = index[hp_id] = len(index)
+                    rows.append(row)
+                    positions.append(position)
+                if rows and len(index) > len(matrix):  # the collection grew while reading
+                    matrix = np.concatenate([matrix, np.empty((len(index) - len(matrix) + self.page_size,
+                                                               matrix.shape[1]), dtype=np.float32)])
+                # fancy assignment in order, so a duplicate id within the page also keeps its last embedding
+                matrix[rows] = embeddings[positions]
+        if matrix is None or not index:
+            return HPEmbeddings(index, np.empty((0, 0), dtype=np.float32))
+        if len(index) < len(matrix):
+            matrix = matrix[:len(index)].copy()
+        return HPEmbeddings(index, matrix)
+
+
+def extract_fields(blob: str, fields: Sequence[str]) -> Tuple[Optional[str], ...]:
+    """
+    :param blob: A '_json' metadata string.
+    :param fields: Top level fields to read.
+    :return: Their values, None for absent fields.
+    """
+    values: List[Optional[str]] = []
+    for field in fields:
+        pattern = _patterns.get(field)
+        if pattern is None:
+            pattern = _patterns[field] = re.compile(r'"%s"\s*:\s*"([^"\\]*)"' % re.escape(field))
+        found = pattern.search(blob)
+        if found is None:
+            break
+        values.append(found.group(1))
+    else:
+        return tuple(values)
+    record = loads(blob) if blob else {}
+    return tuple(record.get(field) for field in fields)
+
+
+def count_fetched(results: Dict, collection_name: str):
+    metrics.count("fetched_rows", len(results.get("ids") or []), collection=collection_name)
+    if metrics.enabled:  # summing the metadata sizes is only worth it when someone looks
+        metrics.count("fetched_metadata_bytes", sum(len(metadata.get("_json", ""))
+                                                    for metadata in results.get("metadatas") or []),
+                      collection=collection_name)
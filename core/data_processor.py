@@ -1,11 +1,24 @@
-import json
-from typing import Dict
+import hashlib
+import logging
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
-from chromadb.types import Collection
-from core.chromadb_manager import ChromaDBManager
 import numpy as np
 
 from core.OMIMHPOExtractor import OMIMHPOExtractor
+from core.aggregation import AggregationStrategy, MeanAggregation
+from core.collection_reader import DEFAULT_PAGE_SIZE, CollectionReader
+from core.embedding_matrix import DiseaseIncidence, HPEmbeddings
+from core.hpoa_reader import HPOAAnnotations, HPOAReader
+from core.quantization import STORAGE_TYPES, QuantizedMatrix
+from core.snapshot_cache import SnapshotCache
+from utils.instrumentation import metrics
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+    from core.chromadb_manager import ChromaDBManager
+
+logger = logging.getLogger(__name__)
 
 """
     This class main function is to create cached dictionaries from the ont_hp and hpoa collection given by the 
@@ -14,65 +27,145 @@ from core.OMIMHPOExtractor import OMIMHPOExtractor
 
 
 class DataProcessor:
-    def __init__(self, db_manager: ChromaDBManager):
+    def __init__(self, db_manager: "ChromaDBManager", snapshot_cache: Optional[SnapshotCache] = None,
+                 hpoa_path: Optional[str] = None, hpoa_databases: Optional[List[str]] = None,
+                 aggregation: Optional[AggregationStrategy] = None, storage: str = "float32"):
+        """
+        :param hpoa_path: Read disease -> hps straight from an upstream (optionally gzipped) phenotype.hpoa instead
+            of the hpoa collection.
+        :param hpoa_databases: Database prefixes to keep from hpoa_path, e.g. ['OMIM', 'ORPHA'], None keeps all.
+        :param aggregation: How hp embeddings are combined into disease and query vectors, plain mean by default.
+        :param storage: How the hp matrix is kept in memory and in the snapshot: 'float32', 'float16' or 'int8'.
+        """
         self.db_manager = db_manager
-        self.hp_embeddings = self.init_hp_embeddings()
-        self.disease_to_hps = self.init_disease_to_hps()
+        self.snapshot_cache = snapshot_cache
+        self.hpoa_path = hpoa_path
+        self.hpoa_databases = hpoa_databases
+        self.aggregation = aggregation or MeanAggregation()
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage {storage}, expected one of {STORAGE_TYPES}")
+        self.storage = storage
+        # bumped on every (re)load, lets dependants notice that their derived state is stale
+        self.generation = 0
+        self.load()
 
-    def init_hp_embeddings(self) -> Dict:
+    def load(self):
+        """
+        (Re)loads the hp embeddings and hpoa annotations, from the snapshot cache if it has a current snapshot,
+        otherwise from the ont_hp and hpoa collections (and then writes the snapshot).
+        """
+        self._disease_averages = None
+        snapshot, key = None, None
+        if self.snapshot_cache:
+            with metrics.timer("load_seconds", stage="snapshot"):
+                key = self.snapshot_cache.key_for(self.db_manager.ont_hp, self.db_manager.hpoa, self.hpoa_path,
+                                                  self.hpoa_databases, storage=self.storage,
+                                                  db_path=getattr(self.db_manager, "path", None))
+                snapshot = self.snapshot_cache.load(key)
+        if snapshot:
+            self.hp_embeddings, self.annotations = snapshot
+            self.hp_embeddings.matrix = QuantizedMatrix.quantize(self.hp_embeddings.matrix, self.storage)
+        else:
+            with metrics.timer("load_seconds", stage="collections"):
+                self.hp_embeddings = self.init_hp_embeddings()
+                self.hp_embeddings.matrix = QuantizedMatrix.quantize(self.hp_embeddings.matrix, self.storage)
+                self.annotations = self.init_annotations()
+            if self.snapshot_cache:
+                try:
+                    self.snapshot_cache.save(key, self.hp_embeddings, self.annotations)
+                except OSError as e:
+                    # e.g. a read only db directory, queries still work from the collections
+                    logger.warning(f"Could not write snapshot {self.snapshot_cache.path_for(key)}: {e}")
+        with metrics.timer("load_seconds", stage="incidence"):
+            self.disease_to_hps = self.annotations.disease_to_hps()
+            self.disease_incidence = self.init_disease_incidence()
+        metrics.count("hp_embedding_bytes", self.hp_matrix.nbytes)
+        self.generation += 1
+
+    def init_hp_embeddings(self) -> HPEmbeddings:
         return self.create_hpo_id_to_embedding(self.db_manager.ont_hp)
 
+    def init_annotations(self) -> HPOAAnnotations:
+        if self.hpoa_path:
+            return HPOAReader(self.hpoa_path, databases=self.hpoa_databases).read()
+        return self.create_hpoa_annotations(self.db_manager.hpoa)
+
     def init_disease_to_hps(self) -> Dict:
-        return self.create_disease_to_hps_dict(self.db_manager.hpoa)
+        return self.init_annotations().disease_to_hps()
+
+    def init_disease_incidence(self) -> DiseaseIncidence:
+        """
+        Weighted incidence matrix of all diseases, one weight per annotation from the aggregation strategy.
+        """
+        self._disease_averages = None
+        self.aggregation.prepare(self.annotations)
+        return DiseaseIncidence.from_annotations(self.annotations, self.hp_index,
+                                                 self.aggregation.annotation_weights(self.annotations))
+
+    @property
+    def hp_matrix(self) -> Union[np.ndarray, QuantizedMatrix]:
+        return self.hp_embeddings.matrix
+
+    @property
+    def hp_index(self) -> Dict[str, int]:
+        return self.hp_embeddings.index
 
     @staticmethod
-    def create_hpo_id_to_embedding(collection: Collection) -> Dict:
+    def create_hpo_id_to_embedding(collection: "Collection", page_size: int = DEFAULT_PAGE_SIZE) -> HPEmbeddings:
         """
-        Create a dictionary mapping HPO IDs to embeddings.
+        Create the HP embedding matrix and its HPO ID -> row index, streamed page by page into a preallocated matrix.
 
         :param collection: The collection to process
-        :return: A dictionary mapping HPO IDs to a dictionary of their label and embeddings.
-        """
-        hpo_id_to_data = {}
-        results = collection.get(include=["metadatas", "embeddings"])
-        for metadata, embedding in zip(results.get("metadatas", []), results.get("embeddings", [])):
-            metadata_json = json.loads(metadata['_json'])
-            hpo_id = metadata_json.get("original_id")
-            if hpo_id:
-                hpo_id_to_data[hpo_id] = {"embeddings": embedding}  # #{'HP:0005872': [1,2,3, ...]}
-        return hpo_id_to_data
-
-    # to be faster
-    # results = collection.get(include=["metadatas", "embeddings"])
-    # metadatas = results.get("metadatas", [])
-    # embeddings = results.get("embeddings", [])
-    # hpo_id_to_data = {
-    #     json.loads(metadata['_json']).get("original_id"): {"embeddings": embedding}
-    #     for metadata, embedding in zip(metadatas, embeddings)
-    #     if json.loads(metadata['_json']).get("original_id")
-    # }
+        :param page_size: Records fetched per collection.get call.
+        :return: HPEmbeddings, a mapping of HPO IDs to {'embeddings': row} backed by one float32 matrix.
+        """
+        return CollectionReader(collection, page_size).read_hp_embeddings()
 
     @staticmethod
-    def create_disease_to_hps_dict(collection: Collection) -> Dict:
+    def create_disease_to_hps_dict(collection: "Collection", page_size: int = DEFAULT_PAGE_SIZE) -> Dict:
         """
         Creates a dictionary mapping diseases (OMIM IDs) to their associated HPO IDs.
 
         :param collection: The collection to process
+        :param page_size: Records fetched per collection.get call.
         :return: Dictionary with diseases as keys and lists of corresponding HPO IDs as values.
         """
         disease_to_hps_dict = {}
-        results = collection.get(where={}, include=["metadatas"])
-        for item in results.get("metadatas"):
-            metadata_json = json.loads(item["_json"])
-            disease = metadata_json.get("disease")
-            phenotype = metadata_json.get('phenotype')
+        for disease, phenotype in CollectionReader(collection, page_size).metadata_fields(("disease", "phenotype")):
             if disease and phenotype:
-                if disease not in disease_to_hps_dict:
-                    disease_to_hps_dict[disease] = [phenotype]
-                else:
-                    disease_to_hps_dict[disease].append(phenotype)
+                disease_to_hps_dict.setdefault(disease, []).append(phenotype)
         return disease_to_hps_dict
 
+    @staticmethod
+    def create_hpoa_annotations(collection: "Collection", page_size: int = DEFAULT_PAGE_SIZE) -> HPOAAnnotations:
+        """
+        Reads the hpoa collection into the same columnar annotations HPOAReader builds from a file, keeping the
+        qualifier, frequency, onset and aspect of every annotation.
+
+        :param collection: The hpoa collection
+        :param page_size: Records fetched per collection.get call.
+        :return: HPOAAnnotations with one entry per record that has a disease and a phenotype.
+        """
+        columns = ("disease", "disease_label", "qualifier", "phenotype", "reference", "evidence", "onset",
+                   "frequency", "sex", "modifier", "aspect")
+        disease, phenotype = columns.index("disease"), columns.index("phenotype")
+        rows = ([str(value or "") for value in record]
+                for record in CollectionReader(collection, page_size).metadata_fields(columns)
+                if record[disease] and record[phenotype])
+        return HPOAAnnotations.from_rows(rows)
+
+    @staticmethod
+    def create_disease_to_hps_dict_from_file(file_path: str, databases: Optional[List[str]] = None) -> Dict:
+        """
+        Streams an hpoa file into the same mapping create_disease_to_hps_dict builds from the hpoa collection (one
+        entry per annotation line).
+
+        :param file_path: Path to a (optionally gzipped) .hpoa file.
+        :param databases: Database prefixes to keep, None keeps all.
+        :return: Dictionary with diseases as keys and lists of corresponding HPO IDs as values.
+        """
+        return HPOAReader(file_path, databases=databases).read().disease_to_hps()
+
     @staticmethod
     def calculate_average_embedding(hps: list, embeddings_dict: Dict) -> np.ndarray:
         """
@@ -82,12 +175,66 @@ class DataProcessor:
         :param embeddings_dict: Dictionary mapping HPO IDs to their embeddings.
         :return: A numpy array representing the average embedding for the HPO IDs.
         """
+        if isinstance(embeddings_dict, HPEmbeddings):
+            average = embeddings_dict.average(hps)
+            return average if average is not None else []
         embeddings = [embeddings_dict[hp_id]['embeddings'] for hp_id in hps if hp_id in embeddings_dict]
         return np.mean(embeddings, axis=0) if embeddings else []
 
+    def average_embedding(self, hps: List[str]) -> Optional[np.ndarray]:
+        """
+        Average embedding of a query's HPO IDs, looked up through the matrix index and weighted like the diseases.
+
+        :param hps: List of HPO IDs, unknown ones are ignored.
+        :return: float32 vector or None if none of the HPO IDs has an embedding.
+        """
+        return self.hp_embeddings.average(hps, self.aggregation)
+
+    def disease_average_embeddings(self, cache: bool = True) -> Tuple[List[str], np.ndarray]:
+        """
+        Average embeddings of all diseases in one sparse-dense product over the incidence matrix, computed once.
+
+        :param cache: False hands the matrix over to a caller that keeps its own copy (e.g. a search backend's
+            compact codes), the processor then doesn't hold on to it.
+        :return: Disease IDs and the aligned (n_diseases, dim) float32 matrix.
+        """
+        averages = self._disease_averages
+        if averages is None:
+            with metrics.timer("aggregate_seconds"):
+                averages = self.disease_incidence.means(self.hp_matrix)
+            metrics.count("aggregated_rows", len(self.disease_incidence.indices))
+        self._disease_averages = averages if cache else None
+        return self.disease_incidence.disease_ids, averages
+
+    def hp_fingerprints(self) -> Dict[str, str]:
+        """
+        :return: {HPO ID: hash of its embedding bytes}, aligned with hp_embeddings.ids.
+        """
+        matrix = self.hp_matrix
+        return {hp_id: hashlib.blake2b(matrix[row].tobytes(), digest_size=8).hexdigest()
+                for hp_id, row in self.hp_index.items()}
+
+    def disease_fingerprints(self) -> Dict[str, str]:
+        """
+        A disease's fingerprint covers its (embedded) HPO IDs with multiplicity, their weights and their embedding
+        hashes, so it changes whenever its average would.
+
+        :return: {disease: fingerprint}, aligned with disease_incidence.disease_ids.
+        """
+        hp_ids = self.hp_embeddings.ids
+        hp_fingerprints = self.hp_fingerprints()
+        incidence = self.disease_incidence
+        weights = incidence.weights if incidence.weights is not None else np.ones(len(incidence.indices))
+        fingerprints = {}
+        for position, disease in enumerate(incidence.disease_ids):
+            lo, hi = incidence.indptr[position], incidence.indptr[position + 1]
+            terms = sorted(f"{hp_ids[row]}:{hp_fingerprints[hp_ids[row]]}:{weight:.6g}"
+                           for row, weight in zip(incidence.indices[lo:hi].tolist(), weights[lo:hi].tolist()))
+            fingerprints[disease] = hashlib.blake2b("\n".join(terms).encode(), digest_size=8).hexdigest()
+        return fingerprints
+
     # deprecated cause using hpoa collection instead of .hpoa file now
     @staticmethod
     def extract_and_use_omim_hpo_mappings(file_path):
-        with open(file_path, 'r') as file:
-            data = file.read()
-        return OMIMHPOExtractor.extract_omim_hpo_mappings(data)
+        return OMIMHPOExtractor.extract_omim_hpo_mappings_from_stream(file_path)
+
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
+
+import numpy as np
+
+from core.batch_upserter import BatchUpserter
+from core.collection_reader import DEFAULT_PAGE_SIZE, CollectionReader
+from core.fingerprint_store import FingerprintStore
+from core.quantization import STORAGE_TYPES, QuantizedMatrix, load_matrix, storage_of
+from core.search_backends import SearchBackend, create_search_backend
+from core.sharded_build import ShardCheckpoint
+from utils.atomic_directory import atomic_directory
+from utils.similarity_measures import SimilarityMeasures
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+    from core.chromadb_manager import ChromaDBManager
+    from core.data_processor import DataProcessor
+
+logger = logging.getLogger(__name__)
+
+# bump whenever the on disk layout changes, older archives are then rejected
+ARCHIVE_VERSION = 1
+
+"""
+    Columnar export of the disease average embeddings, so a build can be shipped to serving nodes instead of being
+    redone there. An archive is a directory with the embedding matrix (.npy, float32 or a compact storage), the hp
+    count per disease (.npy) and a manifest.json holding the disease ids, the dimension, build metadata and a
+    blake2b checksum per array file. Loading verifies the checksums and shapes and memory maps the arrays, importing
+    bulk loads them into a fresh collection in max batch sized chunks or straight into an in memory search backend.
+"""
+
+
+class DiseaseAverageArchive:
+    def __init__(self, disease_ids: List[str], embeddings: Union[np.ndarray, QuantizedMatrix], hp_counts: np.ndarray,
+                 metadata: Optional[Dict] = None):
+        """
+        :param disease_ids: Disease IDs aligned with embeddings and hp_counts.
+        :param embeddings: (n_diseases, dim) disease averages.
+        :param hp_counts: Embedded HP annotations per disease, -1 where unknown (exports of a bare collection).
+        :param metadata: Build metadata kept in the manifest, e.g. model, similarity and aggregation.
+        """
+        if len(disease_ids) != len(embeddings) or len(disease_ids) != len(hp_counts):
+            raise ValueError(f"{len(disease_ids)} disease ids, {len(embeddings)} embeddings and {len(hp_counts)} "
+                             "hp counts are not aligned")
+        self.disease_ids = disease_ids
+        self.embeddings = embeddings
+        self.hp_counts = hp_counts
+        self.metadata = metadata or {}
+        self.storage = storage_of(embeddings)
+
+    def __len__(self) -> int:
+        return len(self.disease_ids)
+
+    @property
+    def dim(self) -> int:
+        return self.embeddings.shape[1] if len(self.embeddings.shape) == 2 else 0
+
+    @classmethod
+    def from_data_processor(cls, data_processor: "DataProcessor",
+                            metadata: Optional[Dict] = None) -> "DiseaseAverageArchive":
+        """ The averages the data processor computes, with the hp counts of its incidence matrix. """
+        disease_ids, embeddings = data_processor.disease_average_embeddings()
+        return cls(list(disease_ids), embeddings, data_processor.disease_incidence.counts.astype(np.int32),
+                   {"aggregation": data_processor.aggregation.name, **(metadata or {})})
+
+    @classmethod
+    def from_collection(cls, collection: "Collection", hp_counts: Optional[Dict[str, int]] = None,
+                        metadata: Optional[Dict] = None,
+                        page_size: int = DEFAULT_PAGE_SIZE) -> "DiseaseAverageArchive":
+        """
+        Pages the ids and embeddings of a DiseaseAvgEmbeddings collection into one preallocated matrix.
+
+        :param hp_counts: Optional {disease: hp count}, diseases without one get -1.
+        """
+        disease_ids, matrix = [], None
+        for page in CollectionReader(collection, page_size).pages(["embeddings"]):
+            embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+            if matrix is None:
+                matrix = np.empty((max(collection.count(), len(embeddings)), embeddings.shape[1]), dtype=np.float32)
+            if len(disease_ids) + len(embeddings) > len(matrix):  # the collection grew while reading
+                matrix = np.concatenate([matrix, np.empty((len(embeddings), matrix.shape[1]), dtype=np.float32)])
+            matrix[len(disease_ids):len(disease_ids) + len(embeddings)] = embeddings
+            disease_ids.extend(page["ids"])
+        matrix = matrix[:len(disease_ids)] if matrix is not None else np.empty((0, 0), dtype=np.float32)
+        counts = np.fromiter(((hp_counts or {}).get(disease, -1) for disease in disease_ids), dtype=np.int32,
+                             count=len(disease_ids))
+        return cls(disease_ids, np.ascontiguousarray(matrix), counts,
+                   {"collection": collection.name, "similarity": (collection.metadata or {}).get("hnsw:space"),
+                    **(metadata or {})})
+
+    def save(self, path: str, storage: str = "float32") -> str:
+        """
+        Writes the archive to the directory path, replacing an older one, see atomic_directory.
+
+        :param storage: 'float32', 'float16' or 'int8' for the embedding matrix.
+        :return: path
+        """
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage {storage}, expected one of {STORAGE_TYPES}")
+        with atomic_directory(path) as tmp_path:
+            embeddings = QuantizedMatrix.quantize(self.embeddings, storage)
+            if isinstance(embeddings, QuantizedMatrix):
+                embeddings.save(tmp_path, "embeddings")
+            else:
+                np.save(os.path.join(tmp_path, "embeddings.npy"), np.ascontiguousarray(embeddings))
+            np.save(os.path.join(tmp_path, "hp_counts.npy"), np.asarray(self.hp_counts, dtype=np.int32))
+            files = sorted(name for name in os.listdir(tmp_path) if name.endswith(".npy"))
+            with open(os.path.join(tmp_path, "manifest.json"), "w") as file:
+                json.dump({"version": ARCHIVE_VERSION, "count": len(self), "dim": self.dim, "storage": storage,
+                           "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                           "metadata": self.metadata, "disease_ids": list(self.disease_ids),
+                           "checksums": {name: file_checksum(os.path.join(tmp_path, name)) for name in files}},
+                          file)
+        logger.info(f"Exported {len(self)} disease averages to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, verify: bool = True,
+             expected_dim: Optional[int] = None) -> "DiseaseAverageArchive":
+        """
+        :param verify: Compare the checksums of the array files with the manifest.
+        :param expected_dim: Reject archives of another embedding dimension, e.g. the hp matrix's.
+        :raises ValueError: If the archive is of another version, corrupt or of the wrong dimension.
+        """
+        with open(os.path.join(path, "manifest.json"), "r") as file:
+            manifest = json.load(file)
+        if manifest.get("version") != ARCHIVE_VERSION:
+            raise ValueError(f"{path} is a version {manifest.get('version')} archive, expected {ARCHIVE_VERSION}")
+        if verify:
+            for name, checksum in manifest["checksums"].items():
+                if file_checksum(os.path.join(path, name)) != checksum:
+                    raise ValueError(f"Checksum mismatch for {name} in {path}")
+        if expected_dim is not None and manifest["dim"] != expected_dim:
+            raise ValueError(f"{path} holds {manifest['dim']} dimensional embeddings, expected {expected_dim}")
+        embeddings = load_matrix(path, "embeddings", mmap=mmap)
+        hp_counts = np.load(os.path.join(path, "hp_counts.npy"), mmap_mode="r" if mmap else None)
+        if manifest["count"] and tuple(embeddings.shape) != (manifest["count"], manifest["dim"]):
+            raise ValueError(f"{path} embeddings have shape {tuple(embeddings.shape)}, the manifest says "
+                             f"({manifest['count']}, {manifest['dim']})")
+        return cls(manifest["disease_ids"], embeddings, hp_counts, manifest.get("metadata"))
+
+    def to_collection(self, db_manager: "ChromaDBManager", name: str,
+                      similarity: Optional[SimilarityMeasures] = None, replace: bool = False,
+                      batch_size: Optional[int] = None, use_writer_thread: bool = False) -> "Collection":
+        """
+        Bulk loads the archive into a fresh collection, in chunks of the client's max batch size.
+
+        :param db_manager: Manager of the target client.
+        :param name: Collection name, e.g. DiseaseAvgEmbeddings.
+        :param similarity: Space of the new collection, the archive's by default (cosine if it has none).
+        :param replace: Drop an existing non empty collection first, otherwise that is an error.
+        """
+        existing = db_manager.get_collection(name)
+        if existing is not None:
+            if existing.count() and not replace:
+                raise ValueError(f"Collection {name} already holds {existing.count()} records, pass replace=True")
+            db_manager.client.delete_collection(name)
+        similarity = similarity or SimilarityMeasures(self.metadata.get("similarity") or "cosine")
+        collection = db_manager.create_collection(name, similarity)
+        upserter = BatchUpserter(collection, batch_size=batch_size, max_batch_size=db_manager.get_max_batch_size(),
+                                 use_writer_thread=use_writer_thread)
+        stats = upserter.upsert_arrays(list(self.disease_ids), FloatRows(self.embeddings),
+                                       [{"type": "disease"}] * len(self))
+        # the incremental and sharded build state described the replaced collection. Imported diseases get a
+        # fingerprint no build produces, so the next incremental build rewrites them all and deletes the ones it
+        # doesn't have
+        FingerprintStore.for_collection(db_manager.path, name).save({disease: "" for disease in self.disease_ids})
+        ShardCheckpoint.for_collection(db_manager.path, name, "").remove()
+        logger.info(f"Imported {len(self)} disease averages into {name}: {stats}")
+        return collection
+
+    def to_search_backend(self, similarity: SimilarityMeasures, storage: str = "float32",
+                          rerank: int = 0) -> SearchBackend:
+        """ The exact in memory numpy backend over the archived matrix. """
+        return create_search_backend("numpy", similarity, list(self.disease_ids),
+                                     np.asarray(self.embeddings, dtype=np.float32), storage=storage, rerank=rerank)
+
+
+class FloatRows:
+    """ Slices of a (possibly compact) matrix as float32 arrays, dequantized one upsert batch at a time. """
+
+    def __init__(self, matrix: Union[np.ndarray, QuantizedMatrix]):
+        self.matrix = matrix
+
+    def __len__(self) -> int:
+        return len(self.matrix)
+
+    def __getitem__(self, key) -> np.ndarray:
+        return np.asarray(self.matrix[key], dtype=np.float32)
+
+
+def file_checksum(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -1,22 +1,59 @@
-from chromadb.types import Collection
+from typing import TYPE_CHECKING, Optional
 
 from core.base_service import BaseService
+from core.sharded_build import ShardCheckpoint, build_key, sharded_build
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
 
 
 class DiseaseAvgEmbeddingService(BaseService):
     """
-        upsert averaged embeddings from hp_embeddings (cached dict from ont_hp collection) that are connected to the
-        relevant disease from disease_to_hps (cached dict from hpoa) into the disease_avg_embeddings_collection that
-        contains disease and the average embeddings of the correlating hp terms
+        upsert averaged embeddings from hp_embeddings (embedding matrix from ont_hp collection) that are connected to
+        the relevant disease from disease_to_hps (cached dict from hpoa) into the disease_avg_embeddings_collection
+        that contains disease and the average embeddings of the correlating hp terms. All averages are computed at
+        once by the data processor, diseases without any embedded hp are skipped
     """
 
-    def process_data(self) -> Collection:
+    # bumped whenever the collection is (re)built, query caches compare against it
+    generation = 0
+
+    def process_data(self, incremental: bool = False) -> "Collection":
+        """
+            incremental only upserts diseases whose hps or hp embeddings changed since the last build, a full build
+            upserts all of them. Both delete diseases that are gone and record the fingerprints of what they wrote
+        """
         if not self.disease_to_hps:
             raise ValueError("disease to hps data is not initialized")
         if not self.disease_avg_embeddings_collection:
             raise ValueError("disease_avg_embeddings collection is not initialized")
-        for disease, hps in self.disease_to_hps.items():
-            average_embedding = self.data_processor.calculate_average_embedding(hps, self.hp_embeddings)
-            self.disease_avg_embeddings_collection.upsert(ids=[disease], embeddings=[average_embedding.tolist()],
-                                                          metadatas=[{"type": "disease"}])
+        disease_ids, average_embeddings = self.data_processor.disease_average_embeddings()
+        self.upsert_changed(self.disease_avg_embeddings_collection, disease_ids, average_embeddings,
+                            {"type": "disease"}, self.data_processor.disease_fingerprints(), incremental=incremental)
+        self.generation += 1
         return self.disease_avg_embeddings_collection
+
+    def process_data_sharded(self, n_shards: int, n_processes: Optional[int] = None) -> "Collection":
+        """
+            full build split into n_shards, averaged by a pool of n_processes and written by this process. After a
+            crash the same call resumes at the first shard that was not written yet, as long as the inputs and
+            n_shards are unchanged
+        """
+        if not self.disease_to_hps:
+            raise ValueError("disease to hps data is not initialized")
+        if not self.disease_avg_embeddings_collection:
+            raise ValueError("disease_avg_embeddings collection is not initialized")
+        collection = self.disease_avg_embeddings_collection
+        fingerprints = self.data_processor.disease_fingerprints()
+        checkpoint = ShardCheckpoint.for_collection(getattr(self.data_processor.db_manager, "path", None),
+                                                    collection.name, build_key(fingerprints, n_shards))
+        if collection.count() == 0:
+            checkpoint.remove()  # collection was dropped, the completed shards are gone with it
+        store = self.fingerprint_store(collection)
+        upserter = self.create_upserter(collection)
+        self.delete_removed(collection, store.diff(fingerprints)[1], upserter.batch_size)
+        sharded_build(upserter, self.data_processor.disease_incidence, self.data_processor.hp_matrix,
+                      {"type": "disease"}, checkpoint, n_shards, n_processes)
+        store.save(fingerprints)
+        self.generation += 1
+        return collection
@@ -0,0 +1,220 @@
+from collections.abc import Mapping
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+"""
+    Dense storage for the HP embeddings (one contiguous float32 matrix plus an HPO id -> row index) and a CSR style
+    disease -> HP row incidence matrix, so averages are computed with array operations instead of per term lookups
+    in dicts of python lists.
+"""
+
+# upper bound for the number of hp rows gathered at once while aggregating, keeps the temporary bounded
+DEFAULT_BLOCK_ROWS = 65536
+
+
+class HPEmbeddings(Mapping):
+    """
+        Read only mapping view over the embedding matrix. hp_embeddings[hp_id]['embeddings'] keeps working like the
+        old {'HP:0005872': {'embeddings': [...]}} dict, but nothing is stored per term.
+    """
+
+    def __init__(self, index: Dict[str, int], matrix: np.ndarray):
+        self.index = index
+        self.matrix = matrix
+
+    def __getitem__(self, hp_id: str) -> Dict:
+        return {"embeddings": self.matrix[self.index[hp_id]]}
+
+    def __contains__(self, hp_id) -> bool:
+        return hp_id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def ids(self) -> List[str]:
+        return list(self.index)
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1] if self.matrix.ndim == 2 else 0
+
+    def rows(self, hp_ids: Iterable[str]) -> np.ndarray:
+        """
+        :param hp_ids: HPO ids, unknown ids are skipped.
+        :return: Array of matrix rows for the known ids.
+        """
+        index = self.index
+        return np.fromiter((index[hp_id] for hp_id in hp_ids if hp_id in index), dtype=np.int64)
+
+    def average(self, hp_ids: List[str], aggregation=None) -> Optional[np.ndarray]:
+        """
+        :param hp_ids: HPO ids, unknown ids are skipped.
+        :param aggregation: Optional AggregationStrategy providing query term weights, None is a plain mean.
+        :return: (Weighted) mean embedding of the known ids or None if none of them is known.
+        """
+        positions, averages = self.averages([hp_ids], aggregation)
+        return averages[0] if len(positions) else None
+
+    def averages(self, hp_id_lists: List[List[str]], aggregation=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Mean embeddings of many HPO id lists at once, through the same incidence product used for diseases.
+
+        :param hp_id_lists: One list of HPO ids per query.
+        :param aggregation: Optional AggregationStrategy providing query term weights, None is a plain mean.
+        :return: Positions of the lists with at least one known id and their (n, dim) averages.
+        """
+        weights = None
+        if aggregation is not None:
+            weights = {position: aggregation.query_weights(hp_ids) for position, hp_ids in enumerate(hp_id_lists)}
+        incidence = DiseaseIncidence.from_mapping(dict(enumerate(hp_id_lists)), self.index, weights)
+        return np.asarray(incidence.disease_ids, dtype=np.int64), incidence.means(self.matrix)
+
+    @classmethod
+    def from_records(cls, hp_ids: Iterable[Optional[str]], embeddings) -> "HPEmbeddings":
+        """
+        Builds the matrix from aligned ids and embeddings (as returned by collection.get). Records without an id are
+        dropped, for duplicate ids the last embedding wins.
+        """
+        index, keep = {}, []
+        for position, hp_id in enumerate(hp_ids):
+            if not hp_id:
+                continue
+            if hp_id in index:
+                keep[index[hp_id]] = position
+            else:
+                index[hp_id] = len(keep)
+                keep.append(position)
+        if not keep:
+            return cls(index, np.empty((0, 0), dtype=np.float32))
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        return cls(index, np.ascontiguousarray(matrix[keep]))
+
+
+class DiseaseIncidence:
+    """
+        CSR style disease x HP incidence matrix: the hp rows of disease_ids[i] are indices[indptr[i]:indptr[i + 1]]
+        with optional weights aligned to indices (None means all ones). Only diseases with at least one embedded HP
+        of non zero weight are kept. Repeated annotations are kept as well, so a term annotated twice counts twice,
+        same as averaging the hpoa rows directly.
+    """
+
+    def __init__(self, disease_ids: List[str], indptr: np.ndarray, indices: np.ndarray,
+                 weights: Optional[np.ndarray] = None):
+        self.disease_ids = disease_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+
+    def __len__(self) -> int:
+        return len(self.disease_ids)
+
+    @property
+    def counts(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    @property
+    def totals(self) -> np.ndarray:
+        """ Sum of weights per disease, the divisor of the weighted mean. """
+        if self.weights is None:
+            return self.counts.astype(np.float32)
+        return np.add.reduceat(self.weights, self.indptr[:-1]) if len(self) else np.empty(0, dtype=np.float32)
+
+    @classmethod
+    def from_mapping(cls, disease_to_hps: Dict[str, List[str]], hp_index: Dict[str, int],
+                     disease_to_weights: Optional[Dict[str, Optional[np.ndarray]]] = None) -> "DiseaseIncidence":
+        """
+        :param disease_to_weights: Optional weights aligned with each disease's hp list, None entries mean ones.
+        """
+        disease_ids, indptr, indices, weights = [], [0], [], []
+        for disease, hps in disease_to_hps.items():
+            hp_weights = disease_to_weights.get(disease) if disease_to_weights else None
+            if hp_weights is None:
+                entries = [(hp_index[hp_id], 1.0) for hp_id in hps if hp_id in hp_index]
+            else:
+                entries = [(hp_index[hp_id], weight) for hp_id, weight in zip(hps, hp_weights)
+                           if hp_id in hp_index and weight > 0]
+            if not entries:
+                continue
+            disease_ids.append(disease)
+            indices.extend(row for row, _ in entries)
+            weights.extend(weight for _, weight in entries)
+            indptr.append(len(indices))
+        return cls(disease_ids, np.asarray(indptr, dtype=np.int64), np.asarray(indices, dtype=np.int64),
+                   np.asarray(weights, dtype=np.float32) if disease_to_weights else None)
+
+    @classmethod
+    def from_annotations(cls, annotations, hp_index: Dict[str, int],
+                         weights: Optional[np.ndarray] = None) -> "DiseaseIncidence":
+        """
+        Vectorized construction from columnar hpoa annotations.
+
+        :param annotations: HPOAAnnotations.
+        :param hp_index: HPO id -> matrix row.
+        :param weights: Weight per annotation, zero weights are dropped. None means all ones.
+        """
+        term_rows = np.fromiter((hp_index.get(hp_id, -1) for hp_id in annotations.hpo_values), dtype=np.int64,
+                                count=len(annotations.hpo_values))
+        rows = term_rows[annotations.hpo] if len(annotations) else np.empty(0, dtype=np.int64)
+        keep = rows >= 0
+        if weights is not None:
+            keep &= weights > 0
+        order = np.argsort(annotations.disease[keep], kind="stable")
+        diseases = annotations.disease[keep][order]
+        present, counts = np.unique(diseases, return_counts=True)
+        indptr = np.zeros(len(present) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        # np.unique sorts codes, codes follow first appearance so diseases keep the hpoa order
+        return cls([annotations.disease_values[code] for code in present.tolist()], indptr, rows[keep][order],
+                   weights[keep][order].astype(np.float32) if weights is not None else None)
+
+    def sums(self, matrix: np.ndarray, block_rows: int = DEFAULT_BLOCK_ROWS) -> np.ndarray:
+        """
+        Sparse-dense product incidence @ matrix, computed in blocks of diseases so at most ~block_rows hp rows are
+        gathered at a time.
+
+        :param matrix: The dense hp embedding matrix.
+        :param block_rows: Soft cap for gathered rows per block.
+        :return: (n_diseases, dim) float32 array of summed embeddings.
+        """
+        out = np.empty((len(self), matrix.shape[1]), dtype=np.float32)
+        for start, end in self._blocks(block_rows):
+            lo, hi = self.indptr[start], self.indptr[end]
+            gathered = matrix[self.indices[lo:hi]]
+            if self.weights is not None:
+                gathered = gathered * self.weights[lo:hi, None]
+            out[start:end] = np.add.reduceat(gathered, self.indptr[start:end] - lo, axis=0, dtype=np.float32)
+        return out
+
+    def means(self, matrix: np.ndarray, block_rows: int = DEFAULT_BLOCK_ROWS) -> np.ndarray:
+        """
+        :return: (n_diseases, dim) float32 array of (weighted) average embeddings, sums divided by the row totals.
+        """
+        sums = self.sums(matrix, block_rows)
+        sums /= self.totals[:, None]
+        return sums
+
+    def shard(self, start: int, end: int) -> "DiseaseIncidence":
+        """ Diseases start:end as their own incidence matrix, indices still point into the full hp matrix. """
+        lo, hi = self.indptr[start], self.indptr[end]
+        return DiseaseIncidence(self.disease_ids[start:end], self.indptr[start:end + 1] - lo,
+                                self.indices[lo:hi], self.weights[lo:hi] if self.weights is not None else None)
+
+    def shard_bounds(self, n_shards: int) -> List[Tuple[int, int]]:
+        """ About n_shards (start, end) disease ranges with similar numbers of annotations. """
+        if n_shards < 1:
+            raise ValueError("n_shards must be a positive integer")
+        return list(self._blocks(max(1, -(-len(self.indices) // n_shards))))
+
+    def _blocks(self, block_rows: int) -> Iterable[Tuple[int, int]]:
+        start, n = 0, len(self)
+        while start < n:
+            # always take at least one disease, even if it alone exceeds block_rows
+            end = int(np.searchsorted(self.indptr, self.indptr[start] + block_rows, side="right")) - 1
+            end = min(max(end, start + 1), n)
+            yield start, end
+            start = end
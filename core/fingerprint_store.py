@@ -0,0 +1,55 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+"""
+    Sidecar file next to the chroma db that remembers a content hash per id of a collection, so a rebuild only has
+    to upsert the ids whose inputs changed and delete the ones that disappeared.
+"""
+
+
+class FingerprintStore:
+    def __init__(self, path: Optional[str]):
+        """
+        :param path: json file holding {id: fingerprint}, None keeps the fingerprints in memory only.
+        """
+        self.path = path
+        self.fingerprints = self.load()
+
+    @classmethod
+    def for_collection(cls, db_path: Optional[str], collection_name: str) -> "FingerprintStore":
+        return cls(os.path.join(db_path, f"{collection_name}.fingerprints.json") if db_path else None)
+
+    def load(self) -> Dict[str, str]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except ValueError:
+            logger.warning(f"Ignoring unreadable fingerprint file {self.path}")
+            return {}
+
+    def diff(self, current: Dict[str, str]) -> Tuple[List[str], List[str]]:
+        """
+        :param current: {id: fingerprint} of the current inputs.
+        :return: ids that are new or changed, ids that are stored but no longer present.
+        """
+        changed = [key for key, fingerprint in current.items() if self.fingerprints.get(key) != fingerprint]
+        removed = [key for key in self.fingerprints if key not in current]
+        return changed, removed
+
+    def clear(self):
+        self.fingerprints = {}
+
+    def save(self, current: Dict[str, str]):
+        self.fingerprints = dict(current)
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.fingerprints, file)
+        os.replace(tmp_path, self.path)
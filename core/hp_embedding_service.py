@@ -1,24 +1,25 @@
-from typing import Dict
+from typing import TYPE_CHECKING, Dict
 
 from core.base_service import BaseService
 from core.chromadb_manager import ChromaDBManager
 from core.data_processor import DataProcessor
-from chromadb.types import Collection
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
 
 
 class HPEmbeddingService(BaseService):
-    def process_data(self) -> Collection:
+    def process_data(self, incremental: bool = False) -> "Collection":
         """
-            upsert hps and embeddings into hp_embeddings collection created by chromadbmanager
+            upsert hps and embeddings into hp_embeddings collection created by chromadbmanager, in batches sliced
+            straight from the embedding matrix. incremental only touches hps whose embedding changed (or vanished)
+            since the last build, a full build upserts all of them. Both record the fingerprints of what they wrote
         """
         if not self.hp_embeddings:
             raise ValueError("HP embeddings data is not initialized")
         if not self.hp_embeddings_collection:
             raise ValueError("HP embeddings collection is not initialized")
-        if self.hp_embeddings_collection is not None:
-            for hp_id, data in self.hp_embeddings.items():
-                embedding_list = data['embeddings']
-                self.hp_embeddings_collection.upsert(ids=[hp_id], embeddings=[embedding_list],
-                                                     metadatas=[{"type": "HP"}])
-                # return self?
+        hp_ids = self.hp_embeddings.ids
+        self.upsert_changed(self.hp_embeddings_collection, hp_ids, self.hp_embeddings.matrix, {"type": "HP"},
+                            self.data_processor.hp_fingerprints(), incremental=incremental)
         return self.hp_embeddings_collection
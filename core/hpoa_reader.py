@@ -0,0 +1,180 @@
+import gzip
+import io
+import os
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, TextIO, Union
+
+import numpy as np
+
+"""
+    Streaming reader for phenotype.hpoa. The file is consumed line by line (plain or gzip) and every annotation is
+    appended to compact columns: strings that repeat (diseases, HPO ids, onsets, aspects) are interned and stored as
+    int32 codes, frequencies are parsed into floats. Memory grows with the number of annotations, not with the size
+    of the text.
+"""
+
+# hpoa columns, the header line of the file uses the same order
+DATABASE_ID, DISEASE_NAME, QUALIFIER, HPO_ID, REFERENCE, EVIDENCE, ONSET, FREQUENCY, SEX, MODIFIER, ASPECT, \
+    BIOCURATION = range(12)
+
+# HPO frequency terms mapped to the middle of the range they stand for
+FREQUENCY_TERMS = {
+    "HP:0040280": 1.0,  # obligate, 100%
+    "HP:0040281": 0.895,  # very frequent, 80-99%
+    "HP:0040282": 0.545,  # frequent, 30-79%
+    "HP:0040283": 0.17,  # occasional, 5-29%
+    "HP:0040284": 0.025,  # very rare, 1-4%
+    "HP:0040285": 0.0,  # excluded, 0%
+}
+
+
+def parse_frequency(value: str) -> float:
+    """
+    :param value: hpoa frequency column, 'n/m', 'x%' or an HPO frequency term.
+    :return: Frequency in [0, 1], NaN if the column is empty or unparseable.
+    """
+    if not value:
+        return np.nan
+    try:
+        if "/" in value:
+            numerator, denominator = value.split("/", 1)
+            return int(numerator) / int(denominator) if int(denominator) else np.nan
+        if value.endswith("%"):
+            return float(value[:-1]) / 100
+    except ValueError:
+        return np.nan
+    return FREQUENCY_TERMS.get(value, np.nan)
+
+
+class Interner:
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def __call__(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class HPOAAnnotations:
+    """
+        Columnar annotations, one entry per hpoa line. Codes index into the matching *_values lists.
+    """
+
+    def __init__(self, disease_values: List[str], disease_names: List[str], hpo_values: List[str],
+                 onset_values: List[str], aspect_values: List[str], disease: np.ndarray, hpo: np.ndarray,
+                 negated: np.ndarray, frequency: np.ndarray, onset: np.ndarray, aspect: np.ndarray):
+        self.disease_values = disease_values
+        self.disease_names = disease_names  # aligned with disease_values
+        self.hpo_values = hpo_values
+        self.onset_values = onset_values
+        self.aspect_values = aspect_values
+        self.disease = disease
+        self.hpo = hpo
+        self.negated = negated
+        self.frequency = frequency
+        self.onset = onset
+        self.aspect = aspect
+
+    def __len__(self) -> int:
+        return len(self.disease)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[List[str]]) -> "HPOAAnnotations":
+        """
+        :param rows: hpoa rows split into columns, as yielded by HPOAReader.rows.
+        """
+        diseases, hpos, onsets, aspects = Interner(), Interner(), Interner(), Interner()
+        disease_names = []
+        disease, hpo, onset, aspect = array("i"), array("i"), array("i"), array("i")
+        negated, frequency = array("b"), array("f")
+        frequencies = {}  # few distinct values, parse each once
+        for parts in rows:
+            code = diseases(parts[DATABASE_ID])
+            if code == len(disease_names):
+                disease_names.append(parts[DISEASE_NAME])
+            disease.append(code)
+            hpo.append(hpos(parts[HPO_ID]))
+            negated.append(parts[QUALIFIER] == "NOT")
+            value = parts[FREQUENCY] if len(parts) > FREQUENCY else ""
+            if value not in frequencies:
+                frequencies[value] = parse_frequency(value)
+            frequency.append(frequencies[value])
+            onset.append(onsets(parts[ONSET]) if len(parts) > ONSET and parts[ONSET] else -1)
+            aspect.append(aspects(parts[ASPECT]) if len(parts) > ASPECT and parts[ASPECT] else -1)
+        return cls(diseases.values, disease_names, hpos.values, onsets.values, aspects.values,
+                   np.frombuffer(disease, dtype=np.int32), np.frombuffer(hpo, dtype=np.int32),
+                   np.frombuffer(negated, dtype=np.int8).astype(bool), np.frombuffer(frequency, dtype=np.float32),
+                   np.frombuffer(onset, dtype=np.int32), np.frombuffer(aspect, dtype=np.int32))
+
+    def disease_to_hps(self, include_negated: bool = True, unique: bool = False,
+                       aspects: Optional[Sequence[str]] = None) -> Dict[str, List[str]]:
+        """
+        :param include_negated: Keep NOT qualified annotations.
+        :param unique: Drop repeated disease/HPO pairs (e.g. the same term backed by several references).
+        :param aspects: Only keep these aspects, e.g. ('P',) for phenotypic abnormalities.
+        :return: Diseases mapped to their HPO IDs, in file order.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if not include_negated:
+            keep &= ~self.negated
+        if aspects is not None:
+            aspect_codes = [code for code, value in enumerate(self.aspect_values) if value in aspects]
+            keep &= np.isin(self.aspect, aspect_codes)
+        disease_to_hps = {}
+        seen = set()
+        for disease, hpo in zip(self.disease[keep].tolist(), self.hpo[keep].tolist()):
+            if unique:
+                if (disease, hpo) in seen:
+                    continue
+                seen.add((disease, hpo))
+            disease_to_hps.setdefault(self.disease_values[disease], []).append(self.hpo_values[hpo])
+        return disease_to_hps
+
+
+class HPOAReader:
+    def __init__(self, source: Union[str, os.PathLike, TextIO], databases: Optional[Iterable[str]] = None,
+                 buffer_size: int = 1 << 20):
+        """
+        :param source: Path to a .hpoa (optionally gzipped) file or an open text stream.
+        :param databases: Only keep diseases from these database prefixes, e.g. ('OMIM', 'ORPHA', 'DECIPHER').
+        :param buffer_size: Read buffer for files.
+        """
+        self.source = source
+        self.prefixes = tuple(f"{database.rstrip(':')}:" for database in databases) if databases else None
+        self.buffer_size = buffer_size
+
+    def open(self) -> TextIO:
+        if not isinstance(self.source, (str, os.PathLike)):
+            return self.source
+        with open(self.source, "rb") as file:
+            is_gzip = file.read(2) == b"\x1f\x8b"
+        if is_gzip:
+            return io.TextIOWrapper(io.BufferedReader(gzip.open(self.source, "rb"), self.buffer_size),
+                                    encoding="utf-8")
+        return open(self.source, "r", encoding="utf-8", buffering=self.buffer_size)
+
+    def rows(self) -> Iterator[List[str]]:
+        """
+        Streams the annotation rows as lists of columns, comments, the header and short lines are skipped.
+        """
+        stream = self.open()
+        try:
+            for line in stream:
+                if not line or line[0] == "#" or line.startswith(("database_id", "DatabaseID")):
+                    continue
+                parts = line.rstrip("\r\n").split("\t")
+                if len(parts) <= HPO_ID:
+                    continue
+                if self.prefixes and not parts[DATABASE_ID].startswith(self.prefixes):
+                    continue
+                yield parts
+        finally:
+            if stream is not self.source:
+                stream.close()
+
+    def read(self) -> HPOAAnnotations:
+        return HPOAAnnotations.from_rows(self.rows())
@@ -1,31 +1,239 @@
 # main.py
-from core.chromadb_manager import ChromaDBManager
+import os
+
+from core.aggregation import create_aggregation_strategy
+from core.chromadb_manager import DEFAULT_VARIANT, ChromaDBManager, CollectionSet
 from core.data_processor import DataProcessor
-from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
-from core.hp_embedding_service import HPEmbeddingService
+from core.query_cache import QueryCache
 from core.query_service import QueryService
+from core.snapshot_cache import SnapshotCache
+from utils.instrumentation import profile
 from utils.similarity_measures import SimilarityMeasures
 
 
+class VariantPipeline:
+    """
+        Data processor, services and query service of one registry variant, built the first time the variant is used.
+        The upsert services are only created when a build needs them, a query never does.
+    """
+
+    def __init__(self, collections: CollectionSet, data_processor: DataProcessor, batch_size=None,
+                 use_writer_thread=False):
+        self.collections = collections
+        self.data_processor = data_processor
+        self.batch_size = batch_size
+        self.use_writer_thread = use_writer_thread
+        self._hp_service = None
+        self._disease_service = None
+        self.query_service = None
+
+    @property
+    def hp_service(self):
+        if self._hp_service is None:
+            from core.hp_embedding_service import HPEmbeddingService
+            self._hp_service = HPEmbeddingService(self.data_processor, batch_size=self.batch_size,
+                                                  use_writer_thread=self.use_writer_thread)
+        return self._hp_service
+
+    @property
+    def disease_service(self):
+        if self._disease_service is None:
+            from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
+            self._disease_service = DiseaseAvgEmbeddingService(self.data_processor, batch_size=self.batch_size,
+                                                               use_writer_thread=self.use_writer_thread)
+            if self.query_service is not None:
+                # builds from now on bump its generation, which invalidates the query cache
+                self.query_service.disease_service = self._disease_service
+        return self._disease_service
+
+
 class Main:
-    def __init__(self, similarity_measure=SimilarityMeasures.COSINE):
-        self.db_manager = ChromaDBManager(similarity=similarity_measure)
-        self.data_processor = DataProcessor(self.db_manager)
-        self.hp_service = HPEmbeddingService(self.data_processor)
-        self.disease_service = DiseaseAvgEmbeddingService(self.data_processor)
-
-    def initialize_data(self):
-        self.data_processor.init_hp_embeddings()
-        self.data_processor.init_disease_to_hps()
-
-    def setup_collections(self):
-        self.hp_service.process_data()
-        self.disease_service.process_data()
-
-    def run_analysis(self, input_hpos, n_results=10): # sim strategy can be gping in later
-        query_service = QueryService(
-            data_processor=self.data_processor,
-            db_manager=self.db_manager,
-            disease_service=self.disease_service,
-        )
-        return query_service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(input_hpos, n_results)
+    def __init__(self, similarity_measure=SimilarityMeasures.COSINE, batch_size=None, use_writer_thread=False,
+                 search_backend="numpy", use_snapshot=False, aggregation=None, query_cache_size=10000,
+                 storage="float32", rerank=0, config_path=None, hpoa_path=None, hpoa_databases=None):
+        self.similarity_measure = similarity_measure
+        self.search_backend = search_backend  # 'numpy', 'hnsw' or 'chroma'
+        self.batch_size = batch_size
+        self.use_writer_thread = use_writer_thread
+        self.query_cache_size = query_cache_size  # 0 disables the query result cache
+        # 'float16' or 'int8' keep the hp and disease matrices compact, rerank re-scores the top candidates in float32
+        self.storage = storage
+        self.rerank = rerank
+        # one client for all variants registered in config.yaml, each variant's collections open on first use
+        self.db_manager = ChromaDBManager(similarity=similarity_measure, config_path=config_path)
+        # snapshots live next to the db, startup becomes an mmap when ont_hp and hpoa are unchanged
+        self.snapshot_cache = SnapshotCache(os.path.join(self.db_manager.path, "snapshots")) if use_snapshot \
+            else None
+        # aggregation of the default variant, defaults to the 'aggregation' section of config.yaml
+        self.aggregation = aggregation
+        # read disease annotations from a phenotype.hpoa file (optionally only some databases, e.g. ['OMIM']) instead
+        # of the hpoa collection, for every variant. Defaults to the variant's hpoa_path in config.yaml
+        self.hpoa_path = hpoa_path
+        self.hpoa_databases = hpoa_databases
+        # variants, the default one included, are loaded on first use
+        self.pipelines = {}
+
+    @property
+    def data_processor(self) -> DataProcessor:
+        return self.get_pipeline().data_processor
+
+    @property
+    def hp_service(self):
+        return self.get_pipeline().hp_service
+
+    @property
+    def disease_service(self):
+        return self.get_pipeline().disease_service
+
+    def get_pipeline(self, variant=None, aggregation=None) -> VariantPipeline:
+        """
+        :param variant: Name of a variant registered in the db manager, None is the default variant.
+        :param aggregation: AggregationStrategy overriding the variant's configured one on first use, the default
+            variant uses Main's aggregation.
+        """
+        variant = variant or DEFAULT_VARIANT
+        if variant not in self.pipelines:
+            collections = self.db_manager.variant(variant)
+            if aggregation is None and variant == DEFAULT_VARIANT:
+                aggregation = self.aggregation
+            hpoa_path, hpoa_databases = (self.hpoa_path, self.hpoa_databases) if self.hpoa_path \
+                else (collections.hpoa_path, collections.hpoa_databases)
+            data_processor = DataProcessor(collections, snapshot_cache=self.snapshot_cache, hpoa_path=hpoa_path,
+                                           hpoa_databases=hpoa_databases,
+                                           aggregation=aggregation or create_aggregation_strategy(
+                                               collections.aggregation), storage=self.storage)
+            self.pipelines[variant] = VariantPipeline(collections, data_processor, batch_size=self.batch_size,
+                                                      use_writer_thread=self.use_writer_thread)
+        return self.pipelines[variant]
+
+    def initialize_data(self, refresh=False, variant=None):
+        # data is already loaded when a variant is first used, refresh re-reads it after the source collections changed
+        if refresh:
+            self.get_pipeline(variant).data_processor.load()
+
+    def setup_collections(self, incremental=False, n_shards=None, n_processes=None, variant=None):
+        # incremental only writes what changed since the last setup, e.g. after a monthly HPO update
+        if incremental and n_shards:
+            raise ValueError("n_shards builds all disease averages, it can't be combined with incremental")
+        pipeline = self.get_pipeline(variant)
+        pipeline.hp_service.process_data(incremental=incremental)
+        if n_shards:
+            # resumable, parallel build of the disease averages
+            pipeline.disease_service.process_data_sharded(n_shards, n_processes)
+        else:
+            pipeline.disease_service.process_data(incremental=incremental)
+
+    def get_query_service(self, variant=None) -> QueryService:
+        # built once per variant, the in memory search backends are kept between queries
+        pipeline = self.get_pipeline(variant)
+        if pipeline.query_service is None:
+            similarity = self.similarity_measure if pipeline.collections.name == DEFAULT_VARIANT \
+                else pipeline.collections.similarity
+            pipeline.query_service = QueryService(
+                data_processor=pipeline.data_processor,
+                db_manager=pipeline.collections,
+                disease_service=pipeline._disease_service,
+                search_backend=self.search_backend,
+                similarity=similarity,
+                cache=QueryCache(max_entries=self.query_cache_size) if self.query_cache_size else None,
+                storage=self.storage,
+                rerank=self.rerank,
+            )
+        return pipeline.query_service
+
+    def run_analysis(self, input_hpos, n_results=10, variant=None): # sim strategy can be gping in later
+        """
+        :param variant: Registry variant (embedding model, similarity, aggregation) to query, default if None.
+        """
+        return self.get_query_service(variant).query_diseases_by_hpo_terms_using_inbuild_distance_functions(
+            input_hpos, n_results)
+
+    def run_batch_analysis(self, input_hpo_lists, n_results=10, chunk_size=512, n_processes=None, variant=None):
+        """
+        Ranks diseases for many patients at once, see QueryService.query_many.
+        """
+        return self.get_query_service(variant).query_many(input_hpo_lists, n_results, chunk_size=chunk_size,
+                                                          n_processes=n_processes)
+
+    def run_similarity_analysis(self, input_hpo_lists, n_results=10, similarity_strategy="bma", variant=None):
+        """
+        Ranks all diseases in process with a similarity strategy ('cosine', 'l2', 'ip' or 'bma'), see
+        QueryService.query_many_with_similarity_strategy.
+        """
+        return self.get_query_service(variant).query_many_with_similarity_strategy(input_hpo_lists, n_results,
+                                                                                    similarity_strategy)
+
+    def build_neighbor_indexes(self, n_neighbors=50, similarity_strategy=None, variant=None):
+        """
+        Offline job: loads or (re)builds the precomputed HP term and disease neighbor indexes of a variant, stored
+        under <index_dir>/neighbors.
+
+        :return: (hp NeighborIndex, disease NeighborIndex)
+        """
+        from core.neighbor_index import NeighborIndex
+        pipeline = self.get_pipeline(variant)
+        directory = os.path.join(pipeline.collections.index_dir, "neighbors")
+        data_processor = pipeline.data_processor
+        disease_ids, disease_embeddings = data_processor.disease_average_embeddings()
+        return (NeighborIndex.load_or_build(os.path.join(directory, "hp"), data_processor.hp_embeddings.ids,
+                                            data_processor.hp_matrix, n_neighbors,
+                                            similarity_strategy=similarity_strategy),
+                NeighborIndex.load_or_build(os.path.join(directory, "diseases"), disease_ids, disease_embeddings,
+                                            n_neighbors, similarity_strategy=similarity_strategy))
+
+    def export_disease_averages(self, path, from_collection=False, storage="float32", variant=None):
+        """
+        Writes the disease averages of a variant to a DiseaseAverageArchive directory.
+
+        :param from_collection: Page them out of the DiseaseAvgEmbeddings collection instead of computing them.
+        """
+        from core.disease_archive import DiseaseAverageArchive
+        pipeline = self.get_pipeline(variant)
+        collections = pipeline.collections
+        metadata = {"variant": collections.name, "model": collections.model,
+                    "similarity": collections.similarity.value}
+        if from_collection:
+            data_processor = pipeline.data_processor
+            hp_counts = dict(zip(data_processor.disease_incidence.disease_ids,
+                                 data_processor.disease_incidence.counts.tolist()))
+            archive = DiseaseAverageArchive.from_collection(collections.disease_avg_embeddings_collection, hp_counts,
+                                                            metadata)
+        else:
+            archive = DiseaseAverageArchive.from_data_processor(pipeline.data_processor, metadata)
+        return archive.save(path, storage=storage)
+
+    def import_disease_averages(self, path, into="collection", replace=False, variant=None):
+        """
+        Loads a DiseaseAverageArchive (checksums and embedding dimension are verified) into a fresh
+        DiseaseAvgEmbeddings collection of the variant ('collection') or straight into its query service ('query').
+        """
+        from core.disease_archive import DiseaseAverageArchive
+        pipeline = self.get_pipeline(variant)
+        archive = DiseaseAverageArchive.load(path, expected_dim=pipeline.data_processor.hp_embeddings.dim)
+        if into == "query":
+            return self.get_query_service(variant).use_disease_archive(archive)
+        if into != "collection":
+            raise ValueError(f"Unknown import target {into}, expected 'collection' or 'query'")
+        collections = pipeline.collections
+        collection = archive.to_collection(self.db_manager, collections.collection_names["disease_avg_embeddings"],
+                                           similarity=collections.similarity, replace=replace,
+                                           batch_size=self.batch_size, use_writer_thread=self.use_writer_thread)
+        collections.collections["disease_avg_embeddings"] = collection  # the cached handle was dropped
+        pipeline.disease_service.generation += 1
+        if pipeline.query_service is not None:
+            pipeline.query_service.search_backends = {}
+        return collection
+
+    def run_profiled_analysis(self, input_hpos, n_results=10, output_path=None, variant=None):
+        """
+        run_analysis under cProfile, stats are logged and written to output_path if given.
+        """
+        with profile(output_path):
+            return self.run_analysis(input_hpos, n_results, variant=variant)
+
+    def create_async_query_service(self, variant=None, **kwargs):
+        """
+        AsyncQueryService sharing this Main's db client, data processor and query service, see its docs for kwargs.
+        """
+        from core.async_query_service import AsyncQueryService
+        return AsyncQueryService(self.get_query_service(variant), **kwargs)
@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from core.data_processor import DataProcessor
+from core.quantization import QuantizedMatrix
+from core.search_backends import matrix_fingerprint
+from core.similarity_service import (DEFAULT_SIMILARITY_BLOCK_SIZE, BestMatchAverage, SimilarityService,
+                                     create_similarity_strategy)
+from utils.atomic_directory import atomic_directory
+
+logger = logging.getLogger(__name__)
+
+# bump whenever the on disk layout changes, older indexes are then rebuilt
+NEIGHBOR_INDEX_VERSION = 1
+
+# rows whose neighbors are searched at once, bounds the build to query_block_rows x block_size distances
+DEFAULT_QUERY_BLOCK_ROWS = 1024
+
+"""
+    Precomputed nearest neighbors of every HP term and every disease. All pairs are scored offline in blocks (a block
+    of rows against a block of columns, with a running top-k), so the build never holds more than the embedding
+    matrix, one block of distances and the result. Only the top n_neighbors per row are kept, as two fixed width
+    (n_rows, n_neighbors) arrays of neighbor rows and distances, which are memory mapped when loaded from disk. A
+    lookup is a dict access plus a row slice.
+"""
+
+
+class NeighborIndex:
+    def __init__(self, ids: List[str], neighbors: np.ndarray, distances: np.ndarray, similarity: str,
+                 fingerprint: Optional[str] = None):
+        """
+        :param ids: Row ids, neighbors point into this list.
+        :param neighbors: (n_rows, n_neighbors) int32 neighbor rows, closest first.
+        :param distances: Aligned float32 distances in the strategy's space, smaller is closer.
+        :param similarity: Name of the SimilarityService strategy the distances come from.
+        :param fingerprint: Fingerprint of the ids and matrix the index was built from.
+        """
+        self.ids = ids
+        self.index: Dict[str, int] = {item_id: row for row, item_id in enumerate(ids)}
+        self.neighbors = neighbors
+        self.distances = distances
+        self.similarity = similarity
+        self.fingerprint = fingerprint
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, item_id) -> bool:
+        return item_id in self.index
+
+    @property
+    def n_neighbors(self) -> int:
+        return self.neighbors.shape[1]
+
+    def most_similar(self, item_id: str, n: Optional[int] = None) -> List[Tuple[str, float]]:
+        """
+        :param item_id: An HPO or disease id of the index.
+        :param n: Number of neighbors, at most n_neighbors, all of them by default.
+        :return: (id, distance) of the closest other rows, closest first.
+        """
+        row = self.index[item_id]
+        neighbors, distances = self.neighbors[row, :n], self.distances[row, :n]
+        ids = self.ids
+        return [(ids[j], float(d)) for j, d in zip(neighbors.tolist(), distances.tolist())]
+
+    @classmethod
+    def build(cls, ids: List[str], matrix: Union[np.ndarray, QuantizedMatrix], n_neighbors: int,
+              similarity_strategy: Union[SimilarityService, str, None] = None,
+              query_block_rows: int = DEFAULT_QUERY_BLOCK_ROWS,
+              block_size: int = DEFAULT_SIMILARITY_BLOCK_SIZE) -> "NeighborIndex":
+        """
+        :param ids: Row ids aligned with matrix.
+        :param matrix: (n_rows, dim) embeddings, compact storages are dequantized one block at a time.
+        :param n_neighbors: Neighbors kept per row, the row itself is never one of them.
+        :param similarity_strategy: A vector SimilarityService or its name, cosine by default.
+        :param query_block_rows: Rows searched at once.
+        :param block_size: Columns scored at once.
+        """
+        if n_neighbors < 1 or query_block_rows < 1:
+            raise ValueError("n_neighbors and query_block_rows must be positive integers")
+        strategy = similarity_strategy if isinstance(similarity_strategy, SimilarityService) \
+            else create_similarity_strategy(similarity_strategy)
+        if isinstance(strategy, BestMatchAverage):
+            raise ValueError("neighbor indexes compare single embeddings, best match average compares sets")
+        n_rows = len(ids)
+        n_neighbors = min(n_neighbors, max(n_rows - 1, 0))
+        neighbors = np.empty((n_rows, n_neighbors), dtype=np.int32)
+        distances = np.empty((n_rows, n_neighbors), dtype=np.float32)
+        for start in range(0, n_rows, query_block_rows):
+            end = min(start + query_block_rows, n_rows)
+            # one extra candidate, the row itself is usually (but with duplicate embeddings not always) the first
+            rows, values = strategy.top_k(np.asarray(matrix[start:end], dtype=np.float32), matrix, n_neighbors + 1,
+                                          block_size)
+            not_self = rows != np.arange(start, end)[:, None]
+            # keep the first n_neighbors columns that are not the row itself
+            keep = not_self & (np.cumsum(not_self, axis=1) <= n_neighbors)
+            neighbors[start:end] = rows[keep].reshape(end - start, n_neighbors)
+            distances[start:end] = values[keep].reshape(end - start, n_neighbors)
+        return cls(list(ids), neighbors, distances, strategy.name, fingerprint=fingerprint(ids, matrix))
+
+    @classmethod
+    def for_hp_terms(cls, data_processor: DataProcessor, n_neighbors: int, **kwargs) -> "NeighborIndex":
+        """ Nearest HP terms of every HP term, see build for kwargs. """
+        return cls.build(data_processor.hp_embeddings.ids, data_processor.hp_matrix, n_neighbors, **kwargs)
+
+    @classmethod
+    def for_diseases(cls, data_processor: DataProcessor, n_neighbors: int, **kwargs) -> "NeighborIndex":
+        """ Nearest diseases of every disease by their average embeddings, see build for kwargs. """
+        disease_ids, disease_embeddings = data_processor.disease_average_embeddings()
+        return cls.build(disease_ids, disease_embeddings, n_neighbors, **kwargs)
+
+    def save(self, path: str) -> str:
+        """ Writes the index to the directory path, replacing an older one, see atomic_directory. """
+        with atomic_directory(path) as tmp_path:
+            np.save(os.path.join(tmp_path, "neighbors.npy"), self.neighbors)
+            np.save(os.path.join(tmp_path, "distances.npy"), self.distances)
+            with open(os.path.join(tmp_path, "index.json"), "w") as file:
+                json.dump({"version": NEIGHBOR_INDEX_VERSION, "similarity": self.similarity,
+                           "fingerprint": self.fingerprint, "ids": self.ids}, file)
+        logger.info(f"Saved neighbor index {path}")
+        return path
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> Optional["NeighborIndex"]:
+        """
+        :return: The index or None if there is none (of this version) at path.
+        """
+        try:
+            with open(os.path.join(path, "index.json"), "r") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != NEIGHBOR_INDEX_VERSION:
+            return None
+        mmap_mode = "r" if mmap else None
+        return cls(meta["ids"], np.load(os.path.join(path, "neighbors.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, "distances.npy"), mmap_mode=mmap_mode), meta["similarity"],
+                   meta.get("fingerprint"))
+
+    @classmethod
+    def load_or_build(cls, path: str, ids: List[str], matrix: Union[np.ndarray, QuantizedMatrix], n_neighbors: int,
+                      **kwargs) -> "NeighborIndex":
+        """
+        Loads the index at path if it was built from the same ids, matrix, strategy and n_neighbors, otherwise
+        builds and saves it.
+        """
+        index = cls.load(path)
+        strategy = kwargs.get("similarity_strategy")
+        name = strategy.name if isinstance(strategy, SimilarityService) else create_similarity_strategy(strategy).name
+        if index is not None and index.similarity == name and \
+                index.n_neighbors == min(n_neighbors, max(len(ids) - 1, 0)) and \
+                index.fingerprint == fingerprint(ids, matrix):
+            return index
+        if index is not None:
+            logger.info(f"Neighbor index {path} is stale, rebuilding")
+        index = cls.build(ids, matrix, n_neighbors, **kwargs)
+        index.save(path)
+        return index
+
+
+def fingerprint(ids: List[str], matrix: Union[np.ndarray, QuantizedMatrix]) -> str:
+    """ Compact storages are hashed by their codes, never widened to float32. """
+    return matrix_fingerprint(list(ids), matrix.codes if isinstance(matrix, QuantizedMatrix) else matrix)
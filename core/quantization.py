@@ -0,0 +1,123 @@
+import os
+from typing import Optional, Union
+
+import numpy as np
+
+from core.embedding_matrix import DEFAULT_BLOCK_ROWS
+
+"""
+    Compact storage for embedding matrices: float16, or int8 with one float32 scale per row (symmetric, the largest
+    absolute value of a row maps to 127). Rows are dequantized to float32 when they are read, so the gathering code
+    paths (averaging, fingerprints) work on a QuantizedMatrix like on a plain array while only the codes stay resident.
+"""
+
+STORAGE_TYPES = ("float32", "float16", "int8")
+
+
+class QuantizedMatrix:
+    def __init__(self, codes: np.ndarray, scales: Optional[np.ndarray] = None):
+        """
+        :param codes: (n, dim) float16 or int8 array, may be memory mapped.
+        :param scales: (n,) float32 scale per row, required for int8 codes.
+        """
+        if codes.dtype == np.int8 and scales is None:
+            raise ValueError("int8 codes need a scale per row")
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def quantize(cls, matrix, storage: str,
+                 block_rows: int = DEFAULT_BLOCK_ROWS) -> Union[np.ndarray, "QuantizedMatrix"]:
+        """
+        :param matrix: (n, dim) array or QuantizedMatrix.
+        :param storage: One of STORAGE_TYPES, 'float32' returns a plain contiguous float32 array.
+        :return: The matrix in the requested storage, unchanged if it already is.
+        """
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage {storage}, expected one of {STORAGE_TYPES}")
+        if storage == storage_of(matrix):
+            return matrix
+        if storage == "float32":
+            return np.ascontiguousarray(matrix, dtype=np.float32)
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if storage == "float16":
+            return cls(matrix.astype(np.float16))
+        codes = np.empty(matrix.shape, dtype=np.int8)
+        scales = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), block_rows):
+            block = matrix[start:start + block_rows]
+            block_scales = np.abs(block).max(axis=1, initial=0) / 127
+            block_scales[block_scales == 0] = 1
+            codes[start:start + block_rows] = np.rint(block / block_scales[:, None])
+            scales[start:start + block_rows] = block_scales
+        return cls(codes, scales)
+
+    @property
+    def storage(self) -> str:
+        return "int8" if self.codes.dtype == np.int8 else "float16"
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def ndim(self) -> int:
+        return self.codes.ndim
+
+    @property
+    def dtype(self):
+        # the dtype rows are read as
+        return np.dtype(np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, key) -> np.ndarray:
+        rows = self.codes[key].astype(np.float32)
+        if self.scales is not None:
+            scales = self.scales[key]
+            rows *= scales[..., None] if np.ndim(scales) else scales
+        return rows
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        rows = self[:]
+        return rows.astype(dtype) if dtype is not None else rows
+
+    def products(self, queries: np.ndarray, block_rows: int = DEFAULT_BLOCK_ROWS) -> np.ndarray:
+        """
+        queries @ matrix.T, dequantizing block_rows rows at a time so no full float32 copy is made.
+
+        :return: (n_queries, n_rows) float32 array.
+        """
+        out = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), block_rows):
+            block = self.codes[start:start + block_rows].astype(np.float32)
+            out[:, start:start + block_rows] = queries @ block.T
+            if self.scales is not None:
+                out[:, start:start + block_rows] *= self.scales[start:start + block_rows]
+        return out
+
+    def save(self, directory: str, name: str):
+        np.save(os.path.join(directory, f"{name}.npy"), self.codes)
+        if self.scales is not None:
+            np.save(os.path.join(directory, f"{name}_scales.npy"), self.scales)
+
+
+def storage_of(matrix) -> str:
+    return matrix.storage if isinstance(matrix, QuantizedMatrix) else np.dtype(matrix.dtype).name
+
+
+def load_matrix(directory: str, name: str, mmap: bool = True) -> Union[np.ndarray, QuantizedMatrix]:
+    """
+    Loads a matrix saved with np.save or QuantizedMatrix.save, float16 and int8 codes come back quantized.
+    """
+    codes = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None)
+    if codes.dtype == np.float32:
+        return codes
+    scales_path = os.path.join(directory, f"{name}_scales.npy")
+    scales = np.load(scales_path) if os.path.exists(scales_path) else None
+    return QuantizedMatrix(codes, scales)
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+"""
+    Bounded LRU cache with optional TTL for query results and averaged query vectors. Entries are evicted by count
+    and by (estimated) size, and the whole cache is dropped when the data it was computed from changes.
+"""
+
+MISSING = object()
+
+
+class QueryCache:
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024,
+                 ttl_seconds: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        """
+        :param max_entries: Max number of cached entries.
+        :param max_bytes: Max summed size of the cached entries, as estimated by the caller.
+        :param ttl_seconds: Entries older than this are treated as missing, None keeps them until evicted.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (value, size, created)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.version = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def check_version(self, version: Hashable):
+        """ Drops everything if version differs from the one the entries were computed for. """
+        with self._lock:
+            if version != self.version:
+                self._clear()
+                self.version = version
+
+    def get(self, key: Hashable) -> Any:
+        """
+        :return: The cached value or MISSING.
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl_seconds is not None and self.clock() - entry[2] > self.ttl_seconds:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int):
+        if size > self.max_bytes or self.max_entries < 1:
+            return
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, self.clock())
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
@@ -1,42 +1,199 @@
-from typing import List, Any
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 
-from core.chromadb_manager import ChromaDBManager
+from core.aggregation import AggregationStrategy
 from core.data_processor import DataProcessor
-from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
+from core.embedding_matrix import HPEmbeddings
+from core.query_cache import MISSING, QueryCache
+from core.search_backends import ChromaSearchBackend, SearchBackend, collection_similarity, create_search_backend
+from core.similarity_service import (DEFAULT_SIMILARITY_BLOCK_SIZE, Ranking, SimilarityService,
+                                     create_similarity_strategy)
+from utils.instrumentation import metrics
+from utils.similarity_measures import SimilarityMeasures
+
+if TYPE_CHECKING:
+    from core.chromadb_manager import ChromaDBManager
+    from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
+
+logger = logging.getLogger(__name__)
+
+# rough size of one (disease, distance) tuple, used to bound the result cache by memory
+RESULT_ENTRY_BYTES = 120
+
+# patients scored per matrix product in query_many, bounds the (chunk, n_diseases) distance matrix
+DEFAULT_QUERY_CHUNK_SIZE = 512
 
 
 class QueryService:
-    def __init__(self, data_processor: DataProcessor, db_manager: ChromaDBManager, disease_service: DiseaseAvgEmbeddingService, similarity_strategy=None):
+    def __init__(self, data_processor: DataProcessor, db_manager: "ChromaDBManager", disease_service: Optional["DiseaseAvgEmbeddingService"] = None, similarity_strategy=None,
+                 search_backend: Union[str, Dict[SimilarityMeasures, str]] = "chroma",
+                 similarity: Optional[SimilarityMeasures] = None, cache: Optional[QueryCache] = None,
+                 storage: str = "float32", rerank: int = 0):
+        """
+        :param disease_service: Service that (re)builds the disease collection, its generation invalidates the cache.
+            Queries don't need it, the collection is only opened by the chroma backend.
+        :param search_backend: 'chroma', 'numpy' or 'hnsw', or a dict choosing one per SimilarityMeasures value.
+        :param similarity: Default similarity measure for queries, defaults to the disease collection's space.
+        :param cache: Optional QueryCache for results and averaged query vectors of single queries.
+        :param storage: Disease matrix storage of the numpy backend: 'float32', 'float16' or 'int8'.
+        :param rerank: Re-rank n_results * rerank candidates of a compact disease matrix in float32, 0 disables it.
+        """
         self.db_manager = db_manager
         self.data_processor = data_processor
         self.similarity_strategy = similarity_strategy
-        self.hp_embeddings = data_processor.hp_embeddings  # Dict
         self.disease_service = disease_service
+        self.search_backend = search_backend
+        self.similarity = similarity or collection_similarity(self.disease_avg_embeddings_collection)
+        self.search_backends: Dict[SimilarityMeasures, SearchBackend] = {}
+        self.generation = data_processor.generation
+        self.cache = cache
+        self.storage = storage
+        self.rerank = rerank
+
+    @property
+    def hp_embeddings(self) -> HPEmbeddings:
+        return self.data_processor.hp_embeddings
+
+    @property
+    def disease_avg_embeddings_collection(self):
+        # opened (and created if missing) on access, so only touched when chroma has to answer
+        return self.db_manager.disease_avg_embeddings_collection
 
-    def query_diseases_by_hpo_terms_using_inbuild_distance_functions(self, hpo_ids: List[str], n_results: int) -> str | list[Any]: # str just for early return
+    @property
+    def disease_generation(self) -> int:
+        return self.disease_service.generation if self.disease_service is not None else 0
+
+    def get_search_backend(self, similarity: Optional[SimilarityMeasures] = None) -> SearchBackend:
+        """
+        Creates (once per similarity measure) the configured backend. The chroma backend can only rank by the
+        collection's own space, for other measures the exact numpy backend is used instead.
         """
-        Queries the 'DiseaseAvgEmbeddings' collection for diseases closest to the average embeddings of given HPO terms.
+        similarity = similarity or self.similarity
+        self.drop_stale_backends()
+        if similarity not in self.search_backends:
+            name = self.search_backend.get(similarity, "numpy") if isinstance(self.search_backend, dict) \
+                else self.search_backend
+            collection = self.disease_avg_embeddings_collection if name == "chroma" else None
+            if name == "chroma" and collection_similarity(collection) != similarity:
+                logger.info(f"{collection.name} is not indexed for {similarity.value}, using the numpy backend")
+                name = "numpy"
+            # the backend keeps its own (possibly compact) matrix, a float32 copy in the processor would double it
+            disease_ids, disease_embeddings = self.data_processor.disease_average_embeddings(cache=False) \
+                if name != "chroma" else (None, None)
+            try:
+                backend = create_search_backend(name, similarity, disease_ids, disease_embeddings,
+                                                collection=collection,
+                                                index_dir=getattr(self.db_manager, "index_dir", None),
+                                                storage=self.storage, rerank=self.rerank)
+            except ImportError as e:
+                logger.warning(f"{e}, using the numpy backend")
+                backend = create_search_backend("numpy", similarity, disease_ids, disease_embeddings,
+                                                storage=self.storage, rerank=self.rerank)
+            self.search_backends[similarity] = backend
+        return self.search_backends[similarity]
+
+    def drop_stale_backends(self):
+        if self.generation != self.data_processor.generation:
+            # data was reloaded, the disease matrices the backends were built from are stale
+            self.search_backends = {}
+            self.generation = self.data_processor.generation
+
+    def use_disease_archive(self, archive, similarity: Optional[SimilarityMeasures] = None) -> SearchBackend:
+        """
+        Serves queries from an imported DiseaseAverageArchive instead of the data processor's own averages, until
+        the data processor is reloaded.
+
+        :raises ValueError: If the archive's dimension differs from the hp embeddings the queries are averaged from.
+        """
+        if archive.dim != self.hp_embeddings.dim:
+            raise ValueError(f"archive holds {archive.dim} dimensional embeddings, the hp embeddings have "
+                             f"{self.hp_embeddings.dim}")
+        similarity = similarity or self.similarity
+        self.drop_stale_backends()
+        backend = archive.to_search_backend(similarity, storage=self.storage, rerank=self.rerank)
+        self.search_backends[similarity] = backend
+        if self.cache is not None:
+            self.cache.clear()
+        return backend
+
+    def query_diseases_by_hpo_terms_using_inbuild_distance_functions(self, hpo_ids: List[str], n_results: int,
+                                                                     similarity: Optional[SimilarityMeasures] = None) -> str | list[Any]: # str just for early return
+        """
+        Queries the disease average embeddings for diseases closest to the average embeddings of given HPO terms.
 
         :param n_results: number of results for query
         :param hpo_ids: List of HPO term IDs.
-        :return: List of diseases sorted by closeness to the average HPO embeddings.
+        :param similarity: Similarity measure to rank by, defaults to the service's measure.
+        :return: List of (disease, distance) sorted by closeness to the average HPO embeddings.
         """
-        # need to check that self contains the collection needed here and the dicts !!!!
-        avg_embedding = self.data_processor.calculate_average_embedding(hpo_ids, self.hp_embeddings) # self.data_processor
-        if avg_embedding is None:
-            return "No valid embeddings found for provided HPO terms."
+        backend = self.get_search_backend(similarity)
+        hpo_ids = canonical_hpo_ids(hpo_ids)
+        result_key = ("results", hpo_ids, n_results, backend.similarity)
+        if self.cache is not None:
+            self.cache.check_version((self.data_processor.generation, self.disease_generation))
+            cached = self.cache.get(result_key)
+            if cached is not MISSING:
+                return list(cached)
+        with metrics.timer("query_seconds", backend=backend.name):
+            with metrics.timer("query_average_seconds"):
+                avg_embedding = self.average_embedding(hpo_ids)
+            if avg_embedding is None:
+                return "No valid embeddings found for provided HPO terms."
+            with metrics.timer("query_search_seconds", backend=backend.name):
+                results = backend.search(avg_embedding[None, :], n_results)[0]
+        if self.cache is not None:
+            self.cache.put(result_key, tuple(results), RESULT_ENTRY_BYTES * (len(results) + 1))
+        return results
 
-        query_results = self.disease_service.disease_avg_embeddings_collection.query( # self.data_processor?
-            query_embeddings=[avg_embedding.tolist()],
-            n_results=n_results,  # optional, should be all for
-            include=["embeddings", "distances"]  # just distances should also work
-        )
+    def average_embedding(self, hpo_ids: Tuple[str, ...]):
+        """ Averaged query vector for canonical hpo ids, through the cache when there is one. """
+        if self.cache is None:
+            return self.data_processor.average_embedding(list(hpo_ids))
+        key = ("vector", hpo_ids)
+        avg_embedding = self.cache.get(key)
+        if avg_embedding is MISSING:
+            avg_embedding = self.data_processor.average_embedding(list(hpo_ids))
+            self.cache.put(key, avg_embedding, avg_embedding.nbytes if avg_embedding is not None else 0)
+        return avg_embedding
 
-        disease_ids = query_results['ids'][0] if 'ids' in query_results and query_results['ids'] else []
-        distances = query_results['distances'][0] if 'distances' in query_results and query_results['distances'] else []
-        sorted_results = sorted(zip(disease_ids, distances), key=lambda x: x[1])
+    def cache_stats(self) -> Dict[str, Any]:
+        """ Hit/miss statistics of the query cache, empty without one. """
+        return self.cache.stats() if self.cache is not None else {}
+
+    def query_many(self, hpo_id_lists: List[List[str]], n_results: int,
+                   similarity: Optional[SimilarityMeasures] = None, chunk_size: int = DEFAULT_QUERY_CHUNK_SIZE,
+                   n_processes: Optional[int] = None) -> List[List[Tuple[str, float]]]:
+        """
+        Scores many patients' HPO profiles: per chunk all averages come from one incidence product and all diseases
+        are ranked with one matrix product.
 
-        return sorted_results
+        :param hpo_id_lists: One list of HPO term IDs per patient.
+        :param n_results: number of results per patient
+        :param similarity: Similarity measure to rank by, defaults to the service's measure.
+        :param chunk_size: Patients per chunk, bounds memory to chunk_size x n_diseases distances.
+        :param n_processes: Score chunks in a process pool of this size (in memory backends only).
+        :return: Per patient a list of (disease, distance), empty if none of its HPO terms has an embedding.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer")
+        backend = self.get_search_backend(similarity)
+        chunks = [hpo_id_lists[start:start + chunk_size] for start in range(0, len(hpo_id_lists), chunk_size)]
+        metrics.count("batch_queries", len(hpo_id_lists), backend=backend.name)
+        with metrics.timer("query_many_seconds", backend=backend.name):
+            if n_processes and n_processes > 1 and len(chunks) > 1:
+                if isinstance(backend, ChromaSearchBackend):
+                    raise ValueError("process pool mode needs an in memory search backend, not chroma")
+                # the embeddings and backend are handed to each worker once, not per chunk
+                with ProcessPoolExecutor(n_processes, initializer=_init_query_worker,
+                                         initargs=(self.hp_embeddings, backend, self.data_processor.aggregation)) \
+                        as pool:
+                    chunk_results = list(pool.map(_query_chunk_in_worker, chunks, repeat(n_results)))
+            else:
+                chunk_results = [query_chunk(self.hp_embeddings, backend, chunk, n_results,
+                                             self.data_processor.aggregation) for chunk in chunks]
+        return [results for chunk in chunk_results for results in chunk]
 
     def query_with_custom_similarity_function(self, data1, data2):
         # Implementation using custom similarity measure
@@ -44,3 +201,65 @@ class QueryService:
             return self.similarity_strategy.calculate_similarity(data1, data2)
         else:
             raise ValueError("No similarity strategy provided")
+
+    def query_many_with_similarity_strategy(self, hpo_id_lists: List[List[str]], n_results: int,
+                                            similarity_strategy: Union[SimilarityService, str, None] = None,
+                                            block_size: int = DEFAULT_SIMILARITY_BLOCK_SIZE) -> Ranking:
+        """
+        Ranks all diseases in process with a SimilarityService strategy, e.g. best match average, without chroma.
+
+        :param hpo_id_lists: One list of HPO term IDs per patient.
+        :param n_results: number of results per patient
+        :param similarity_strategy: Strategy or its name (see SIMILARITY_STRATEGIES), defaults to the service's.
+        :param block_size: Diseases (or disease annotations for set based strategies) scored per block.
+        :return: Per patient a list of (disease, distance), empty if none of its HPO terms has an embedding.
+        """
+        strategy = similarity_strategy or self.similarity_strategy
+        if strategy is None:
+            raise ValueError("No similarity strategy provided")
+        if isinstance(strategy, str):
+            strategy = create_similarity_strategy(strategy)
+        disease_ids, disease_embeddings = self.data_processor.disease_average_embeddings()
+        with metrics.timer("query_many_seconds", backend=f"similarity:{strategy.name}"):
+            return strategy.rank(self.hp_embeddings, disease_ids, disease_embeddings,
+                                 self.data_processor.disease_incidence,
+                                 [canonical_hpo_ids(hpo_ids) for hpo_ids in hpo_id_lists], n_results,
+                                 self.data_processor.aggregation, block_size)
+
+    def query_with_similarity_strategy(self, hpo_ids: List[str], n_results: int,
+                                       similarity_strategy: Union[SimilarityService, str, None] = None) \
+            -> List[Tuple[str, float]]:
+        """
+        Single patient query_many_with_similarity_strategy.
+        """
+        return self.query_many_with_similarity_strategy([hpo_ids], n_results, similarity_strategy)[0]
+
+
+def canonical_hpo_ids(hpo_ids: List[str]) -> Tuple[str, ...]:
+    """ A query is a set of terms: sorted and without duplicates, so equal sets share cache entries. """
+    return tuple(sorted(set(hpo_ids)))
+
+
+def query_chunk(hp_embeddings: HPEmbeddings, backend: SearchBackend, hpo_id_lists: List[List[str]],
+                n_results: int, aggregation: Optional[AggregationStrategy] = None) -> List[List[Tuple[str, float]]]:
+    positions, averages = hp_embeddings.averages([canonical_hpo_ids(hpo_ids) for hpo_ids in hpo_id_lists],
+                                                 aggregation)
+    results = [[] for _ in hpo_id_lists]
+    if len(positions):
+        for position, ranked in zip(positions, backend.search(averages, n_results)):
+            results[position] = ranked
+    return results
+
+
+_worker_state = {}
+
+
+def _init_query_worker(hp_embeddings: HPEmbeddings, backend: SearchBackend, aggregation: AggregationStrategy):
+    _worker_state["hp_embeddings"] = hp_embeddings
+    _worker_state["backend"] = backend
+    _worker_state["aggregation"] = aggregation
+
+
+def _query_chunk_in_worker(hpo_id_lists: List[List[str]], n_results: int) -> List[List[Tuple[str, float]]]:
+    return query_chunk(_worker_state["hp_embeddings"], _worker_state["backend"], hpo_id_lists, n_results,
+                       _worker_state["aggregation"])
@@ -0,0 +1,258 @@
+import hashlib
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+import numpy as np
+
+from core.quantization import QuantizedMatrix
+from utils.similarity_measures import SimilarityMeasures
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+try:
+    import hnswlib
+except ImportError:  # optional, only needed for the hnsw backend
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+Results = List[List[Tuple[str, float]]]
+
+"""
+    Search backends that rank the disease average embeddings for a batch of query embeddings. Distances follow
+    chroma's definitions so every backend returns the same numbers for the same data:
+        cosine: 1 - cos(q, d)    l2: squared euclidean distance    ip: 1 - q.d
+"""
+
+
+class SearchBackend(ABC):
+    name = None
+
+    def __init__(self, similarity: SimilarityMeasures):
+        self.similarity = similarity
+
+    @abstractmethod
+    def search(self, query_embeddings: np.ndarray, n_results: int) -> Results:
+        """
+        :param query_embeddings: (n_queries, dim) array.
+        :param n_results: Number of diseases per query.
+        :return: Per query a list of (disease_id, distance) sorted by ascending distance.
+        """
+        pass
+
+
+class NumpySearchBackend(SearchBackend):
+    """
+        Exact brute force search over the in memory disease matrix: one matrix product per batch of queries and an
+        argpartition top-k, no round trip through chroma. With a compact storage the matrix is kept as float16 or
+        int8 codes and, if rerank is set, the top n_results * rerank candidates are re-scored against float32.
+    """
+    name = "numpy"
+
+    def __init__(self, disease_ids: List[str], disease_embeddings: np.ndarray, similarity: SimilarityMeasures,
+                 storage: str = "float32", rerank: int = 0):
+        """
+        :param storage: 'float32', 'float16' or 'int8', see core.quantization.
+        :param rerank: Candidate multiplier for the exact float32 re-rank of a compact matrix, 0 disables it. The
+            float32 matrix is kept alongside the codes while it is enabled.
+        """
+        super().__init__(similarity)
+        self.disease_ids = disease_ids
+        matrix = np.asarray(disease_embeddings, dtype=np.float32)
+        if similarity == SimilarityMeasures.COSINE:
+            matrix = normalize(matrix)
+        matrix = np.ascontiguousarray(matrix)
+        self.squared_norms = np.einsum("ij,ij->i", matrix, matrix)
+        self.matrix = QuantizedMatrix.quantize(matrix, storage)
+        self.rerank = rerank
+        self.exact_matrix = matrix if rerank and storage != "float32" else None
+
+    def distances(self, query_embeddings: np.ndarray) -> np.ndarray:
+        """
+        :return: (n_queries, n_diseases) distances in the backend's similarity space.
+        """
+        queries = self.prepare_queries(query_embeddings)
+        if isinstance(self.matrix, QuantizedMatrix):
+            products = self.matrix.products(queries)
+        else:
+            products = queries @ self.matrix.T
+        return self.to_distances(queries, products, self.squared_norms[None, :])
+
+    def prepare_queries(self, query_embeddings: np.ndarray) -> np.ndarray:
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        return normalize(queries) if self.similarity == SimilarityMeasures.COSINE else queries
+
+    def to_distances(self, queries: np.ndarray, products: np.ndarray, squared_norms: np.ndarray) -> np.ndarray:
+        if self.similarity == SimilarityMeasures.L2:
+            query_norms = np.einsum("ij,ij->i", queries, queries)
+            return np.maximum(query_norms[:, None] - 2 * products + squared_norms, 0)
+        return 1 - products
+
+    def search(self, query_embeddings: np.ndarray, n_results: int) -> Results:
+        distances = self.distances(query_embeddings)
+        if self.exact_matrix is not None:
+            return self.rerank_search(query_embeddings, distances, n_results)
+        rows, columns = top_k_smallest(distances, n_results)
+        return [[(self.disease_ids[j], float(distances[i, j])) for j in row] for i, row in zip(rows, columns)]
+
+    def rerank_search(self, query_embeddings: np.ndarray, distances: np.ndarray, n_results: int) -> Results:
+        """ Exact float32 distances for the best n_results * rerank candidates of the compact matrix. """
+        _, candidates = top_k_smallest(distances, n_results * self.rerank)
+        queries = self.prepare_queries(query_embeddings)
+        products = np.einsum("qkd,qd->qk", self.exact_matrix[candidates], queries)
+        exact = self.to_distances(queries, products, self.squared_norms[candidates])
+        rows, order = top_k_smallest(exact, n_results)
+        return [[(self.disease_ids[candidates[i, k]], float(exact[i, k])) for k in row] for i, row in zip(rows, order)]
+
+
+class HnswSearchBackend(SearchBackend):
+    """
+        Approximate search with an hnswlib index that is persisted next to the chroma db and rebuilt only when the
+        disease matrix changed.
+    """
+    name = "hnsw"
+
+    def __init__(self, disease_ids: List[str], disease_embeddings: np.ndarray, similarity: SimilarityMeasures,
+                 index_dir: Optional[str] = None, ef: int = 200, m: int = 16):
+        super().__init__(similarity)
+        if hnswlib is None:
+            raise ImportError("the hnsw search backend requires hnswlib (pip install hnswlib)")
+        self.disease_ids = disease_ids
+        matrix = np.ascontiguousarray(disease_embeddings, dtype=np.float32)
+        fingerprint = matrix_fingerprint(disease_ids, matrix)
+        index_path = os.path.join(index_dir, f"disease_index_{similarity.value}.bin") if index_dir else None
+        self.index = self.load_index(index_path, fingerprint, matrix.shape[1]) if index_path else None
+        if self.index is None:
+            self.index = self.build_index(matrix, m)
+            if index_path:
+                self.save_index(index_path, fingerprint)
+        self.index.set_ef(max(ef, 1))
+
+    def build_index(self, matrix: np.ndarray, m: int):
+        index = hnswlib.Index(space=self.similarity.value, dim=matrix.shape[1])
+        index.init_index(max_elements=max(len(matrix), 1), ef_construction=200, M=m)
+        if len(matrix):
+            index.add_items(matrix, np.arange(len(matrix)))
+        return index
+
+    def load_index(self, index_path: str, fingerprint: str, dim: int):
+        try:
+            with open(index_path + ".json", "r") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if meta.get("fingerprint") != fingerprint:
+            logger.info(f"Disease index {index_path} is stale, rebuilding")
+            return None
+        index = hnswlib.Index(space=self.similarity.value, dim=dim)
+        index.load_index(index_path, max_elements=max(len(self.disease_ids), 1))
+        return index
+
+    def save_index(self, index_path: str, fingerprint: str):
+        os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+        self.index.save_index(index_path)
+        with open(index_path + ".json", "w") as file:
+            json.dump({"fingerprint": fingerprint, "similarity": self.similarity.value}, file)
+
+    def search(self, query_embeddings: np.ndarray, n_results: int) -> Results:
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        k = min(n_results, len(self.disease_ids))
+        if k == 0:
+            return [[] for _ in queries]
+        self.index.set_ef(max(self.index.ef, k))
+        labels, distances = self.index.knn_query(queries, k=k)
+        return [[(self.disease_ids[j], float(d)) for j, d in zip(row_labels, row_distances)]
+                for row_labels, row_distances in zip(labels, distances)]
+
+
+class ChromaSearchBackend(SearchBackend):
+    """
+        Fallback that queries the DiseaseAvgEmbeddings collection, only distances are requested back.
+    """
+    name = "chroma"
+
+    def __init__(self, collection: "Collection", similarity: Optional[SimilarityMeasures] = None):
+        super().__init__(similarity or collection_similarity(collection))
+        self.collection = collection
+
+    def search(self, query_embeddings: np.ndarray, n_results: int) -> Results:
+        query_results = self.collection.query(
+            query_embeddings=np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)),
+            n_results=n_results,
+            include=["distances"]
+        )
+        ids = query_results.get('ids') or []
+        distances = query_results.get('distances') or []
+        return [sorted(zip(row_ids, row_distances), key=lambda x: x[1]) for row_ids, row_distances in
+                zip(ids, distances)]
+
+
+SEARCH_BACKENDS = ("chroma", "numpy", "hnsw")
+
+
+def create_search_backend(name: str, similarity: SimilarityMeasures, disease_ids: List[str] = None,
+                          disease_embeddings: np.ndarray = None, collection: "Collection" = None,
+                          index_dir: Optional[str] = None, storage: str = "float32", rerank: int = 0) -> SearchBackend:
+    """
+    :param name: One of SEARCH_BACKENDS.
+    :param similarity: Similarity measure the backend ranks by.
+    :param disease_ids: Disease IDs for the in memory backends.
+    :param disease_embeddings: Matrix aligned with disease_ids for the in memory backends.
+    :param collection: DiseaseAvgEmbeddings collection for the chroma backend.
+    :param index_dir: Where the hnsw backend persists its index, usually the chroma db path.
+    :param storage: Compact storage of the numpy backend's disease matrix, 'float32', 'float16' or 'int8'.
+    :param rerank: Exact float32 re-rank candidate multiplier for a compact numpy backend, 0 disables it.
+    """
+    if name == "numpy":
+        return NumpySearchBackend(disease_ids, disease_embeddings, similarity, storage=storage, rerank=rerank)
+    if name == "hnsw":
+        return HnswSearchBackend(disease_ids, disease_embeddings, similarity, index_dir=index_dir)
+    if name == "chroma":
+        if collection is None:
+            raise ValueError("the chroma search backend needs the disease_avg_embeddings collection")
+        if collection_similarity(collection) != similarity:
+            raise ValueError(f"collection {collection.name} uses {collection_similarity(collection).value}, "
+                             f"not {similarity.value}")
+        return ChromaSearchBackend(collection, similarity)
+    raise ValueError(f"Unknown search backend {name}, expected one of {SEARCH_BACKENDS}")
+
+
+def collection_similarity(collection: "Collection") -> SimilarityMeasures:
+    space = (collection.metadata or {}).get("hnsw:space", SimilarityMeasures.L2.value)  # chroma's default is l2
+    return SimilarityMeasures(space)
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k_smallest(values: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Row wise top-k of a 2d array with argpartition, sorted ascending (ties broken by column index).
+
+    :return: Row numbers and a (n_rows, k) array of column indices.
+    """
+    k = min(k, values.shape[1])
+    rows = np.arange(values.shape[0])
+    if k == 0:
+        return rows, np.empty((values.shape[0], 0), dtype=np.int64)
+    if k < values.shape[1]:
+        candidates = np.argpartition(values, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    candidate_values = np.take_along_axis(values, candidates, axis=1)
+    order = np.lexsort((candidates, candidate_values), axis=1)
+    return rows, np.take_along_axis(candidates, order, axis=1)
+
+
+def matrix_fingerprint(ids: List[str], matrix: np.ndarray) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update("\n".join(ids).encode())
+    digest.update(np.ascontiguousarray(matrix).tobytes())
+    return digest.hexdigest()
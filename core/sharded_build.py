@@ -0,0 +1,172 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from core.batch_upserter import BatchUpserter
+from core.embedding_matrix import DiseaseIncidence
+from core.quantization import QuantizedMatrix
+from utils.instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+    Sharded build of the disease average collection: diseases are split into shards of similar annotation counts,
+    a process pool averages the shards against one read only copy of the hp matrix (the snapshot's mmap file or a
+    shared memory block, never pickled per task) and the calling process is the single writer into the collection.
+    Completed shards are recorded in a checkpoint file so a crashed build resumes at the first unfinished shard.
+"""
+
+
+class ShardCheckpoint:
+    def __init__(self, path: Optional[str], build_key: str):
+        """
+        :param path: json file holding the build key and the completed shard numbers, None keeps it in memory.
+        :param build_key: Identifies the inputs and shard layout, a checkpoint of another build is ignored.
+        """
+        self.path = path
+        self.build_key = build_key
+        self.completed: Set[int] = self.load()
+
+    @classmethod
+    def for_collection(cls, db_path: Optional[str], collection_name: str, build_key: str) -> "ShardCheckpoint":
+        return cls(os.path.join(db_path, f"{collection_name}.shards.json") if db_path else None, build_key)
+
+    def load(self) -> Set[int]:
+        if not self.path or not os.path.exists(self.path):
+            return set()
+        try:
+            with open(self.path, "r") as file:
+                state = json.load(file)
+        except ValueError:
+            logger.warning(f"Ignoring unreadable shard checkpoint {self.path}")
+            return set()
+        if state.get("build_key") != self.build_key:
+            logger.info(f"Shard checkpoint {self.path} belongs to another build, starting over")
+            return set()
+        return set(state.get("completed", []))
+
+    def mark_completed(self, shard: int):
+        self.completed.add(shard)
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"build_key": self.build_key, "completed": sorted(self.completed)}, file)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        self.completed = set()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def build_key(disease_fingerprints: Dict[str, str], n_shards: int) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(n_shards).encode())
+    for disease, fingerprint in disease_fingerprints.items():
+        digest.update(f"{disease}={fingerprint};".encode())
+    return digest.hexdigest()
+
+
+_worker_state = {}
+
+
+def _attach_array(source: Tuple) -> np.ndarray:
+    kind, name, offset, shape, dtype = source
+    if kind == "mmap":
+        return np.memmap(name, dtype=dtype, mode="r", offset=offset, shape=shape)
+    block = shared_memory.SharedMemory(name=name)
+    _worker_state.setdefault("blocks", []).append(block)  # the array is only valid while the block stays open
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array.flags.writeable = False
+    return array
+
+
+def _attach_matrix(source: Tuple):
+    """ Pool initializer: maps the hp matrix (or a QuantizedMatrix's codes and scales) once per worker, read only. """
+    quantized, array_sources = source
+    arrays = [_attach_array(array_source) for array_source in array_sources]
+    _worker_state["matrix"] = QuantizedMatrix(*arrays) if quantized else arrays[0]
+
+
+def _average_shard(shard: int, incidence: DiseaseIncidence) -> Tuple[int, np.ndarray]:
+    return shard, incidence.means(_worker_state["matrix"])
+
+
+def _share_array(array: np.ndarray) -> Tuple[Tuple, Optional[shared_memory.SharedMemory]]:
+    if isinstance(array, np.memmap) and array.filename and array.flags.c_contiguous:
+        return ("mmap", array.filename, array.offset, array.shape, array.dtype.str), None
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+    return ("shm", block.name, 0, array.shape, array.dtype.str), block
+
+
+def shared_matrix_source(
+        matrix: Union[np.ndarray, QuantizedMatrix]) -> Tuple[Tuple, List[shared_memory.SharedMemory]]:
+    """
+    A QuantizedMatrix shares its codes and scales as they are, workers dequantize the rows they read.
+
+    :return: How workers find the matrix (whether it is quantized and, per array, ('mmap', file, offset, shape,
+        dtype) or ('shm', name, 0, shape, dtype)), and the shared memory blocks the caller has to close and unlink.
+    """
+    quantized = isinstance(matrix, QuantizedMatrix)
+    if quantized:
+        arrays = [matrix.codes] if matrix.scales is None else [matrix.codes, matrix.scales]
+    else:
+        arrays = [matrix]
+    sources, blocks = [], []
+    for array in arrays:
+        source, block = _share_array(array)
+        sources.append(source)
+        if block is not None:
+            blocks.append(block)
+    return (quantized, tuple(sources)), blocks
+
+
+def sharded_build(upserter: BatchUpserter, incidence: DiseaseIncidence, matrix: Union[np.ndarray, QuantizedMatrix],
+                  metadata: Dict, checkpoint: ShardCheckpoint, n_shards: int,
+                  n_processes: Optional[int] = None) -> List[int]:
+    """
+    Averages and upserts all diseases of the incidence matrix shard by shard, skipping shards the checkpoint
+    already has. The checkpoint is removed once every shard is written.
+
+    :param upserter: Writer into the disease collection, only used from this process.
+    :param matrix: The hp embedding matrix (or QuantizedMatrix) the incidence indices point into.
+    :param n_processes: Pool size, None or 1 averages the shards in this process.
+    :return: Shard numbers built by this call.
+    """
+    bounds = incidence.shard_bounds(n_shards)
+    pending = [shard for shard in range(len(bounds)) if shard not in checkpoint.completed]
+    if len(pending) < len(bounds):
+        logger.info(f"Resuming sharded build, {len(bounds) - len(pending)} of {len(bounds)} shards already done")
+
+    def write(shard: int, averages: np.ndarray):
+        start, end = bounds[shard]
+        upserter.upsert_arrays(incidence.disease_ids[start:end], averages, [metadata] * (end - start))
+        checkpoint.mark_completed(shard)
+        metrics.count("built_shards")
+
+    if not n_processes or n_processes <= 1:
+        for shard in pending:
+            write(shard, incidence.shard(*bounds[shard]).means(matrix))
+    elif pending:
+        source, blocks = shared_matrix_source(matrix)
+        try:
+            with ProcessPoolExecutor(n_processes, initializer=_attach_matrix, initargs=(source,)) as pool:
+                futures = [pool.submit(_average_shard, shard, incidence.shard(*bounds[shard])) for shard in pending]
+                # shards are written in completion order, the checkpoint is a set so order does not matter
+                for future in as_completed(futures):
+                    write(*future.result())
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    checkpoint.remove()
+    return pending
@@ -1,15 +1,77 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Optional, Tuple
+
 import numpy as np
 
+from core.embedding_matrix import DiseaseIncidence, HPEmbeddings
+from core.search_backends import normalize, top_k_smallest
+
+"""
+    Similarity strategies that rank the whole disease corpus in process. Every strategy scores a batch of queries
+    against all diseases as a (n_queries, n_diseases) distance matrix, smaller is closer, computed in blocks of
+    diseases while a running top-k is kept, so memory stays bounded by n_queries x block size. The vector strategies
+    compare averaged embeddings and use chroma's distance definitions (cosine: 1 - cos, l2: squared euclidean,
+    ip: 1 - q.d), best match average compares the individual hp embeddings of both sides.
+"""
+
+# diseases (vector strategies) or disease annotations (best match average) scored per block
+DEFAULT_SIMILARITY_BLOCK_SIZE = 8192
+
+Ranking = List[List[Tuple[str, float]]]
+
 
 class SimilarityService(ABC):
+    name = None
+
     @abstractmethod
     def calculate_similarity(self, vector_a: List[float], vector_b: List[float]) -> float:
         pass
 
+    @abstractmethod
+    def distances(self, queries: np.ndarray, diseases: np.ndarray) -> np.ndarray:
+        """
+        :param queries: (n_queries, dim) array.
+        :param diseases: (n_diseases, dim) array.
+        :return: (n_queries, n_diseases) distances, smaller is closer.
+        """
+        pass
+
+    def top_k(self, queries: np.ndarray, diseases: np.ndarray, k: int,
+              block_size: int = DEFAULT_SIMILARITY_BLOCK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (n_queries, k) disease row indices and their distances, ascending.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        top = TopK(len(queries), k)
+        for start in range(0, len(diseases), block_size):
+            top.add(start, self.distances(queries, np.asarray(diseases[start:start + block_size], dtype=np.float32)))
+        return top.indices, top.values
+
+    def rank(self, hp_embeddings: HPEmbeddings, disease_ids: List[str], disease_embeddings: np.ndarray,
+             incidence: DiseaseIncidence, hpo_id_lists: List[List[str]], n_results: int, aggregation=None,
+             block_size: int = DEFAULT_SIMILARITY_BLOCK_SIZE) -> Ranking:
+        """
+        Ranks all diseases for every query.
+
+        :param disease_ids: Disease IDs aligned with disease_embeddings and incidence.
+        :param disease_embeddings: (n_diseases, dim) disease averages.
+        :param incidence: Disease x HP incidence, used by set based strategies.
+        :param hpo_id_lists: One list of HPO IDs per query.
+        :param aggregation: AggregationStrategy weighting the query averages, None is a plain mean.
+        :return: Per query a list of (disease, distance), empty if none of its HPO IDs has an embedding.
+        """
+        positions, averages = hp_embeddings.averages(hpo_id_lists, aggregation)
+        results = [[] for _ in hpo_id_lists]
+        if len(positions):
+            indices, values = self.top_k(averages, disease_embeddings, n_results, block_size)
+            for position, row, distances in zip(positions, indices, values):
+                results[position] = [(disease_ids[j], float(d)) for j, d in zip(row.tolist(), distances.tolist())]
+        return results
+
 
 class CosineSimilarity(SimilarityService):
+    name = "cosine"
+
     def calculate_similarity(self, vector_a: List[float], vector_b: List[float]) -> float:
         """ Calculate the cosine similarity between two vectors. """
         dot_product = np.dot(vector_a, vector_b)
@@ -17,9 +79,127 @@ class CosineSimilarity(SimilarityService):
         norm_b = np.linalg.norm(vector_b)
         return dot_product / (norm_a * norm_b)
 
+    def distances(self, queries: np.ndarray, diseases: np.ndarray) -> np.ndarray:
+        return 1 - normalize(queries) @ normalize(diseases).T
+
 
 class L2Distance(SimilarityService):
+    name = "l2"
+
     def calculate_similarity(self, vector_a: List[float], vector_b: List[float]) -> float:
-        # Implement L2 distance calculation
-        raise NotImplementedError
+        """ Euclidean distance between two vectors, rankings use its square like chroma. """
+        return float(np.linalg.norm(np.asarray(vector_a, dtype=np.float64) - np.asarray(vector_b, dtype=np.float64)))
+
+    def distances(self, queries: np.ndarray, diseases: np.ndarray) -> np.ndarray:
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        disease_norms = np.einsum("ij,ij->i", diseases, diseases)
+        return np.maximum(query_norms[:, None] - 2 * queries @ diseases.T + disease_norms[None, :], 0)
+
+
+class InnerProduct(SimilarityService):
+    name = "ip"
+
+    def calculate_similarity(self, vector_a: List[float], vector_b: List[float]) -> float:
+        """ Dot product of two vectors. """
+        return float(np.dot(vector_a, vector_b))
+
+    def distances(self, queries: np.ndarray, diseases: np.ndarray) -> np.ndarray:
+        return 1 - queries @ diseases.T
+
+
+class BestMatchAverage(SimilarityService):
+    """
+        Set based similarity: every query HP is matched with its most similar HP of the disease and vice versa, the
+        score is the mean of both directions' average best match (cosine between hp embeddings). Unlike comparing
+        averages, one very specific shared term is not diluted by the rest of either profile. Annotation weights of
+        the aggregation strategy are not applied, repeated disease annotations count repeatedly.
+    """
+    name = "bma"
+
+    def calculate_similarity(self, vector_a: List[float], vector_b: List[float]) -> float:
+        """ BMA similarity of two sets of hp embeddings, (n, dim) and (m, dim). """
+        return 1 - self.distances(np.atleast_2d(vector_a), np.atleast_2d(vector_b))[0, 0]
+
+    def distances(self, queries: np.ndarray, diseases: np.ndarray) -> np.ndarray:
+        """
+        :param queries: One set of hp embeddings, (n, dim).
+        :param diseases: One set of hp embeddings, (m, dim).
+        :return: (1, 1) array with 1 - BMA.
+        """
+        incidence = DiseaseIncidence(["disease"], np.array([0, len(diseases)], dtype=np.int64),
+                                     np.arange(len(diseases), dtype=np.int64))
+        return 1 - self.scores(normalize(np.asarray(queries, dtype=np.float32)), normalize(
+            np.asarray(diseases, dtype=np.float32)), incidence)[None, :]
+
+    @staticmethod
+    def scores(query: np.ndarray, hp_rows: np.ndarray, incidence: DiseaseIncidence) -> np.ndarray:
+        """
+        :param query: Normalized hp embeddings of one query, (n, dim).
+        :param hp_rows: Normalized hp embeddings of the incidence's annotations, aligned with incidence.indices.
+        :param incidence: Diseases to score, its indptr segments hp_rows.
+        :return: BMA per disease.
+        """
+        similarities = query @ hp_rows.T  # (n, annotations)
+        starts = incidence.indptr[:-1]
+        query_to_disease = np.maximum.reduceat(similarities, starts, axis=1).mean(axis=0)
+        disease_to_query = np.add.reduceat(similarities.max(axis=0), starts) / incidence.counts
+        return (query_to_disease + disease_to_query) / 2
+
+    def rank(self, hp_embeddings: HPEmbeddings, disease_ids: List[str], disease_embeddings: np.ndarray,
+             incidence: DiseaseIncidence, hpo_id_lists: List[List[str]], n_results: int, aggregation=None,
+             block_size: int = DEFAULT_SIMILARITY_BLOCK_SIZE) -> Ranking:
+        queries = [hp_embeddings.rows(hpo_ids) for hpo_ids in hpo_id_lists]
+        known = [position for position, rows in enumerate(queries) if len(rows)]
+        results = [[] for _ in hpo_id_lists]
+        if not known or not len(incidence):
+            return results
+        query_embeddings = [normalize(np.asarray(hp_embeddings.matrix[queries[position]], dtype=np.float32))
+                            for position in known]
+        top = TopK(len(known), n_results)
+        # diseases in blocks of about block_size annotations, the hp rows of a block are gathered once for all queries
+        for start, end in incidence.shard_bounds(max(1, -(-len(incidence.indices) // block_size))):
+            block = incidence.shard(start, end)
+            hp_rows = normalize(np.asarray(hp_embeddings.matrix[block.indices], dtype=np.float32))
+            top.add(start, 1 - np.stack([self.scores(query, hp_rows, block) for query in query_embeddings]))
+        for position, row, distances in zip(known, top.indices, top.values):
+            results[position] = [(disease_ids[j], float(d)) for j, d in zip(row.tolist(), distances.tolist())]
+        return results
+
+
+class TopK:
+    """
+        Running row wise top-k over column blocks of a distance matrix that is never materialized as a whole.
+    """
+
+    def __init__(self, n_rows: int, k: int):
+        self.k = k
+        self.indices = np.empty((n_rows, 0), dtype=np.int64)
+        self.values = np.empty((n_rows, 0), dtype=np.float32)
+
+    def add(self, offset: int, distances: np.ndarray):
+        """
+        :param offset: Column of distances[:, 0] in the full matrix.
+        :param distances: (n_rows, block) distances.
+        """
+        values = np.concatenate([self.values, distances.astype(np.float32, copy=False)], axis=1)
+        indices = np.concatenate([self.indices, np.broadcast_to(
+            np.arange(offset, offset + distances.shape[1], dtype=np.int64), distances.shape)], axis=1)
+        # ties are broken by the block column, same as top_k_smallest over the full matrix since earlier blocks come
+        # first and keep their order
+        rows, columns = top_k_smallest(values, self.k)
+        self.indices = indices[rows[:, None], columns]
+        self.values = values[rows[:, None], columns]
+
+
+SIMILARITY_STRATEGIES = {strategy.name: strategy for strategy in
+                         (CosineSimilarity, L2Distance, InnerProduct, BestMatchAverage)}
+
 
+def create_similarity_strategy(name: Optional[str] = None) -> SimilarityService:
+    """
+    :param name: One of SIMILARITY_STRATEGIES, cosine by default.
+    """
+    name = name or CosineSimilarity.name
+    if name not in SIMILARITY_STRATEGIES:
+        raise ValueError(f"Unknown similarity strategy {name}, expected one of {list(SIMILARITY_STRATEGIES)}")
+    return SIMILARITY_STRATEGIES[name]()
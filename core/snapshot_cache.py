@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+import numpy as np
+
+from core.embedding_matrix import HPEmbeddings
+from core.hpoa_reader import HPOAAnnotations
+from core.quantization import QuantizedMatrix, load_matrix
+from utils.atomic_directory import atomic_directory
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+logger = logging.getLogger(__name__)
+
+# bump whenever the on disk layout changes, older snapshots are then ignored
+SNAPSHOT_VERSION = 3
+
+ANNOTATION_COLUMNS = ("disease", "hpo", "negated", "frequency", "onset", "aspect")
+
+"""
+    On disk snapshot of what DataProcessor reads from ont_hp and hpoa: the HP embedding matrix as .npy, in the
+    processor's compact storage if it uses one (memory mapped on load, so several worker processes share the same
+    pages), the HPO id index and the columnar hpoa annotations (interned codes, qualifier, frequency, onset, aspect)
+    as .npy arrays. A snapshot lives in its own directory named after a key of its storage, its sources (which
+    collections or hpoa file) and their content (counts, last write sequence numbers and sampled records), a changed
+    source collection therefore simply misses the cache. Saving a snapshot removes the older ones of the same storage
+    and sources, which can't be hit anymore.
+"""
+
+
+class SnapshotCache:
+    def __init__(self, directory: str, mmap: bool = True):
+        """
+        :param directory: Where snapshots are stored, usually <chroma_db_path>/snapshots.
+        :param mmap: Memory map the embedding matrix instead of reading it into memory.
+        """
+        self.directory = directory
+        self.mmap = mmap
+
+    @staticmethod
+    def key_for(ont_hp: "Collection", hpoa: Optional["Collection"], hpoa_path: Optional[str] = None,
+                hpoa_databases: Optional[List[str]] = None, samples: int = 8, storage: str = "float32",
+                db_path: Optional[str] = None) -> str:
+        """
+        Cheap cache key: count, the ids, metadata and embeddings of a few evenly spaced records and the last write
+        sequence number of each collection, so computing it doesn't need the full collection scan the snapshot is
+        meant to avoid. The sequence number catches edits the samples miss, when the client isn't a local sqlite db
+        the key falls back to the samples. When the annotations come from an hpoa file its path, size and mtime
+        replace the hpoa collection. Compact storages get their own snapshots, a quantized matrix is never widened
+        back to float32.
+
+        :param db_path: Directory of a persistent chroma db, to read the write sequence numbers from.
+        :return: '<storage>-<sources hash>-<content hash>'
+        """
+        hpoa_source = f"{os.path.abspath(hpoa_path)}:{hpoa_databases}" if hpoa_path else hpoa.name
+        sources = hashlib.blake2b(f"{ont_hp.name}:{hpoa_source}".encode(), digest_size=6).hexdigest()
+        digest = hashlib.blake2b(digest_size=12)
+        if hpoa_path:
+            stat = os.stat(hpoa_path)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        for collection in (ont_hp,) if hpoa_path else (ont_hp, hpoa):
+            count = collection.count()
+            digest.update(f"{collection.name}:{count}:{last_write(db_path, collection)}".encode())
+            for offset in sorted({count * i // samples for i in range(samples)} | {max(count - 1, 0)}):
+                if count == 0:
+                    break
+                record = collection.get(limit=1, offset=offset, include=["metadatas", "embeddings"])
+                digest.update(json.dumps([record["ids"], record["metadatas"]], sort_keys=True).encode())
+                if record["embeddings"] is not None and len(record["embeddings"]):
+                    digest.update(np.asarray(record["embeddings"], dtype=np.float32).tobytes())
+        return f"{storage}-{sources}-{digest.hexdigest()}"
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, f"snapshot-v{SNAPSHOT_VERSION}-{key}")
+
+    def load(self, key: str) -> Optional[Tuple[HPEmbeddings, HPOAAnnotations]]:
+        """
+        :return: (hp_embeddings, annotations) or None if there is no snapshot for this key.
+        """
+        path = self.path_for(key)
+        try:
+            with open(os.path.join(path, "index.json"), "r") as file:
+                index = json.load(file)
+            if index.get("version") != SNAPSHOT_VERSION:
+                return None
+            matrix = load_matrix(path, "hp_matrix", mmap=self.mmap)
+            columns = {column: np.load(os.path.join(path, f"annotation_{column}.npy"))
+                       for column in ANNOTATION_COLUMNS}
+        except (OSError, ValueError):
+            return None
+        hp_ids = index["hp_ids"]
+        hp_embeddings = HPEmbeddings({hp_id: row for row, hp_id in enumerate(hp_ids)}, matrix)
+        annotations = HPOAAnnotations(index["disease_values"], index["disease_names"], index["hpo_values"],
+                                      index["onset_values"], index["aspect_values"], **columns)
+        logger.info(f"Loaded snapshot {path}")
+        return hp_embeddings, annotations
+
+    def save(self, key: str, hp_embeddings: HPEmbeddings, annotations: HPOAAnnotations) -> str:
+        """
+        Writes the snapshot directory, replacing an older one, see atomic_directory.
+
+        :return: The snapshot directory.
+        """
+        path = self.path_for(key)
+        with atomic_directory(path) as tmp_path:
+            if isinstance(hp_embeddings.matrix, QuantizedMatrix):
+                hp_embeddings.matrix.save(tmp_path, "hp_matrix")
+            else:
+                np.save(os.path.join(tmp_path, "hp_matrix.npy"), np.ascontiguousarray(hp_embeddings.matrix))
+            for column in ANNOTATION_COLUMNS:
+                np.save(os.path.join(tmp_path, f"annotation_{column}.npy"), getattr(annotations, column))
+            with open(os.path.join(tmp_path, "index.json"), "w") as file:
+                json.dump({"version": SNAPSHOT_VERSION, "key": key, "hp_ids": hp_embeddings.ids,
+                           "disease_values": annotations.disease_values, "disease_names": annotations.disease_names,
+                           "hpo_values": annotations.hpo_values, "onset_values": annotations.onset_values,
+                           "aspect_values": annotations.aspect_values}, file)
+        self.prune(key)
+        logger.info(f"Saved snapshot {path}")
+        return path
+
+    def prune(self, key: str):
+        """ Removes snapshots of other versions and the older snapshots of key's storage and sources. """
+        prefix = "snapshot-v"
+        stale_prefix = os.path.basename(self.path_for(key.rsplit("-", 1)[0])) + "-"
+        current = os.path.basename(self.path_for(key))
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix) or name == current:
+                continue
+            if name.startswith(stale_prefix) or not name.startswith(f"{prefix}{SNAPSHOT_VERSION}-"):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+                logger.info(f"Removed stale snapshot {name}")
+
+
+def last_write(db_path: Optional[str], collection: "Collection") -> Optional[int]:
+    """
+    Highest write sequence number chroma recorded for the collection's segments, it grows with every upsert and
+    delete. Read from the sqlite file of a persistent db, None if there is none or its layout is unknown.
+    """
+    sqlite_path = os.path.join(db_path, "chroma.sqlite3") if db_path else None
+    if not sqlite_path or not os.path.exists(sqlite_path):
+        return None
+    try:
+        connection = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+        try:
+            row = connection.execute("SELECT MAX(m.seq_id) FROM max_seq_id m JOIN segments s ON m.segment_id = s.id "
+                                     "WHERE s.collection = ?", (str(collection.id),)).fetchone()
+        finally:
+            connection.close()
+    except (sqlite3.Error, AttributeError):
+        return None
+    return row[0] if row else None
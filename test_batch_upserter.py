@@ -0,0 +1,234 @@
+import os
+
+import numpy as np
+import pytest
+
+from core.aggregation import create_aggregation_strategy
+from core.batch_upserter import BatchUpserter
+from core.data_processor import DataProcessor
+from core.disease_archive import DiseaseAverageArchive
+from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
+from core.hp_embedding_service import HPEmbeddingService
+from core.main import Main
+from core.quantization import QuantizedMatrix
+from core.sharded_build import _attach_matrix, _worker_state, shared_matrix_source
+
+
+class RecordingCollection:
+    name = "recording"
+
+    def __init__(self, fail_on_batch=None):
+        self.batches = []
+        self.fail_on_batch = fail_on_batch
+
+    def upsert(self, ids, embeddings, metadatas):
+        if self.fail_on_batch == len(self.batches):
+            raise RuntimeError("write failed")
+        self.batches.append(list(ids))
+
+
+@pytest.mark.parametrize("use_writer_thread", [False, True])
+def test_upsert_is_chunked_to_batch_size(use_writer_thread):
+    collection = RecordingCollection()
+    progress = []
+    upserter = BatchUpserter(collection, batch_size=4, use_writer_thread=use_writer_thread,
+                             progress_callback=lambda done, total: progress.append((done, total)))
+    stats = upserter.upsert(((str(i), [float(i)], {}) for i in range(10)), total=10)
+
+    assert [len(batch) for batch in collection.batches] == [4, 4, 2]
+    assert [i for batch in collection.batches for i in batch] == [str(i) for i in range(10)]
+    assert stats.rows == 10 and stats.batches == 3
+    assert progress[-1] == (10, 10)
+
+
+def test_batch_size_is_capped_by_client_limit():
+    upserter = BatchUpserter(RecordingCollection(), batch_size=10_000, max_batch_size=100)
+    assert upserter.batch_size == 100
+
+
+def test_upsert_arrays_slices_columns():
+    collection = RecordingCollection()
+    BatchUpserter(collection, batch_size=3).upsert_arrays([str(i) for i in range(7)], np.zeros((7, 2)))
+    assert [len(batch) for batch in collection.batches] == [3, 3, 1]
+
+
+def test_writer_thread_errors_are_raised():
+    upserter = BatchUpserter(RecordingCollection(fail_on_batch=1), batch_size=2, use_writer_thread=True)
+    with pytest.raises(RuntimeError):
+        upserter.upsert((str(i), [0.0], {}) for i in range(10))
+
+
+def test_services_upsert_everything(synthetic_data_processor):
+    hp_collection = HPEmbeddingService(synthetic_data_processor, batch_size=7).process_data()
+    disease_collection = DiseaseAvgEmbeddingService(synthetic_data_processor, batch_size=7,
+                                                    use_writer_thread=True).process_data()
+
+    assert hp_collection.count() == len(synthetic_data_processor.hp_embeddings)
+    assert disease_collection.count() == len(synthetic_data_processor.disease_to_hps)
+
+
+def test_incremental_rebuild_only_touches_changed_diseases(synthetic_data_processor):
+    service = DiseaseAvgEmbeddingService(synthetic_data_processor)
+    collection = service.process_data(incremental=True)
+    hpoa = synthetic_data_processor.db_manager.hpoa
+    changed, removed = list(synthetic_data_processor.disease_to_hps)[:2]
+    record_ids = hpoa.get(include=[])["ids"]
+    changed_rows = [record_id for record_id in record_ids if record_id.startswith("0-")]
+    removed_rows = [record_id for record_id in record_ids if record_id.startswith("1-")]
+    hpoa.delete(ids=changed_rows[1:] + removed_rows)
+    synthetic_data_processor.load()
+
+    upserted = []
+    service.create_upserter = lambda c: BatchUpserter(RecordingCollectionProxy(c, upserted))
+    service.process_data(incremental=True)
+
+    disease_to_hps = synthetic_data_processor.disease_to_hps
+    assert upserted == [changed]
+    assert removed not in disease_to_hps
+    assert collection.count() == len(disease_to_hps)
+    expected = synthetic_data_processor.hp_embeddings[disease_to_hps[changed][0]]['embeddings']
+    stored = collection.get(ids=[changed], include=["embeddings"])["embeddings"][0]
+    assert np.allclose(stored, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_full_rebuild_records_fingerprints_for_incremental_builds(synthetic_db_manager, sharded):
+    mean_processor = DataProcessor(synthetic_db_manager)
+    DiseaseAvgEmbeddingService(mean_processor).process_data(incremental=True)
+    ic_service = DiseaseAvgEmbeddingService(DataProcessor(synthetic_db_manager,
+                                                          aggregation=create_aggregation_strategy({"strategy": "ic"})))
+    if sharded:
+        ic_service.process_data_sharded(n_shards=3)
+    else:
+        ic_service.process_data()
+    collection = DiseaseAvgEmbeddingService(mean_processor).process_data(incremental=True)
+
+    disease_ids, averages = mean_processor.disease_average_embeddings()
+    stored = collection.get(ids=disease_ids, include=["embeddings"])
+    stored = dict(zip(stored["ids"], stored["embeddings"]))
+    assert np.allclose([stored[disease] for disease in disease_ids], averages, atol=1e-6)
+
+
+class RecordingCollectionProxy:
+    def __init__(self, collection, upserted):
+        self.collection = collection
+        self.name = collection.name
+        self.upserted = upserted
+        self.fail_after = None
+        self.calls = 0
+
+    def upsert(self, ids, embeddings, metadatas):
+        if self.fail_after is not None and self.calls == self.fail_after:
+            raise RuntimeError("write failed")
+        self.calls += 1
+        self.upserted.extend(ids)
+        self.collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas)
+
+
+@pytest.mark.parametrize("n_processes", [None, 2])
+def test_sharded_build_matches_and_resumes(synthetic_data_processor, n_processes):
+    service = DiseaseAvgEmbeddingService(synthetic_data_processor)
+    collection = service.disease_avg_embeddings_collection
+    disease_ids, averages = synthetic_data_processor.disease_average_embeddings()
+
+    upserted = []
+    proxy = RecordingCollectionProxy(collection, upserted)
+    proxy.fail_after = 2
+    service.create_upserter = lambda c: BatchUpserter(proxy)
+    with pytest.raises(RuntimeError):
+        service.process_data_sharded(n_shards=5, n_processes=n_processes)
+    first_run = list(upserted)
+
+    proxy.fail_after = None
+    upserted.clear()
+    service.process_data_sharded(n_shards=5, n_processes=n_processes)
+
+    assert not set(first_run) & set(upserted)
+    assert sorted(first_run + upserted) == sorted(disease_ids)
+    stored = collection.get(ids=disease_ids, include=["embeddings"])
+    stored = dict(zip(stored["ids"], stored["embeddings"]))
+    assert np.allclose([stored[disease] for disease in disease_ids], averages, atol=1e-6)
+
+
+def test_sharded_build_is_not_incremental(tmp_path, synthetic_db_manager):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(f"chroma_db_path: {synthetic_db_manager.path}\n")
+    with pytest.raises(ValueError):
+        Main(config_path=str(config_path)).setup_collections(incremental=True, n_shards=4)
+    assert sorted(collection.name for collection in synthetic_db_manager.list_collections()) == ["hpoa", "ont_hp"]
+
+
+@pytest.mark.parametrize("storage", ["float16", "int8"])
+def test_sharded_build_shares_quantized_codes(synthetic_db_manager, storage):
+    processor = DataProcessor(synthetic_db_manager, storage=storage)
+    matrix = processor.hp_matrix
+    source, blocks = shared_matrix_source(matrix)
+    try:
+        assert sum(block.size for block in blocks) < matrix.shape[0] * matrix.shape[1] * 4
+        _attach_matrix(source)
+        attached = _worker_state["matrix"]
+        assert isinstance(attached, QuantizedMatrix) and attached.storage == storage
+        assert np.array_equal(np.asarray(attached), np.asarray(matrix))
+    finally:
+        for block in _worker_state.pop("blocks", []) + blocks:
+            block.close()
+        for block in blocks:
+            block.unlink()
+
+    service = DiseaseAvgEmbeddingService(processor)
+    service.process_data_sharded(n_shards=3, n_processes=2)
+    disease_ids, averages = processor.disease_average_embeddings()
+    stored = service.disease_avg_embeddings_collection.get(ids=disease_ids, include=["embeddings"])
+    stored = dict(zip(stored["ids"], stored["embeddings"]))
+    assert np.allclose([stored[disease] for disease in disease_ids], averages, atol=1e-6)
+
+
+@pytest.mark.parametrize("storage", ["float32", "int8"])
+def test_disease_archive_round_trip(tmp_path, synthetic_data_processor, storage):
+    db_manager = synthetic_data_processor.db_manager
+    disease_ids, averages = synthetic_data_processor.disease_average_embeddings()
+    path = DiseaseAverageArchive.from_data_processor(synthetic_data_processor).save(str(tmp_path / "export"), storage)
+    archive = DiseaseAverageArchive.load(path, expected_dim=synthetic_data_processor.hp_embeddings.dim)
+
+    assert archive.disease_ids == disease_ids and archive.storage == storage
+    assert np.array_equal(archive.hp_counts, synthetic_data_processor.disease_incidence.counts)
+    collection = archive.to_collection(db_manager, "DiseaseAvgEmbeddingsImported", batch_size=4)
+    stored = collection.get(include=["embeddings"])
+    stored = dict(zip(stored["ids"], stored["embeddings"]))
+    assert sorted(stored) == sorted(disease_ids)
+    assert np.allclose([stored[disease] for disease in disease_ids], averages,
+                       atol=0.02 if storage == "int8" else 1e-6)
+    with pytest.raises(ValueError):
+        archive.to_collection(db_manager, "DiseaseAvgEmbeddingsImported")
+
+    exported = DiseaseAverageArchive.from_collection(collection, page_size=7)
+    assert sorted(exported.disease_ids) == sorted(disease_ids) and (exported.hp_counts == -1).all()
+    with pytest.raises(ValueError):
+        DiseaseAverageArchive.load(path, expected_dim=synthetic_data_processor.hp_embeddings.dim + 1)
+    with open(tmp_path / "export" / "hp_counts.npy", "r+b") as file:
+        file.seek(-1, 2)
+        file.write(b"\xff")
+    with pytest.raises(ValueError):
+        DiseaseAverageArchive.load(path)
+
+
+def test_import_resets_incremental_build_state(tmp_path, synthetic_db_manager):
+    mean_processor = DataProcessor(synthetic_db_manager)
+    service = DiseaseAvgEmbeddingService(mean_processor)
+    collection = service.process_data(incremental=True)
+    checkpoint = os.path.join(synthetic_db_manager.path, f"{collection.name}.shards.json")
+    open(checkpoint, "w").close()
+    ic_processor = DataProcessor(synthetic_db_manager, aggregation=create_aggregation_strategy({"strategy": "ic"}))
+    archive = DiseaseAverageArchive.from_data_processor(ic_processor)
+    archive.disease_ids = archive.disease_ids[:-1] + ["OMIM:imported"]  # a disease the local data doesn't have
+    # the handle Main.import_disease_averages swaps in
+    synthetic_db_manager.variant().collections["disease_avg_embeddings"] = archive.to_collection(
+        synthetic_db_manager, collection.name, replace=True)
+
+    assert not os.path.exists(checkpoint)
+    collection = service.process_data(incremental=True)
+    disease_ids, averages = mean_processor.disease_average_embeddings()
+    stored = collection.get(include=["embeddings"])
+    stored = dict(zip(stored["ids"], stored["embeddings"]))
+    assert sorted(stored) == sorted(disease_ids)
+    assert np.allclose([stored[disease] for disease in disease_ids], averages, atol=1e-6)
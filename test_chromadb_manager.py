@@ -3,7 +3,11 @@ from typing import Collection
 import numpy as np
 import pytest
 
+from core.aggregation import InformationContentAggregation, create_aggregation_strategy
 from core.chromadb_manager import ChromaDBManager
+from core.data_processor import DataProcessor
+from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
+from utils.similarity_measures import SimilarityMeasures
 
 
 @pytest.fixture
@@ -30,6 +34,51 @@ def cached_dict():
     }
 
 
+def test_variants_share_client_and_open_lazily(tmp_path, synthetic_db_manager):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(f"chroma_db_path: {synthetic_db_manager.path}\n"
+                           "variants:\n  l2_ic:\n    similarity: l2\n    aggregation: ic\n")
+    manager = ChromaDBManager(config_path=str(config_path))
+    variant = manager.variant("l2_ic")
+
+    assert variant.collections == {}
+    assert manager.find_variant(similarity=SimilarityMeasures.L2, aggregation="ic") is variant
+    processor = DataProcessor(variant, aggregation=create_aggregation_strategy(variant.aggregation))
+    assert set(variant.collections) == {"ont_hp", "hpoa"}
+    assert isinstance(processor.aggregation, InformationContentAggregation)
+
+    collection = DiseaseAvgEmbeddingService(processor).process_data()
+    assert collection.name == "DiseaseAvgEmbeddings_l2_ic"
+    assert collection.metadata["hnsw:space"] == "l2"
+    assert manager.client.get_collection("DiseaseAvgEmbeddings_l2_ic").count() == len(processor.disease_to_hps)
+    with pytest.raises(ValueError):
+        manager.variant("missing")
+
+
+def test_variants_inherit_exclude_negated(tmp_path, synthetic_db_manager):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(f"chroma_db_path: {synthetic_db_manager.path}\n"
+                           "aggregation:\n  strategy: mean\n  exclude_negated: true\n"
+                           "variants:\n  ic:\n    aggregation: ic\n  frequency_all:\n"
+                           "    aggregation:\n      strategy: frequency\n      exclude_negated: false\n")
+    manager = ChromaDBManager(config_path=str(config_path))
+
+    assert create_aggregation_strategy(manager.variant("ic").aggregation).exclude_negated
+    assert not create_aggregation_strategy(manager.variant("frequency_all").aggregation).exclude_negated
+
+
+def test_config_path_does_not_depend_on_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert "chroma_db_path" in ChromaDBManager.load_config()
+
+
+def test_create_collection_returns_none_for_an_existing_name(synthetic_db_manager):
+    assert synthetic_db_manager.create_collection("HPtoEmbeddings") is not None
+    assert synthetic_db_manager.create_collection("HPtoEmbeddings") is None
+    with pytest.raises(Exception):
+        synthetic_db_manager.create_collection("x")  # invalid names still raise
+
+
 def test_get_embeddings_by_hpo_ids_faster(db_manager, ont_hp_collection):
     hpo_id_to_data_dict = db_manager.create_hpo_id_to_data_dict_with_embedding(ont_hp_collection)
     mock_data = {
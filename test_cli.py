@@ -0,0 +1,77 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from core.cli import main
+from core.data_processor import DataProcessor
+from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
+from core.query_service import QueryService
+
+
+def test_core_modules_do_not_import_chromadb():
+    code = "import sys, core.cli, core.main, core.query_service; print('chromadb' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.stdout.strip() == "False"
+
+
+def test_query_command_matches_query_service(tmp_path, synthetic_db_manager, capsys):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(f"chroma_db_path: {synthetic_db_manager.path}\n")
+    processor = DataProcessor(synthetic_db_manager)
+    disease_service = DiseaseAvgEmbeddingService(processor)
+    disease_service.process_data()
+    hps = list(processor.disease_to_hps.values())[0]
+    expected = QueryService(processor, synthetic_db_manager, disease_service, search_backend="numpy") \
+        .query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 3)
+
+    for _ in range(2):  # the second run starts from the snapshot written by the first
+        assert main(["--config", str(config_path), "query", *hps, "--top", "3", "--json"]) == 0
+        out, err = capsys.readouterr()
+        assert [row["disease"] for row in json.loads(out)] == [disease for disease, _ in expected]
+        assert err.startswith("cold start:")
+    assert main(["--config", str(config_path), "--quiet", "query", "HP:nope"]) == 1
+
+
+def test_query_command_does_not_write_to_the_db(tmp_path, synthetic_db_manager, capsys):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(f"chroma_db_path: {synthetic_db_manager.path}\n")
+    hps = list(DataProcessor(synthetic_db_manager).disease_to_hps.values())[0]
+
+    assert main(["--config", str(config_path), "--quiet", "query", "--no-snapshot", *hps]) == 0
+    assert main(["--config", str(config_path), "--quiet", "query", "--no-snapshot", *hps, "--strategy", "bma"]) == 0
+    assert sorted(collection.name for collection in synthetic_db_manager.list_collections()) == ["hpoa", "ont_hp"]
+
+
+def test_query_command_reads_annotations_from_an_hpoa_file(tmp_path, synthetic_db_manager, capsys):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(f"chroma_db_path: {synthetic_db_manager.path}\n")
+    hpoa_path = tmp_path / "phenotype.hpoa"
+    rows = [("OMIM:1", "HP:0000001"), ("OMIM:1", "HP:0000002"), ("ORPHA:2", "HP:0000003")]
+    hpoa_path.write_text("#version: test\ndatabase_id\tdisease_name\tqualifier\thpo_id\treference\tevidence\tonset\t"
+                         "frequency\tsex\tmodifier\taspect\tbiocuration\n" +
+                         "".join(f"{disease}\tname\t\t{hp_id}\tref\tTAS\t\t\t\t\tP\tcurator\n"
+                                 for disease, hp_id in rows))
+    synthetic_db_manager.client.delete_collection("hpoa")
+
+    assert main(["--config", str(config_path), "--quiet", "--hpoa-path", str(hpoa_path), "--hpoa-databases", "OMIM",
+                 "query", "--no-snapshot", "--json", "HP:0000001"]) == 0
+    assert [row["disease"] for row in json.loads(capsys.readouterr().out)] == ["OMIM:1"]
+
+
+def test_build_command_rejects_incremental_shards(capsys):
+    with pytest.raises(SystemExit):
+        main(["build", "--incremental", "--shards", "4"])
+    assert "not allowed with argument" in capsys.readouterr().err
+
+
+def test_query_command_reports_unbuilt_chroma_collection(tmp_path, synthetic_db_manager, capsys):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(f"chroma_db_path: {synthetic_db_manager.path}\n")
+    hps = list(DataProcessor(synthetic_db_manager).disease_to_hps.values())[0]
+
+    assert main(["--config", str(config_path), "--backend", "chroma", "query", "--no-snapshot", *hps]) == 1
+    assert "is empty, run 'hpdisease build' first" in capsys.readouterr().err
@@ -0,0 +1,188 @@
+import json
+
+import numpy as np
+import pytest
+
+from core.aggregation import (AGGREGATION_STRATEGIES, FrequencyWeightedAggregation, InformationContentAggregation,
+                              MeanAggregation, create_aggregation_strategy)
+from core.collection_reader import extract_fields
+from core.data_processor import DataProcessor
+from core.embedding_matrix import DiseaseIncidence, HPEmbeddings
+from core.hpoa_reader import HPOAReader
+from core.quantization import QuantizedMatrix
+from core.snapshot_cache import SnapshotCache
+
+HPOA_FILE = "phenotypeTestFile.hpoa"
+
+
+def test_hp_matrix_is_contiguous_float32(synthetic_data_processor):
+    matrix = synthetic_data_processor.hp_matrix
+    assert matrix.dtype == np.float32 and matrix.flags["C_CONTIGUOUS"]
+    assert matrix.shape[0] == len(synthetic_data_processor.hp_index)
+
+
+def test_disease_averages_match_per_disease_mean(synthetic_data_processor):
+    disease_ids, averages = synthetic_data_processor.disease_average_embeddings()
+    embeddings = {hp_id: {'embeddings': data['embeddings'].tolist()}
+                  for hp_id, data in synthetic_data_processor.hp_embeddings.items()}
+
+    for disease, average in zip(disease_ids, averages):
+        hps = synthetic_data_processor.disease_to_hps[disease]
+        expected = DataProcessor.calculate_average_embedding(hps, embeddings)
+        assert np.allclose(average, expected, atol=1e-6)
+
+
+def test_incidence_blocks_do_not_change_result():
+    rng = np.random.default_rng(1)
+    matrix = rng.normal(size=(20, 4)).astype(np.float32)
+    index = {f"HP:{i}": i for i in range(20)}
+    disease_to_hps = {f"D{d}": [f"HP:{i}" for i in rng.choice(20, size=rng.integers(1, 8))] for d in range(30)}
+    disease_to_hps["unknown"] = ["HP:nope"]
+    incidence = DiseaseIncidence.from_mapping(disease_to_hps, index)
+
+    assert "unknown" not in incidence.disease_ids
+    assert np.allclose(incidence.means(matrix, block_rows=3), incidence.means(matrix))
+
+
+def test_query_average_skips_unknown_ids():
+    embeddings = HPEmbeddings.from_records(["HP:1", None, "HP:2"], [[1, 2], [9, 9], [3, 4]])
+    assert np.allclose(embeddings.average(["HP:1", "HP:2", "HP:3"]), [2, 3])
+    assert embeddings.average(["HP:3"]) is None
+    assert np.allclose(embeddings["HP:2"]["embeddings"], [3, 4])
+
+
+def test_snapshot_round_trip(tmp_path, synthetic_db_manager):
+    cache = SnapshotCache(str(tmp_path / "snapshots"))
+    built = DataProcessor(synthetic_db_manager, snapshot_cache=cache)
+    loaded = DataProcessor(synthetic_db_manager, snapshot_cache=cache)
+
+    assert isinstance(loaded.hp_matrix, np.memmap)
+    assert loaded.hp_index == built.hp_index
+    assert loaded.disease_to_hps == built.disease_to_hps
+    assert np.array_equal(loaded.annotations.frequency, built.annotations.frequency, equal_nan=True)
+    assert np.allclose(loaded.disease_average_embeddings()[1], built.disease_average_embeddings()[1])
+
+
+@pytest.mark.parametrize("storage", ["float16", "int8"])
+def test_compact_storage_in_memory_and_snapshot(tmp_path, synthetic_db_manager, storage):
+    exact = DataProcessor(synthetic_db_manager)
+    cache = SnapshotCache(str(tmp_path / "snapshots"))
+    built = DataProcessor(synthetic_db_manager, snapshot_cache=cache, storage=storage)
+    loaded = DataProcessor(synthetic_db_manager, snapshot_cache=cache, storage=storage)
+
+    for processor in (built, loaded):
+        assert isinstance(processor.hp_matrix, QuantizedMatrix) and processor.hp_matrix.storage == storage
+        assert processor.hp_matrix.nbytes < exact.hp_matrix.nbytes / 1.5
+        assert np.allclose(processor.disease_average_embeddings()[1], exact.disease_average_embeddings()[1],
+                           atol=0.02)
+    assert isinstance(loaded.hp_matrix.codes, np.memmap)
+    assert np.array_equal(np.asarray(loaded.hp_matrix), np.asarray(built.hp_matrix))
+
+
+def test_snapshot_key_follows_collections(synthetic_db_manager):
+    ont_hp, hpoa = synthetic_db_manager.ont_hp, synthetic_db_manager.hpoa
+    key = SnapshotCache.key_for(ont_hp, hpoa)
+    assert SnapshotCache.key_for(ont_hp, hpoa) == key
+    hpoa.delete(ids=hpoa.get(limit=1, include=[])["ids"])
+    assert SnapshotCache.key_for(ont_hp, hpoa) != key
+
+
+def test_snapshot_key_follows_same_count_edits(synthetic_db_manager):
+    ont_hp, hpoa, db_path = synthetic_db_manager.ont_hp, synthetic_db_manager.hpoa, synthetic_db_manager.path
+    # re-embedding keeps ids and metadata, the sampled embeddings change
+    key = SnapshotCache.key_for(ont_hp, hpoa, db_path=db_path)
+    records = ont_hp.get(include=["metadatas", "embeddings"])
+    ont_hp.upsert(ids=records["ids"], embeddings=np.asarray(records["embeddings"]) * 2,
+                  metadatas=records["metadatas"])
+    assert SnapshotCache.key_for(ont_hp, hpoa, db_path=db_path) != key
+    # a single hpoa edit is very likely not sampled, the write sequence number still moves
+    key = SnapshotCache.key_for(ont_hp, hpoa, db_path=db_path)
+    record = hpoa.get(offset=1, limit=1, include=["metadatas", "embeddings"])
+    hpoa.upsert(ids=record["ids"], embeddings=record["embeddings"], metadatas=[{"_json": "{}"}])
+    assert SnapshotCache.key_for(ont_hp, hpoa, db_path=db_path) != key
+
+
+def test_snapshot_save_prunes_superseded_snapshots(tmp_path, synthetic_db_manager):
+    directory = tmp_path / "snapshots"
+    cache = SnapshotCache(str(directory))
+    DataProcessor(synthetic_db_manager, snapshot_cache=cache)
+    DataProcessor(synthetic_db_manager, snapshot_cache=cache, storage="int8")
+    (directory / "snapshot-v2-0123456789abcdef").mkdir()
+    hpoa = synthetic_db_manager.hpoa
+    hpoa.delete(ids=hpoa.get(limit=1, include=[])["ids"])
+    DataProcessor(synthetic_db_manager, snapshot_cache=cache)
+
+    names = sorted(path.name for path in directory.iterdir())
+    assert len(names) == 2
+    assert names[0].startswith("snapshot-v3-float32-") and names[1].startswith("snapshot-v3-int8-")
+    assert cache.load(SnapshotCache.key_for(synthetic_db_manager.ont_hp, hpoa,
+                                            db_path=synthetic_db_manager.path)) is not None
+
+
+def test_unwritable_snapshot_cache_falls_back_to_collections(tmp_path, synthetic_db_manager, monkeypatch):
+    cache = SnapshotCache(str(tmp_path / "snapshots"))
+
+    def save(*args):
+        raise PermissionError("read only")
+
+    monkeypatch.setattr(cache, "save", save)
+    processor = DataProcessor(synthetic_db_manager, snapshot_cache=cache)
+
+    assert processor.hp_matrix.shape[0] == len(processor.hp_index) > 0
+
+
+@pytest.mark.parametrize("aggregation", [FrequencyWeightedAggregation(), InformationContentAggregation()])
+def test_weighted_disease_averages(synthetic_db_manager, aggregation):
+    processor = DataProcessor(synthetic_db_manager, aggregation=aggregation)
+    weights = aggregation.annotation_weights(processor.annotations)
+    disease_ids, averages = processor.disease_average_embeddings()
+
+    for disease, average in zip(disease_ids, averages):
+        rows = processor.annotations.disease == processor.annotations.disease_values.index(disease)
+        hps = [processor.annotations.hpo_values[code] for code in processor.annotations.hpo[rows]]
+        embeddings = np.array([processor.hp_embeddings[hp_id]['embeddings'] for hp_id in hps])
+        assert np.allclose(average, np.average(embeddings, axis=0, weights=weights[rows]), atol=1e-5)
+
+
+def test_negated_annotations_are_excluded():
+    annotations = HPOAReader(HPOA_FILE).read()
+    weights = MeanAggregation(exclude_negated=True).annotation_weights(annotations)
+    assert (weights == 0).sum() == annotations.negated.sum() == 1
+
+
+def test_information_content_favours_specific_terms():
+    annotations = HPOAReader(HPOA_FILE).read()
+    aggregation = InformationContentAggregation()
+    aggregation.prepare(annotations)
+    shared = aggregation.query_weights(["HP:0000006"])[0]  # autosomal dominant, three diseases
+    unseen = aggregation.query_weights(["HP:9999999"])[0]
+    specific = aggregation.query_weights(["HP:0011097"])[0]
+    assert shared < specific < unseen
+
+
+def test_aggregation_strategy_from_config():
+    strategy = create_aggregation_strategy({"strategy": "ic", "exclude_negated": True})
+    assert isinstance(strategy, InformationContentAggregation) and strategy.exclude_negated
+    assert not any(create_aggregation_strategy({"strategy": name}).exclude_negated or strategy().exclude_negated
+                   for name, strategy in AGGREGATION_STRATEGIES.items())
+    with pytest.raises(ValueError):
+        create_aggregation_strategy({"strategy": "median"})
+
+
+def test_paged_reads_match_full_reads(synthetic_db_manager):
+    ont_hp, hpoa = synthetic_db_manager.ont_hp, synthetic_db_manager.hpoa
+    full = ont_hp.get(include=["metadatas", "embeddings"])
+    expected = HPEmbeddings.from_records((json.loads(metadata["_json"])["original_id"]
+                                          for metadata in full["metadatas"]), full["embeddings"])
+    paged = DataProcessor.create_hpo_id_to_embedding(ont_hp, page_size=7)
+
+    assert paged.index == expected.index
+    assert paged.matrix.flags["C_CONTIGUOUS"] and np.array_equal(paged.matrix, expected.matrix)
+    assert DataProcessor.create_disease_to_hps_dict(hpoa, page_size=7) == \
+        DataProcessor.create_hpoa_annotations(hpoa, page_size=1000).disease_to_hps()
+
+
+def test_extract_fields_falls_back_to_json():
+    assert extract_fields('{"disease": "OMIM:1", "phenotype": "HP:2"}', ("disease", "phenotype")) == \
+        ("OMIM:1", "HP:2")
+    assert extract_fields('{"disease": "OMIM:\\"1\\"", "onset": null}', ("disease", "onset")) == ('OMIM:"1"', None)
@@ -0,0 +1,56 @@
+import gzip
+import math
+import shutil
+
+import pytest
+
+from core.OMIMHPOExtractor import OMIMHPOExtractor
+from core.hpoa_reader import HPOAReader, parse_frequency
+
+HPOA_FILE = "phenotypeTestFile.hpoa"
+
+
+@pytest.fixture
+def gzipped_hpoa(tmp_path):
+    path = tmp_path / "phenotype.hpoa.gz"
+    with open(HPOA_FILE, "rb") as source, gzip.open(path, "wb") as target:
+        shutil.copyfileobj(source, target)
+    return str(path)
+
+
+def test_extractor_matches_split_based_parsing():
+    with open(HPOA_FILE, "r") as file:
+        lines = [line.split("\t") for line in file.read().split("\n") if line and not line.startswith("#")][1:]
+    expected = {}
+    for parts in lines:
+        expected.setdefault(parts[0], set()).add(parts[3])
+
+    mappings = OMIMHPOExtractor.extract_omim_hpo_mappings_from_stream(HPOA_FILE)
+    assert {disease: set(hps) for disease, hps in mappings.items()} == expected
+    assert all(len(hps) == len(set(hps)) for hps in mappings.values())
+
+
+def test_gzip_and_plain_give_same_columns(gzipped_hpoa):
+    plain, gzipped = HPOAReader(HPOA_FILE).read(), HPOAReader(gzipped_hpoa).read()
+    assert plain.disease_to_hps() == gzipped.disease_to_hps()
+    assert plain.frequency.tolist() == pytest.approx(gzipped.frequency.tolist(), nan_ok=True)
+
+
+def test_columns_and_filters():
+    annotations = HPOAReader(HPOA_FILE).read()
+    assert annotations.negated.sum() == 1
+    assert set(annotations.aspect_values) == {"P", "C", "I"}
+    negated_hpo = annotations.hpo_values[annotations.hpo[annotations.negated][0]]
+    negated_disease = annotations.disease_values[annotations.disease[annotations.negated][0]]
+    assert negated_hpo not in annotations.disease_to_hps(include_negated=False, unique=True)[negated_disease]
+
+    assert len(HPOAReader(HPOA_FILE, databases=["ORPHA"]).read()) == 0
+    assert len(HPOAReader(HPOA_FILE, databases=["OMIM"]).read()) == len(annotations)
+
+
+def test_parse_frequency():
+    assert parse_frequency("1/4") == 0.25
+    assert parse_frequency("40%") == pytest.approx(0.4)
+    assert parse_frequency("HP:0040280") == 1.0
+    assert math.isnan(parse_frequency(""))
+    assert math.isnan(parse_frequency("often"))
@@ -0,0 +1,49 @@
+import json
+
+from core.query_service import QueryService
+from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
+from utils.instrumentation import Metrics, metrics
+
+
+def test_disabled_metrics_record_nothing():
+    recorder = Metrics()
+    with recorder.timer("stage_seconds"):
+        pass
+    recorder.count("rows", 10)
+    assert recorder.to_dict() == {"counters": {}, "histograms": {}}
+
+
+def test_exports():
+    recorder = Metrics(enabled=True)
+    for value in (0.002, 0.004, 0.2):
+        recorder.observe("query_seconds", value, backend="numpy")
+    recorder.count("upserted_rows", 5, collection="HPtoEmbeddings")
+
+    data = json.loads(recorder.to_json())
+    histogram = data["histograms"]['query_seconds{backend="numpy"}']
+    assert histogram["count"] == 3 and histogram["p50"] == 0.005
+    prometheus = recorder.to_prometheus()
+    assert 'hpdisease_upserted_rows_total{collection="HPtoEmbeddings"} 5' in prometheus
+    assert 'hpdisease_query_seconds_bucket{backend="numpy",le="+Inf"} 3' in prometheus
+    assert "upserted_rows{collection=\"HPtoEmbeddings\"}=5" in recorder.to_log_line()
+
+
+def test_pipeline_stages_are_instrumented(synthetic_data_processor):
+    metrics.reset()
+    metrics.enable()
+    try:
+        synthetic_data_processor.load()
+        disease_service = DiseaseAvgEmbeddingService(synthetic_data_processor)
+        disease_service.process_data()
+        service = QueryService(synthetic_data_processor, synthetic_data_processor.db_manager, disease_service,
+                               search_backend="numpy")
+        service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(["HP:0000001", "HP:0000002"], 3)
+        data = metrics.to_dict()
+    finally:
+        metrics.disable()
+        metrics.reset()
+    assert data["counters"]['fetched_rows{collection="ont_hp"}'] == len(synthetic_data_processor.hp_embeddings)
+    assert data["counters"]['upserted_rows{collection="DiseaseAvgEmbeddings"}'] == \
+        len(synthetic_data_processor.disease_incidence)
+    assert data["histograms"]['query_seconds{backend="numpy"}']["count"] == 1
+    assert 'fetch_seconds{collection="hpoa"}' in data["histograms"]
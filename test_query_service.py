@@ -0,0 +1,273 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from core.async_query_service import AsyncQueryService, Overloaded
+from core.disease_archive import DiseaseAverageArchive
+from core.disease_avg_embedding_service import DiseaseAvgEmbeddingService
+from core.query_cache import MISSING, QueryCache
+from core.neighbor_index import NeighborIndex
+from core.query_service import QueryService
+from core.search_backends import NumpySearchBackend, create_search_backend, top_k_smallest
+from core.similarity_service import BestMatchAverage, L2Distance, create_similarity_strategy
+from utils.similarity_measures import SimilarityMeasures
+
+
+@pytest.fixture
+def disease_service(synthetic_data_processor):
+    service = DiseaseAvgEmbeddingService(synthetic_data_processor)
+    service.process_data()
+    return service
+
+
+def query_service(data_processor, disease_service, backend, similarity=None):
+    return QueryService(data_processor, data_processor.db_manager, disease_service, search_backend=backend,
+                        similarity=similarity)
+
+
+def ranked_ids(results):
+    return [disease for disease, _ in results]
+
+
+def test_top_k_smallest_is_sorted():
+    values = np.array([[5.0, 1.0, 4.0, 0.5, 3.0], [0.0, 2.0, 1.0, 3.0, 4.0]])
+    _, columns = top_k_smallest(values, 3)
+    assert columns.tolist() == [[3, 1, 4], [0, 2, 1]]
+
+
+@pytest.mark.parametrize("similarity", list(SimilarityMeasures))
+def test_numpy_distances_match_definitions(similarity):
+    rng = np.random.default_rng(3)
+    diseases, query = rng.normal(size=(5, 4)), rng.normal(size=4)
+    distances = NumpySearchBackend([str(i) for i in range(5)], diseases, similarity).distances(query)[0]
+    if similarity == SimilarityMeasures.COSINE:
+        expected = 1 - diseases @ query / (np.linalg.norm(diseases, axis=1) * np.linalg.norm(query))
+    elif similarity == SimilarityMeasures.L2:
+        expected = ((diseases - query) ** 2).sum(axis=1)
+    else:
+        expected = 1 - diseases @ query
+    assert np.allclose(distances, expected, atol=1e-5)
+
+
+def test_numpy_backend_matches_chroma(synthetic_data_processor, disease_service):
+    chroma = query_service(synthetic_data_processor, disease_service, "chroma")
+    in_memory = query_service(synthetic_data_processor, disease_service, "numpy")
+    for hps in list(synthetic_data_processor.disease_to_hps.values())[:10]:
+        expected = chroma.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 5)
+        actual = in_memory.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 5)
+        assert ranked_ids(actual) == ranked_ids(expected)
+        assert np.allclose([d for _, d in actual], [d for _, d in expected], atol=1e-5)
+
+
+@pytest.mark.parametrize("similarity", list(SimilarityMeasures))
+def test_hnsw_backend_matches_numpy(tmp_path, synthetic_data_processor, similarity):
+    pytest.importorskip("hnswlib")
+    disease_ids, embeddings = synthetic_data_processor.disease_average_embeddings()
+    exact = create_search_backend("numpy", similarity, disease_ids, embeddings)
+    approximate = create_search_backend("hnsw", similarity, disease_ids, embeddings, index_dir=str(tmp_path))
+    reloaded = create_search_backend("hnsw", similarity, disease_ids, embeddings, index_dir=str(tmp_path))
+    queries = embeddings[:5] + 0.01
+    for backend in (approximate, reloaded):
+        for expected, actual in zip(exact.search(queries, 5), backend.search(queries, 5)):
+            assert ranked_ids(actual) == ranked_ids(expected)
+
+
+def test_chroma_backend_falls_back_for_other_measures(synthetic_data_processor, disease_service):
+    service = query_service(synthetic_data_processor, disease_service, "chroma")
+    assert isinstance(service.get_search_backend(SimilarityMeasures.IP), NumpySearchBackend)
+
+
+@pytest.mark.parametrize("storage", ["float16", "int8"])
+@pytest.mark.parametrize("similarity", list(SimilarityMeasures))
+def test_compact_numpy_backend_and_rerank(synthetic_data_processor, storage, similarity):
+    disease_ids, averages = synthetic_data_processor.disease_average_embeddings()
+    queries = averages[:5] + 0.01
+    exact = NumpySearchBackend(disease_ids, averages, similarity).search(queries, 5)
+    compact = NumpySearchBackend(disease_ids, averages, similarity, storage=storage)
+    reranked = NumpySearchBackend(disease_ids, averages, similarity, storage=storage, rerank=4).search(queries, 5)
+
+    assert compact.matrix.nbytes < averages.nbytes / 1.5
+    for expected, approximate in zip(exact, compact.search(queries, 5)):
+        assert np.allclose([d for _, d in approximate], [d for _, d in expected], atol=0.05)
+    for expected, results in zip(exact, reranked):
+        assert ranked_ids(results) == ranked_ids(expected)
+        assert np.allclose([d for _, d in results], [d for _, d in expected], atol=1e-5)
+
+
+def test_compact_backend_owns_the_only_disease_matrix(synthetic_data_processor, disease_service):
+    service = QueryService(synthetic_data_processor, synthetic_data_processor.db_manager, disease_service,
+                           search_backend="numpy", storage="int8")
+    backend = service.get_search_backend()
+
+    assert backend.matrix.storage == "int8" and backend.exact_matrix is None
+    assert synthetic_data_processor._disease_averages is None
+
+
+def test_unknown_hpos_return_message(synthetic_data_processor, disease_service):
+    service = query_service(synthetic_data_processor, disease_service, "numpy")
+    assert isinstance(service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(["HP:nope"], 3), str)
+
+
+@pytest.mark.parametrize("n_processes", [None, 2])
+def test_query_many_matches_single_queries(synthetic_data_processor, disease_service, n_processes):
+    service = query_service(synthetic_data_processor, disease_service, "numpy")
+    patients = list(synthetic_data_processor.disease_to_hps.values())[:9] + [["HP:nope"]]
+    batch = service.query_many(patients, 4, chunk_size=4, n_processes=n_processes)
+
+    assert len(batch) == len(patients) and batch[-1] == []
+    for hps, results in zip(patients[:-1], batch):
+        expected = service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 4)
+        assert ranked_ids(results) == ranked_ids(expected)
+        assert np.allclose([d for _, d in results], [d for _, d in expected], atol=1e-5)
+
+
+@pytest.mark.parametrize("similarity", list(SimilarityMeasures))
+def test_similarity_strategies_match_numpy_backend(synthetic_data_processor, disease_service, similarity):
+    service = query_service(synthetic_data_processor, disease_service, "numpy", similarity)
+    patients = list(synthetic_data_processor.disease_to_hps.values())[:6] + [["HP:nope"]]
+    ranked = service.query_many_with_similarity_strategy(patients, 4, similarity.value, block_size=4)
+
+    assert ranked[-1] == []
+    for hps, results in zip(patients[:-1], ranked):
+        expected = service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 4)
+        assert ranked_ids(results) == ranked_ids(expected)
+        assert np.allclose([d for _, d in results], [d for _, d in expected], atol=1e-4)
+
+
+def test_best_match_average_matches_pairwise(synthetic_data_processor, disease_service):
+    service = query_service(synthetic_data_processor, disease_service, "numpy")
+    embeddings = synthetic_data_processor.hp_embeddings
+    hps = list(synthetic_data_processor.disease_to_hps.values())[0][:3]
+    ranked = service.query_with_similarity_strategy(hps, 5, BestMatchAverage())
+
+    query = np.array([embeddings[hp]["embeddings"] for hp in sorted(set(hps))])
+    expected = sorted((1 - BestMatchAverage().calculate_similarity(
+        query, np.array([embeddings[hp]["embeddings"] for hp in disease_hps if hp in embeddings])), disease)
+        for disease, disease_hps in synthetic_data_processor.disease_to_hps.items())[:5]
+    assert np.allclose([d for _, d in ranked], [d for d, _ in expected], atol=1e-5)
+
+
+def test_pairwise_strategies():
+    assert np.isclose(L2Distance().calculate_similarity([0, 3], [4, 0]), 5)
+    assert np.isclose(BestMatchAverage().calculate_similarity([[1, 0]], [[1, 0], [0, 1]]), 0.75)
+    with pytest.raises(ValueError):
+        create_similarity_strategy("jaccard")
+
+
+@pytest.mark.parametrize("similarity", ["cosine", "l2"])
+def test_neighbor_index_matches_brute_force(tmp_path, synthetic_data_processor, similarity):
+    ids, matrix = synthetic_data_processor.hp_embeddings.ids, synthetic_data_processor.hp_matrix
+    index = NeighborIndex.for_hp_terms(synthetic_data_processor, 5, similarity_strategy=similarity,
+                                       query_block_rows=7, block_size=11)
+    distances = create_similarity_strategy(similarity).distances(matrix, matrix)
+    np.fill_diagonal(distances, np.inf)
+    for row in (0, len(ids) // 2, len(ids) - 1):
+        expected = np.argsort(distances[row], kind="stable")[:5]
+        assert [hp for hp, _ in index.most_similar(ids[row])] == [ids[j] for j in expected]
+        assert np.allclose([d for _, d in index.most_similar(ids[row])], distances[row, expected], atol=1e-5)
+
+    path = str(tmp_path / "neighbors" / "hp")
+    index.save(path)
+    loaded = NeighborIndex.load(path)
+    assert isinstance(loaded.neighbors, np.memmap) and loaded.most_similar(ids[3], 2) == index.most_similar(ids[3], 2)
+    assert NeighborIndex.load_or_build(path, ids, matrix, 5, similarity_strategy=similarity).fingerprint == \
+        index.fingerprint
+    assert NeighborIndex.load_or_build(path, ids, matrix, 3, similarity_strategy=similarity).n_neighbors == 3
+
+
+def test_query_service_serves_imported_archive(tmp_path, synthetic_data_processor, disease_service):
+    path = DiseaseAverageArchive.from_data_processor(synthetic_data_processor).save(str(tmp_path / "export"))
+    built = query_service(synthetic_data_processor, disease_service, "numpy")
+    served = query_service(synthetic_data_processor, disease_service, "numpy")
+    served.use_disease_archive(DiseaseAverageArchive.load(path))
+
+    assert isinstance(served.search_backends[served.similarity].matrix, np.ndarray)
+    for hps in list(synthetic_data_processor.disease_to_hps.values())[:5]:
+        assert served.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 4) == \
+            built.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 4)
+
+
+def test_query_cache_hits_and_invalidation(synthetic_data_processor, disease_service):
+    service = QueryService(synthetic_data_processor, synthetic_data_processor.db_manager, disease_service,
+                           search_backend="numpy", cache=QueryCache())
+    hps = list(synthetic_data_processor.disease_to_hps.values())[0]
+    first = service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 3)
+    again = service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(list(reversed(hps)) + hps[:1], 3)
+
+    assert again == first
+    assert service.cache_stats()["hits"] == 1
+
+    disease_service.process_data()
+    service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 3)
+    assert service.cache_stats()["hits"] == 1
+
+
+def test_query_cache_eviction_and_ttl():
+    now = [0.0]
+    cache = QueryCache(max_entries=2, max_bytes=100, ttl_seconds=10, clock=lambda: now[0])
+    cache.put("a", 1, 10)
+    cache.put("b", 2, 10)
+    cache.get("a")
+    cache.put("c", 3, 10)
+    assert cache.get("b") is MISSING and cache.get("a") == 1
+
+    cache.put("big", 4, 95)
+    assert len(cache) == 1 and cache.stats()["evictions"] == 3
+
+    now[0] = 11
+    assert cache.get("big") is MISSING
+
+
+def test_async_query_service_micro_batches(synthetic_data_processor, disease_service):
+    service = query_service(synthetic_data_processor, disease_service, "numpy")
+    patients = list(synthetic_data_processor.disease_to_hps.values())[:6] + [["HP:nope"]]
+
+    async def run():
+        async with AsyncQueryService(service, max_workers=2, batch_window_ms=20, timeout=30) as async_service:
+            return await asyncio.gather(*(async_service.query(hps, 2 + i % 3) for i, hps in enumerate(patients)))
+
+    results = asyncio.run(run())
+    assert results[-1] == []
+    for i, (hps, ranked) in enumerate(zip(patients[:-1], results)):
+        expected = service.query_diseases_by_hpo_terms_using_inbuild_distance_functions(hps, 2 + i % 3)
+        assert ranked_ids(ranked) == ranked_ids(expected)
+
+
+def test_async_query_service_backpressure_and_timeout(synthetic_data_processor, disease_service):
+    service = query_service(synthetic_data_processor, disease_service, "numpy")
+    hps = list(synthetic_data_processor.disease_to_hps.values())[0]
+
+    async def run():
+        async with AsyncQueryService(service, batch_window_ms=50, max_pending=1, wait_when_full=False) as async_service:
+            first = asyncio.ensure_future(async_service.query(hps, 3))
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(async_service.query(hps, 3))
+            await asyncio.sleep(0)
+            with pytest.raises(Overloaded):
+                await async_service.query(hps, 3)
+            first, second = await first, await second
+        async with AsyncQueryService(service, batch_window_ms=500) as async_service:
+            with pytest.raises(asyncio.TimeoutError):
+                await async_service.query(hps, 3, timeout=0.01)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second and len(first) == 3
+
+
+def test_async_query_service_close_fails_unscored_batch(synthetic_data_processor, disease_service):
+    service = query_service(synthetic_data_processor, disease_service, "numpy")
+    hps = list(synthetic_data_processor.disease_to_hps.values())[0]
+
+    async def run():
+        async_service = AsyncQueryService(service, batch_window_ms=100)
+        async_service.start()
+        request = asyncio.ensure_future(async_service.query(hps, 3))
+        await asyncio.sleep(0.01)  # the batcher holds the request in its batch window
+        await async_service.close()
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(request, 1)
+
+    asyncio.run(run())
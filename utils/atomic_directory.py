@@ -0,0 +1,26 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def atomic_directory(path: str) -> Iterator[str]:
+    """
+    Yields a temporary directory next to path, which replaces path once the block completes, so readers never see a
+    half written directory. The temporary directory is removed if the block raises.
+
+    :param path: Final directory, an existing one is replaced.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        yield tmp_path
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
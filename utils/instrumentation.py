@@ -0,0 +1,191 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, the last bucket (+Inf) is implicit
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+"""
+    Opt-in timers, counters and histograms for the hot paths. Everything is a no-op until enabled, either with
+    metrics.enable() or by setting HPDISEASE_METRICS=1. Results can be written as one log line, Prometheus text or json.
+"""
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[position] += 1
+                return
+        self.bucket_counts[-1] += 1
+
+    def quantile(self, q: float) -> float:
+        """ Upper bound of the bucket holding the q quantile, the usual histogram estimate. """
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return {"count": self.count, "sum": self.sum, "min": self.min if self.count else 0.0,
+                "max": self.max if self.count else 0.0, "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                "buckets": dict(zip([*map(str, self.buckets), "+Inf"], self.bucket_counts))}
+
+
+class _Timer:
+    __slots__ = ("metrics", "key", "start")
+
+    def __init__(self, metrics: "Metrics", key: Optional[Key]):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        if self.key is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.key is not None:
+            self.metrics._observe(self.key, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counters: Dict[Key, float] = {}
+        self.histograms: Dict[Key, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, str]) -> Key:
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def count(self, name: str, value: float = 1, **labels):
+        """ Adds value to a counter, e.g. rows, bytes or upserts of a stage. """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        if self.enabled:
+            self._observe(self._key(name, labels), value)
+
+    def _observe(self, key: Key, value: float):
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name: str, **labels) -> _Timer:
+        """ Context manager recording the duration of its block in seconds into the histogram name. """
+        return _Timer(self, self._key(name, labels) if self.enabled else None)
+
+    @staticmethod
+    def _format(key: Key) -> str:
+        name, labels = key
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {"counters": {self._format(key): value for key, value in sorted(self.counters.items())},
+                    "histograms": {self._format(key): histogram.to_dict()
+                                   for key, histogram in sorted(self.histograms.items())}}
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_log_line(self) -> str:
+        data = self.to_dict()
+        parts = [f"{name}={value:g}" for name, value in data["counters"].items()]
+        parts += [f"{name}=count:{h['count']},sum:{h['sum']:.4f}s,p50:{h['p50']:g}s,p99:{h['p99']:g}s"
+                  for name, h in data["histograms"].items()]
+        return " ".join(parts)
+
+    def log(self, level: int = logging.INFO):
+        logger.log(level, f"metrics {self.to_log_line()}")
+
+    def to_prometheus(self, prefix: str = "hpdisease_") -> str:
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}{name}_total counter")
+                lines.append(f"{self._format((prefix + name + '_total', labels))} {value:g}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = prefix + name
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, bucket_count in zip([*map(str, histogram.buckets), "+Inf"], histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self._format((metric + '_bucket', labels + (('le', bound),)))} {cumulative}")
+                lines.append(f"{self._format((metric + '_sum', labels))} {histogram.sum:g}")
+                lines.append(f"{self._format((metric + '_count', labels))} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(enabled=os.environ.get("HPDISEASE_METRICS") == "1")
+
+
+@contextmanager
+def profile(output_path: Optional[str] = None, sort: str = "cumulative", limit: int = 30):
+    """
+    cProfile a block, e.g. a single run_analysis call. The raw stats are written to output_path (open with snakeviz,
+    pstats or compare with a py-spy recording), the top entries are logged either way.
+
+        with profile("run_analysis.prof"):
+            main.run_analysis(hpo_ids)
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if output_path:
+            profiler.dump_stats(output_path)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+        logger.info(f"profile{' written to ' + output_path if output_path else ''}\n{stream.getvalue()}")